@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Benchmarks the utilities against synthetic iTunes libraries and Strawberry databases of
+increasing size, recording the elapsed time and peak memory of each run as JSON, so changes
+in performance can be compared between versions.
+
+The synthetic data resembles that of a real library: iTunes URLs are encoded with decomposed
+(NFD) unicode characters, part of the collection has been moved to another directory in
+Strawberry, some tracks lack an artist, location, or play date, some songs are duplicated,
+and the library has playlists.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import sqlite3
+import argparse
+import platform
+import multiprocessing
+import subprocess
+import unicodedata
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+ARTISTS = ('Björk', 'Brian Eno & David Byrne', "Guns N' Roses", 'Sigur Rós', 'Motörhead', 'Beyoncé',
+           'The Beatles', 'Mötley Crüe', 'Ólafur Arnalds', 'AC/DC', 'Sinéad O\'Connor', 'Sade')
+
+# The directory of the iTunes library, and the directory part of the collection was moved to.
+ITUNES_DIRECTORY = '/Volumes/Music/iTunes/iTunes Music'
+MOVED_DIRECTORY = '/Volumes/Music/Media'
+
+# The URL replacement of the moved part of the collection.
+REPLACE_URL = 'iTunes/iTunes%20Music'
+REPLACE_WITH = 'Media'
+
+# Each mode benchmarked, the utility and its arguments. {library}, {strawberry} and {source}
+# are replaced with the paths of the synthetic files. The library XML is parsed by each run,
+# except by the snapshot modes.
+MODES = {
+    'unplayed': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-p', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'unplayed-bulk': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-p', '-b', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'unplayed-snapshot': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '--snapshot', '{library}.snapshot', '-p', '-b', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'all': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-u', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'all-bulk': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-u', '-b', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'playlists': ['iTunesPlayLists2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-r', REPLACE_URL, REPLACE_WITH],
+    'all-pipeline': ['iTunes2Strawberry.py', '-s', '{strawberry}', '-i', '{library}', '-u', '-P', '-r', REPLACE_URL, '-w', REPLACE_WITH],
+    'merge': ['updateStrawberry.py', '-u', '{strawberry}', '-f', '{source}'],
+    'merge-pipeline': ['updateStrawberry.py', '-u', '{strawberry}', '-f', '{source}', '-P'],
+    'consolidate': ['consolidateTracks.py', '-u', '{strawberry}', '--detect-duplicates', '-w'],
+}
+
+# The modes reading a snapshot of the library, which are run once beforehand to write it.
+SNAPSHOT_MODES = ('unplayed-snapshot',)
+
+SONGS_SCHEMA = """CREATE TABLE songs (title TEXT, album TEXT, artist TEXT, albumartist TEXT, track INTEGER NOT NULL DEFAULT -1,
+    disc INTEGER NOT NULL DEFAULT -1, year INTEGER NOT NULL DEFAULT -1, genre TEXT, composer TEXT, grouping TEXT, comment TEXT,
+    length INTEGER NOT NULL DEFAULT 0, bitrate INTEGER NOT NULL DEFAULT -1, samplerate INTEGER NOT NULL DEFAULT -1, url TEXT NOT NULL,
+    unavailable INTEGER DEFAULT 0, filesize INTEGER NOT NULL DEFAULT -1, mtime INTEGER NOT NULL DEFAULT -1, ctime INTEGER NOT NULL DEFAULT -1,
+    playcount INTEGER NOT NULL DEFAULT 0, lastplayed INTEGER NOT NULL DEFAULT -1, skipcount INTEGER NOT NULL DEFAULT 0,
+    compilation INTEGER NOT NULL DEFAULT 0, rating REAL NOT NULL DEFAULT -1);
+CREATE INDEX idx_url ON songs (url);
+CREATE TABLE playlists (name TEXT NOT NULL, last_played INTEGER NOT NULL DEFAULT -1, ui_order INTEGER NOT NULL DEFAULT 0,
+    special_type TEXT, ui_path TEXT, is_favorite INTEGER NOT NULL DEFAULT 0, dynamic_playlist_type INTEGER,
+    dynamic_playlist_data BLOB, dynamic_playlist_backend TEXT);
+CREATE TABLE playlist_items (playlist INTEGER NOT NULL, type INTEGER NOT NULL DEFAULT 0, collection_id INTEGER,
+    source INTEGER NOT NULL DEFAULT 0, title TEXT, url TEXT);
+"""
+
+def syntheticTracks(trackCount, seed = 1):
+    """
+    Generates a dictionary of the fields of each synthetic track, with the path of its file.
+    """
+    randomTracks = random.Random(seed)
+    firstPlay = datetime(2010, 1, 1)
+    for trackNumber in range(trackCount):
+        artist = ARTISTS[trackNumber % len(ARTISTS)]
+        album = f"Álbum {trackNumber // 12}"
+        track = {
+            'Track ID': 1000 + trackNumber,
+            'Name': f"Canción {trackNumber} (Señor's Mix)",
+            'Artist': artist,
+            'Album': album,
+            'Total Time': randomTracks.randrange(60000, 600000),
+            'Size': randomTracks.randrange(1000000, 20000000),
+            'path': f"{artist}/{album}/{trackNumber % 12 + 1:02} Canción {trackNumber}.mp3",
+        }
+        if randomTracks.random() < 0.7:
+            track['Play Count'] = randomTracks.randrange(1, 50)
+            # Some played tracks lack a play date.
+            if randomTracks.random() < 0.95:
+                track['Play Date UTC'] = firstPlay + timedelta(seconds = randomTracks.randrange(400000000))
+        if randomTracks.random() < 0.2:
+            track['Skip Count'] = randomTracks.randrange(1, 10)
+        if randomTracks.random() < 0.02:
+            del track['Artist']
+        if randomTracks.random() < 0.005:
+            del track['path']
+        yield track
+
+def writeLibrary(libraryPath, trackCount, playlistCount):
+    """
+    Writes the synthetic iTunes Library.xml, with the paths of the tracks URL encoded in NFD form, as iTunes does.
+    """
+    with open(libraryPath, 'w', encoding = 'utf-8') as libraryFile:
+        libraryFile.write('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n')
+        libraryFile.write('<plist version="1.0">\n<dict>\n\t<key>Major Version</key><integer>1</integer>\n\t<key>Minor Version</key><integer>1</integer>\n')
+        libraryFile.write('\t<key>Date</key><date>2022-05-01T00:00:00Z</date>\n\t<key>Application Version</key><string>12.8</string>\n')
+        libraryFile.write(f'\t<key>Music Folder</key><string>file://{quote(ITUNES_DIRECTORY)}/</string>\n\t<key>Tracks</key>\n\t<dict>\n')
+        for track in syntheticTracks(trackCount):
+            fields = [f"\t\t\t<key>Track ID</key><integer>{track['Track ID']}</integer>"]
+            for key in ('Name', 'Artist', 'Album'):
+                if key in track:
+                    fields.append(f"\t\t\t<key>{key}</key><string>{escape(track[key])}</string>")
+            for key in ('Total Time', 'Size', 'Play Count', 'Skip Count'):
+                if key in track:
+                    fields.append(f"\t\t\t<key>{key}</key><integer>{track[key]}</integer>")
+            if 'Play Date UTC' in track:
+                fields.append(f"\t\t\t<key>Play Date UTC</key><date>{track['Play Date UTC'].strftime('%Y-%m-%dT%H:%M:%SZ')}</date>")
+            if 'path' in track:
+                location = 'file://' + quote(unicodedata.normalize('NFD', f"{ITUNES_DIRECTORY}/{track['path']}"))
+                fields.append(f"\t\t\t<key>Location</key><string>{escape(location)}</string>")
+            libraryFile.write(f"\t\t<key>{track['Track ID']}</key>\n\t\t<dict>\n" + '\n'.join(fields) + "\n\t\t</dict>\n")
+        libraryFile.write('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+        randomPlaylists = random.Random(2)
+        playlists = [('Library', range(trackCount))]
+        for playlistNumber in range(playlistCount):
+            playlistSize = randomPlaylists.randrange(10, 1000)
+            playlists.append((f"Playlist {playlistNumber}", [randomPlaylists.randrange(trackCount) for item in range(playlistSize)]))
+        for playlistName, trackNumbers in playlists:
+            libraryFile.write(f"\t\t<dict>\n\t\t\t<key>Name</key><string>{playlistName}</string>\n\t\t\t<key>Description</key><string></string>\n")
+            libraryFile.write("\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n")
+            for trackNumber in trackNumbers:
+                libraryFile.write(f"\t\t\t\t<dict><key>Track ID</key><integer>{1000 + trackNumber}</integer></dict>\n")
+            libraryFile.write("\t\t\t</array>\n\t\t</dict>\n")
+        libraryFile.write('\t</array>\n</dict>\n</plist>\n')
+
+def writeStrawberry(strawberryPath, sourcePath, trackCount):
+    """
+    Writes the synthetic Strawberry database of the tracks, and the Strawberry database of another computer to merge
+    from. A quarter of the collection has been moved, and some songs are duplicated. The URLs are NFC encoded, as
+    Strawberry does.
+    """
+    randomSongs = random.Random(3)
+    songs = []
+    sourceSongs = []
+    for track in syntheticTracks(trackCount):
+        path = track.get('path', f"{track['Artist'] if 'Artist' in track else ''}/{track['Album']}/missing {track['Track ID']}.mp3")
+        directory = MOVED_DIRECTORY if track['Track ID'] % 4 == 0 else ITUNES_DIRECTORY
+        url = 'file://' + quote(unicodedata.normalize('NFC', f"{directory}/{path}"), safe = "/&'(),[];!+=@")
+        played = randomSongs.random() < 0.3
+        song = (track['Name'], track['Album'], track.get('Artist', ''), url, track['Total Time'] * 1000000, track['Size'],
+                randomSongs.randrange(1, 20) if played else 0, 0, 1600000000 + randomSongs.randrange(50000000) if played else -1)
+        songs.append(song)
+        if randomSongs.random() < 0.01:
+            # A duplicate of the song, in another format.
+            songs.append(song[:3] + (url.replace('.mp3', '.m4a'),) + song[4:6] + (randomSongs.randrange(1, 5), 0, 1650000000))
+        if randomSongs.random() < 0.5:
+            sourceSongs.append(song[:6] + (randomSongs.randrange(1, 30), randomSongs.randrange(3), 1600000000 + randomSongs.randrange(60000000)))
+    for databasePath, databaseSongs in ((strawberryPath, songs), (sourcePath, sourceSongs)):
+        if os.path.exists(databasePath):
+            os.remove(databasePath)
+        databaseClient = sqlite3.connect(databasePath)
+        databaseClient.executescript(SONGS_SCHEMA)
+        databaseClient.executemany("INSERT INTO songs (title, album, artist, url, length, filesize, playcount, skipcount, lastplayed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   databaseSongs)
+        databaseClient.commit()
+        databaseClient.close()
+
+def generateFiles(directory, trackCount):
+    """
+    Writes the synthetic files of the number of tracks to the directory, unless already written.
+    Returns a dictionary of the paths of the files.
+    """
+    paths = {
+        'library': os.path.join(directory, f"Library-{trackCount}.xml"),
+        'strawberry': os.path.join(directory, f"strawberry-{trackCount}.db"),
+        'source': os.path.join(directory, f"source-{trackCount}.db"),
+    }
+    if not all(os.path.exists(path) for path in paths.values()):
+        appLogger.info(f"Generating synthetic library of {trackCount} tracks")
+        # Linux reports the peak memory of a child process as at least that of its parent when forked, so the files
+        # are generated in another process, keeping the memory of this one, which forks each run, small.
+        spawnContext = multiprocessing.get_context('spawn')
+        for target, targetArgs in ((writeLibrary, (paths['library'], trackCount, max(trackCount // 2500, 4))),
+                                   (writeStrawberry, (paths['strawberry'], paths['source'], trackCount))):
+            generator = spawnContext.Process(target = target, args = targetArgs)
+            generator.start()
+            generator.join()
+    return paths
+
+def runMode(mode, paths, workPath, timeout):
+    """
+    Runs the utility of the mode on a copy of the synthetic Strawberry database.
+    Returns a dictionary of the elapsed seconds, peak resident memory in bytes, and exit status of the run.
+    """
+    shutil.copyfile(paths['strawberry'], workPath)
+    command = [sys.executable] + [argument.format(**dict(paths, strawberry = workPath)) for argument in MODES[mode]]
+    command[1] = os.path.join(os.path.dirname(os.path.abspath(__file__)), command[1])
+    appLogger.debug(' '.join(command))
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    timedOut = False
+    while True:
+        pid, status, resources = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if timeout is not None and time.perf_counter() - started > timeout:
+            process.kill()
+            timedOut = True
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    # The maximum resident set size is in kilobytes on Linux, but bytes on MacOS.
+    peakMemory = resources.ru_maxrss if sys.platform == 'darwin' else resources.ru_maxrss * 1024
+    return {'seconds': round(elapsed, 3), 'peak_memory': peakMemory, 'exit_status': os.waitstatus_to_exitcode(status), 'timed_out': timedOut}
+
+def compareResults(results, baseline, tolerance):
+    """
+    Prints the change of each result from the baseline results.
+    Returns the number of results slower, or using more memory, than the baseline by more than the tolerance ratio.
+    """
+    baselineResults = {(result['tracks'], result['mode']): result for result in baseline['results']}
+    regressionCount = 0
+    for result in results:
+        baselineResult = baselineResults.get((result['tracks'], result['mode']))
+        if baselineResult is None:
+            continue
+        timeRatio = result['seconds'] / max(baselineResult['seconds'], 0.001)
+        memoryRatio = result['peak_memory'] / max(baselineResult['peak_memory'], 1)
+        regressed = timeRatio > tolerance or memoryRatio > tolerance
+        regressionCount += int(regressed)
+        print(f"{result['mode']:>17} {result['tracks']:>8}: time x{timeRatio:.2f}, memory x{memoryRatio:.2f}{' REGRESSED' if regressed else ''}")
+    return regressionCount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks the utilities against synthetic iTunes libraries and Strawberry databases, recording the time and peak memory of each.')
+    parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
+    parser.add_argument('-n', '--tracks', action = 'store', type = int, nargs = '+', help = 'The number of tracks of each synthetic library. Defaults to %(default)s.', default = list(DEFAULT_SIZES))
+    parser.add_argument('-m', '--modes', action = 'store', nargs = '+', choices = list(MODES.keys()), help = 'The modes to benchmark. Defaults to all.', default = list(MODES.keys()))
+    parser.add_argument('-d', '--directory', action = 'store', type = str, help = 'Directory of the synthetic files, which are reused if present. Defaults to %(default)s.', default = 'benchmark')
+    parser.add_argument('-o', '--output', action = 'store', type = str, help = 'Path of the JSON results. Defaults to %(default)s.', default = 'benchmark_results.json')
+    parser.add_argument('-t', '--timeout', action = 'store', type = float, help = 'Stop any run taking longer than this many seconds.', default = None)
+    parser.add_argument('-c', '--compare', action = 'store', type = str, help = 'Path of earlier JSON results to compare with, exiting with an error if any mode regressed.', default = None)
+    parser.add_argument('--tolerance', action = 'store', type = float, help = 'The ratio of time or memory to the earlier results which is a regression. Defaults to %(default)s.', default = 1.25)
+    args = parser.parse_args()
+
+    # We set the logging value here so it's available to the core and master nodes.
+    appLogger = logging.getLogger("benchmark")
+    logging.basicConfig()
+
+    if args.verbose > 1:
+        appLogger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        appLogger.setLevel(logging.INFO)
+
+    os.makedirs(args.directory, exist_ok = True)
+    results = []
+    for trackCount in args.tracks:
+        paths = generateFiles(args.directory, trackCount)
+        for mode in args.modes:
+            if mode in SNAPSHOT_MODES:
+                runMode(mode, paths, os.path.join(args.directory, 'work.db'), args.timeout)
+            result = runMode(mode, paths, os.path.join(args.directory, 'work.db'), args.timeout)
+            result.update(tracks = trackCount, mode = mode)
+            results.append(result)
+            print(f"{mode:>17} {trackCount:>8}: {result['seconds']:10.3f}s {result['peak_memory'] / 1024 / 1024:8.1f}MB"
+                  f"{' timed out' if result['timed_out'] else ''}{' failed' if result['exit_status'] != 0 and not result['timed_out'] else ''}")
+
+    with open(args.output, 'w') as outputFile:
+        json.dump({
+            'date': datetime.now().isoformat(timespec = 'seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'results': results
+        }, outputFile, indent = 1)
+
+    if args.compare is not None:
+        with open(args.compare) as baselineFile:
+            regressionCount = compareResults(results, json.load(baselineFile), args.tolerance)
+        if regressionCount > 0:
+            appLogger.error(f"{regressionCount} results regressed")
+            sys.exit(1)
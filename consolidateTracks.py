@@ -9,8 +9,12 @@ import argparse
 import sqlite3
 import re
 from datetime import datetime, timezone
-from urllib.parse import quote, unquote, urlparse, urlunparse
-import unicodedata
+from strawberryDatabase import executeUpdate, likePattern
+from runStatistics import runStatistics
+from urlConversion import convertURL
+from liveDatabase import databaseToUpdate
+
+appLogger = logging.getLogger("consolidateTracks")
 
 def dumpAllPlayed(cursor):
     findPlayed = "SELECT title,artist,url,playcount,lastplayed,skipcount FROM songs WHERE playcount <> 0"
@@ -19,55 +23,37 @@ def dumpAllPlayed(cursor):
     for row in cursor.fetchall():
         print(row[0], row[1], row[2], row[3], datetime.fromtimestamp(row[4]), row[5])
 
-def convertURL(iTunesURL):
-    """
-    Converts the iTunes URLs to a URL that can be found in the Strawberry database.
-    """
-    # Convert XML encoding of ampersands in the URL.
-    iTunesURL = iTunesURL.replace('&#38;', '&')
-    # iTunes encodes URLs, using UTF-8 encoding, but using a character and the combining diacritic,
-    # instead of the noramlized, singular combined character including the diacritic, that Strawberry uses.
-    # For example, iTunes: "n%CC%83", Strawberry: "%C3%B1"
-    # So we need to decode the URL encoding, normalize the characters to the Normal Form
-    # Composed form, then decode the unicode encoding into UTF-8, then reencode the URL.
-    parsedURL = urlparse(iTunesURL) # parse the URL to ensure the URL separators don't get encoded.
-    decodedPath = unquote(parsedURL.path)
-    normalizedUnicodePath = unicodedata.normalize('NFC', decodedPath)
-    # While Strawberry encodes the URL, it leaves a lot of characters unquoted.
-    encodedURL = urlunparse((parsedURL.scheme,
-                             parsedURL.netloc,
-                             quote(normalizedUnicodePath, safe = "/&'(),[];!+=@"),
-                             parsedURL.params,
-                             parsedURL.query,
-                             parsedURL.fragment))
-    return encodedURL
-
 def updatePlayDetails(strawberryDatabaseCursor, cleanedURL, newPlayCount, newLastPlayed, newSkipCount):
     # Set the track with the unassigned play count, last played date, and skip counts to the iTunes values:
     # Escape quote characters in URL for SQL use.
     cleanedURL = cleanedURL.replace("'", "''")
     updateCounts = f"UPDATE songs SET playcount = {newPlayCount}, skipcount = {newSkipCount}, lastplayed = {newLastPlayed} WHERE url = '{cleanedURL}'"
     appLogger.debug(updateCounts)
-    strawberryDatabaseCursor.execute(updateCounts)
     # Determine if the field was updated.
-    strawberryDatabaseCursor.execute('SELECT changes() FROM songs')
-    result = strawberryDatabaseCursor.fetchone()
-    if result[0] == 0:
+    if executeUpdate(strawberryDatabaseCursor, updateCounts) == 0:
         appLogger.warning(f"Unable to update {cleanedURL}")
         return False
     else:
         print(f"Updated Track: {cleanedURL} to play count {newPlayCount}, last played {newLastPlayed}, skip count {newSkipCount}")
         return True
     
+def consolidatedPlayDetails(fromTrack, toTrack):
+    """
+    Returns the tuple of total plays, latest play and total skips of the consolidated tracks,
+    using the latest lastplayed of the two tracks, and summing the playcounts and skipcounts.
+    """
+    latestPlay = max(fromTrack['lastplayed'], toTrack['lastplayed'])
+    totalPlays = fromTrack['playcount'] + toTrack['playcount']
+    totalSkips = fromTrack['skipcount'] + toTrack['skipcount']
+    return totalPlays, latestPlay, totalSkips
+
 def consolidateStrawberryTracks(updateDatabaseCursor, fromTrack, toTrack, do_update):
     """
     Update the to-track from the from-track, by using the latest lastplayed of the two
     tracks, and summing the playcounts.
     Returns the number of updates performed.
     """
-    latestPlay = max(fromTrack['lastplayed'], toTrack['lastplayed'])
-    totalPlays = fromTrack['playcount'] + toTrack['playcount']
-    totalSkips = fromTrack['skipcount'] + toTrack['skipcount']
+    totalPlays, latestPlay, totalSkips = consolidatedPlayDetails(fromTrack, toTrack)
     cleanedURL = convertURL(toTrack['url'])
     appLogger.info(f"Updating URL {cleanedURL} to play count {totalPlays} last played {latestPlay} skip count {totalSkips}")
     updateCount = 0
@@ -78,39 +64,96 @@ def consolidateStrawberryTracks(updateDatabaseCursor, fromTrack, toTrack, do_upd
         appLogger.warning(f"Unplayed or skipped in the from and to tracks, not altering.")
     return updateCount
 
+def hasURLIndex(databaseCursor):
+    """
+    Returns True if the index of the song URLs has been built for this connection.
+    """
+    databaseCursor.execute("SELECT COUNT(1) FROM sqlite_temp_master WHERE name = 'song_urls'")
+    return databaseCursor.fetchone()[0] > 0
+
+def buildURLIndex(databaseCursor):
+    """
+    Builds a trigram full text index of the song URLs in the temp schema, so URL fragments are
+    found without scanning the songs table. The index lasts for the connection. Building it
+    takes about as long as a hundred scans, so it is only worthwhile for many lookups.
+    Returns False if the SQLite library has no FTS5 trigram tokenizer.
+    """
+    if hasURLIndex(databaseCursor):
+        return True
+    try:
+        databaseCursor.execute("CREATE VIRTUAL TABLE temp.song_urls USING fts5(url, tokenize = 'trigram')")
+    except sqlite3.OperationalError as error:
+        appLogger.info(f"Unable to index the song URLs, searching the songs table: {error}")
+        return False
+    databaseCursor.execute("INSERT INTO temp.song_urls (rowid, url) SELECT rowid, url FROM songs")
+    return True
+
+def findCandidates(databaseCursor, trackURL):
+    """
+    Returns a list of (rowid, url) tuples of every song whose URL contains the URL fragment, in
+    rowid order. The index of the song URLs is used, if it has been built.
+    """
+    table = "temp.song_urls" if hasURLIndex(databaseCursor) else "songs"
+    pattern = likePattern(trackURL, '%', '%')
+    # The trigram index is not used by a LIKE with an ESCAPE clause, so it is only added when the
+    # fragment holds a character LIKE treats as a wildcard, such as the % of an encoded URL.
+    escape = " ESCAPE '\\'" if pattern != f"%{trackURL}%" else ""
+    findSongs = f"SELECT rowid, url FROM {table} WHERE url LIKE ?{escape} ORDER BY rowid"
+    appLogger.debug(findSongs)
+    databaseCursor.execute(findSongs, (pattern,))
+    return databaseCursor.fetchall()
+
+def chooseCandidate(trackURL, candidates):
+    """
+    Returns the rowid of the song matching the URL fragment, or None if no song, or more than one
+    song, matches. A song with exactly the URL is chosen over others containing it. Each candidate
+    of an ambiguous fragment is reported.
+    """
+    if len(candidates) == 1:
+        return candidates[0][0]
+    exactMatches = [rowid for rowid, url in candidates if url == trackURL]
+    if len(exactMatches) == 1:
+        return exactMatches[0]
+    if len(candidates) > 1:
+        appLogger.error(f"{trackURL} is ambiguous, matching {len(candidates)} tracks:")
+        for rowid, url in candidates:
+            appLogger.error(f"    {url}")
+    return None
+
 def findTrack(databaseCursor, trackURL):
     """
-    Returns a dictionary containing the track found, or None if no matching track.
+    Returns a dictionary containing the track found, or None if no matching track, or the
+    fragment matches several tracks.
     """
-    findSong = f"SELECT url, artist, title, playcount, lastplayed, skipcount FROM songs WHERE url LIKE '%{trackURL}%'"
+    rowid = chooseCandidate(trackURL, findCandidates(databaseCursor, trackURL))
+    if rowid is None:
+        return None
+    findSong = "SELECT url, artist, title, playcount, lastplayed, skipcount FROM songs WHERE rowid = ?"
     appLogger.debug(findSong)
-    databaseCursor.execute(findSong)
+    databaseCursor.execute(findSong, (rowid,))
     firstRow = databaseCursor.fetchone()
-    if firstRow is not None:
-        track = {
-            'url': firstRow[0],
-            'artist': firstRow[1],
-            'title': firstRow[2],
-            'playcount': firstRow[3],
-            'lastplayed': firstRow[4],
-            'skipcount': firstRow[5]
-            # album TEXT,
-            # albumartist TEXT,
-            # track INTEGER NOT NULL DEFAULT -1,
-            # disc INTEGER NOT NULL DEFAULT -1,
-            # year INTEGER NOT NULL DEFAULT -1,
-            # originalyear INTEGER NOT NULL DEFAULT -1,
-            # genre TEXT,
-            # compilation INTEGER NOT NULL DEFAULT 0,
-            # composer TEXT,
-            # performer TEXT,
-            # grouping TEXT,
-            # comment TEXT,
-            # lyrics TEXT,
-        }
-        return track
-    else:
-        return None
+    track = {
+        'url': firstRow[0],
+        'artist': firstRow[1],
+        'title': firstRow[2],
+        'playcount': firstRow[3],
+        'lastplayed': firstRow[4],
+        'skipcount': firstRow[5]
+        # album TEXT,
+        # albumartist TEXT,
+        # track INTEGER NOT NULL DEFAULT -1,
+        # disc INTEGER NOT NULL DEFAULT -1,
+        # year INTEGER NOT NULL DEFAULT -1,
+        # originalyear INTEGER NOT NULL DEFAULT -1,
+        # genre TEXT,
+        # compilation INTEGER NOT NULL DEFAULT 0,
+        # composer TEXT,
+        # performer TEXT,
+        # grouping TEXT,
+        # comment TEXT,
+        # lyrics TEXT,
+    }
+    return track
 
 def displayTrack(description, track):
     """
@@ -118,44 +161,215 @@ def displayTrack(description, track):
     """
     print(description + ':', track)
 
+def loadSongs(databaseCursor):
+    """
+    Reads all songs in a single scan.
+    Returns a list of dictionaries of each song, in rowid order.
+    """
+    columns = [row[1] for row in databaseCursor.execute("PRAGMA table_info(songs)")]
+    # Not all versions of the songs table record if the file is unavailable.
+    unavailable = 'unavailable' if 'unavailable' in columns else '0'
+    allSongs = f"SELECT rowid, url, artist, title, album, length, playcount, lastplayed, skipcount, {unavailable} FROM songs ORDER BY rowid"
+    appLogger.debug(allSongs)
+    databaseCursor.execute(allSongs)
+    return [{
+        'rowid': row[0],
+        'url': row[1],
+        'artist': row[2],
+        'title': row[3],
+        'album': row[4],
+        'length': row[5],
+        'playcount': row[6],
+        'lastplayed': row[7],
+        'skipcount': row[8],
+        'unavailable': row[9]
+    } for row in databaseCursor.fetchall()]
+
+def readTrackPairs(pairsFile):
+    """
+    Generates the (from, to) URL fragment pairs from a file with a tab separated pair per line.
+    Blank lines and lines starting with # are ignored.
+    """
+    for lineNumber, line in enumerate(pairsFile, start = 1):
+        line = line.rstrip('\n')
+        if len(line.strip()) == 0 or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 2:
+            appLogger.error(f"Line {lineNumber} is not a tab separated pair of from and to tracks: {line}")
+            continue
+        yield fields[0], fields[1]
+
+class SongFinder:
+    """
+    Finds songs by their complete URL, or by a fragment of it, as findTrack does, from the songs
+    read in a single scan.
+    """
+    def __init__(self, databaseCursor, songs):
+        self.databaseCursor = databaseCursor
+        buildURLIndex(databaseCursor)
+        self.songsByURL = {}
+        self.songsByRowid = {}
+        for song in songs:
+            self.songsByURL.setdefault(song['url'], song)
+            self.songsByRowid[song['rowid']] = song
+
+    def find(self, trackURL):
+        """
+        Returns the song with the URL, or else whose URL contains the fragment, or None if no
+        song, or more than one song, matches.
+        """
+        song = self.songsByURL.get(trackURL)
+        if song is not None:
+            runStatistics.count('matched_url')
+            return song
+        rowid = chooseCandidate(trackURL, findCandidates(self.databaseCursor, trackURL))
+        runStatistics.count('matched_url_fragment' if rowid is not None else 'unmatched')
+        return self.songsByRowid.get(rowid)
+
+def consolidatePairs(updateDatabaseCursor, songs, trackPairs, do_update):
+    """
+    Consolidate each pair of from and to tracks, with the same rule as consolidateStrawberryTracks,
+    in a single transaction. Where a track is consolidated several times, the totals accumulate.
+    Returns the number of updates performed.
+    """
+    consolidated = {}
+    with runStatistics.phase('matching'):
+        finder = SongFinder(updateDatabaseCursor, songs)
+        for fromURL, toURL in trackPairs:
+            fromTrack = finder.find(fromURL)
+            toTrack = finder.find(toURL)
+            if fromTrack is None:
+                appLogger.error("No single track found matching %s to update from.", fromURL)
+            elif toTrack is None:
+                appLogger.error("No single track found matching %s to update to.", toURL)
+            elif fromTrack['rowid'] == toTrack['rowid']:
+                appLogger.warning("%s and %s are the same track, not altering.", fromURL, toURL)
+            else:
+                # Accumulate into the updated tracks, so repeated and chained consolidations add together.
+                fromTrack = consolidated.get(fromTrack['rowid'], fromTrack)
+                toTrack = consolidated.get(toTrack['rowid'], toTrack)
+                totalPlays, latestPlay, totalSkips = consolidatedPlayDetails(fromTrack, toTrack)
+                appLogger.info("Updating URL %s from %s to play count %s last played %s skip count %s",
+                               toTrack['url'], fromTrack['url'], totalPlays, latestPlay, totalSkips)
+                if totalPlays > 0 or latestPlay > 0 or totalSkips > 0:
+                    consolidated[toTrack['rowid']] = dict(toTrack, playcount = totalPlays, lastplayed = latestPlay, skipcount = totalSkips)
+                else:
+                    appLogger.warning("Unplayed or skipped in %s and %s, not altering.", fromTrack['url'], toTrack['url'])
+    for track in consolidated.values():
+        print(f"{'Updated' if do_update else 'Would update'} Track: {track['url']} to play count {track['playcount']}, last played {track['lastplayed']}, skip count {track['skipcount']}")
+    if not do_update:
+        return 0
+    updateCounts = "UPDATE songs SET playcount = ?, skipcount = ?, lastplayed = ? WHERE rowid = ?"
+    appLogger.debug(updateCounts)
+    with runStatistics.phase('sql_writes'):
+        updateDatabaseCursor.executemany(updateCounts, [(track['playcount'], track['skipcount'], track['lastplayed'], track['rowid'])
+                                                        for track in consolidated.values()])
+    runStatistics.count('rows_written', updateDatabaseCursor.rowcount)
+    return updateDatabaseCursor.rowcount
+
+def normalisedField(field):
+    """
+    Returns the field case folded, with punctuation and spacing removed, for comparison.
+    """
+    return ''.join(character for character in (field or '').casefold() if character.isalnum())
+
+def detectDuplicates(songs):
+    """
+    Group the songs by their normalised artist, title, album and duration in seconds.
+    Returns a list of (from tracks, to track) tuples of each group of more than one song. The
+    to-track is the first available song of the group, or the most recently added.
+    """
+    groups = {}
+    for song in songs:
+        key = (normalisedField(song['artist']), normalisedField(song['title']),
+               normalisedField(song['album']), round((song['length'] or 0) / 1e9))
+        groups.setdefault(key, []).append(song)
+    duplicates = []
+    for group in groups.values():
+        if len(group) > 1:
+            available = [song for song in group if not song['unavailable']]
+            toTrack = available[0] if len(available) > 0 else group[-1]
+            duplicates.append(([song for song in group if song is not toTrack], toTrack))
+    return duplicates
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'Alters a Strawberry music player database, merging the play and skip counts, and last played date and time, from one track to another.')
     parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
     parser.add_argument('-u', '--update-db', action = 'store', help = 'Path to the Strawberry database file to update.', type = str, default = 'strawberry.db')
     parser.add_argument('-w', '--write-updates', action = 'store_true', help = 'Write the update to the database, if not enabled, will simply show a dry run.', default = False)
-    parser.add_argument('from_track', action = 'store', type = str, help = 'URL fragment of track to update from.')
-    parser.add_argument('to_track', action = 'store', type = str, help = 'URL fragment of track to update.')
+    parser.add_argument('-b', '--batch', action = 'store', type = argparse.FileType('r'), help = 'File of tab separated pairs of URL fragments of tracks to update from and to, one pair per line.')
+    parser.add_argument('-a', '--detect-duplicates', action = 'store_true', help = 'Consolidate songs with the same artist, title, album and duration. Without -w, lists them as pairs which can be edited and used with --batch.')
+    parser.add_argument('from_track', action = 'store', type = str, nargs = '?', help = 'URL fragment of track to update from.')
+    parser.add_argument('to_track', action = 'store', type = str, nargs = '?', help = 'URL fragment of track to update.')
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended.')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of tracks found, as JSON to the file, or standard output.')
     
     args = parser.parse_args()
+    if args.batch is None and not args.detect_duplicates and (args.from_track is None or args.to_track is None):
+        parser.error('The from and to tracks are required, unless using --batch or --detect-duplicates')
 
-    # We set the logging value here so it's available to the core and master nodes.
-    appLogger = logging.getLogger("consolidateTracks")
     logging.basicConfig()
 
     if args.verbose > 1:
         appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
     elif args.verbose > 0:
         appLogger.setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
 
-    updateSQLClient = sqlite3.connect(args.update_db)
-    updateCursor = updateSQLClient.cursor()
+    if args.stats is not None:
+        runStatistics.enable()
 
-    toTrack = findTrack(updateCursor, args.to_track)
-    if toTrack is None:
-        appLogger.error(f"No track found matching {args.from_track} to update to.")
-    else:
-        displayTrack('Update', toTrack)
-    fromTrack = findTrack(updateCursor, args.from_track)
-    if fromTrack is None:
-        appLogger.error(f"No track found matching {args.from_track} to update from.")
-    else:
-        displayTrack('From', fromTrack)
+    with databaseToUpdate(args.update_db, args.live) as databasePath:
+        updateSQLClient = sqlite3.connect(databasePath)
+        updateCursor = updateSQLClient.cursor()
+
+        if args.batch is not None or args.detect_duplicates:
+            with runStatistics.phase('matching'):
+                songs = loadSongs(updateCursor)
+                duplicates = detectDuplicates(songs) if args.detect_duplicates else []
+            if args.detect_duplicates:
+                trackPairs = []
+                for fromTracks, toTrack in duplicates:
+                    for fromTrack in fromTracks:
+                        if not args.write_updates:
+                            print(f"{fromTrack['url']}\t{toTrack['url']}")
+                        trackPairs.append((fromTrack['url'], toTrack['url']))
+            else:
+                trackPairs = readTrackPairs(args.batch)
+            if args.batch is not None or args.write_updates:
+                updateCount = consolidatePairs(updateCursor, songs, trackPairs, args.write_updates)
+                appLogger.info(f"Updated {updateCount} tracks")
+                if updateCount > 0 and args.write_updates:
+                    # Save (commit) the changes.
+                    with runStatistics.phase('commit'):
+                        updateSQLClient.commit()
+        else:
+            # Two lookups scan the songs table faster than building the index of the song URLs,
+            # which only pays for itself over many lookups, so the index is not built for them.
+            with runStatistics.phase('matching'):
+                toTrack = findTrack(updateCursor, args.to_track)
+            if toTrack is None:
+                appLogger.error(f"No single track found matching {args.to_track} to update to.")
+            else:
+                displayTrack('Update', toTrack)
+            with runStatistics.phase('matching'):
+                fromTrack = findTrack(updateCursor, args.from_track)
+            if fromTrack is None:
+                appLogger.error(f"No single track found matching {args.from_track} to update from.")
+            else:
+                displayTrack('From', fromTrack)
 
-    if toTrack is not None and fromTrack is not None:
-        updateCount = consolidateStrawberryTracks(updateCursor, fromTrack, toTrack, args.write_updates)
-        appLogger.info(f"Updated {updateCount} tracks")
-        if updateCount > 0 and args.write_updates:
-            # Save (commit) the changes.
-            updateSQLClient.commit()
+            if toTrack is not None and fromTrack is not None:
+                updateCount = consolidateStrawberryTracks(updateCursor, fromTrack, toTrack, args.write_updates)
+                appLogger.info(f"Updated {updateCount} tracks")
+                if updateCount > 0 and args.write_updates:
+                    # Save (commit) the changes.
+                    with runStatistics.phase('commit'):
+                        updateSQLClient.commit()
 
-    updateSQLClient.close()
+        updateSQLClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
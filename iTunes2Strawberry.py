@@ -4,14 +4,20 @@ Converts an iTunes exported library XML file, updating the Strawberry music play
 database, with the play and skip counts, and the last played date and time.
 """
 
-import plistlib
 import logging
 import argparse
 import sqlite3
-import re
+import itertools
 from datetime import datetime, timezone
-from urllib.parse import quote, unquote, urlparse, urlunparse
-import unicodedata
+from strawberryDatabase import executeUpdate
+from pipeline import Pipeline, MATCHER_COUNT
+from librarySnapshot import openLibrary
+from libraryIndex import openIndexedLibrary
+from liveDatabase import databaseToUpdate
+from urlRewriting import URLRewriter
+from runStatistics import runStatistics
+
+appLogger = logging.getLogger("iTunes2Strawberry")
 
 def dumpAllPlayed(cursor):
     findPlayed = "SELECT title,artist,url,playcount,lastplayed,skipcount FROM songs WHERE playcount <> 0"
@@ -20,181 +26,423 @@ def dumpAllPlayed(cursor):
     for row in cursor.fetchall():
         print(row[0], row[1], row[2], row[3], datetime.fromtimestamp(row[4]), row[5])
 
-def convertURL(iTunesURL):
-    """
-    Converts the iTunes URLs to a URL that can be found in the Strawberry database.
-    """
-    # Convert XML encoding of ampersands in the URL.
-    iTunesURL = iTunesURL.replace('&#38;', '&')
-    # iTunes encodes URLs, using UTF-8 encoding, but using a character and the combining diacritic,
-    # instead of the noramlized, singular combined character including the diacritic, that Strawberry uses.
-    # For example, iTunes: "n%CC%83", Strawberry: "%C3%B1"
-    # So we need to decode the URL encoding, normalize the characters to the Normal Form
-    # Composed form, then decode the unicode encoding into UTF-8, then reencode the URL.
-    parsedURL = urlparse(iTunesURL) # parse the URL to ensure the URL separators don't get encoded.
-    decodedPath = unquote(parsedURL.path)
-    normalizedUnicodePath = unicodedata.normalize('NFC', decodedPath)
-    # While Strawberry encodes the URL, it leaves a lot of characters unquoted.
-    encodedURL = urlunparse((parsedURL.scheme,
-                             parsedURL.netloc,
-                             quote(normalizedUnicodePath, safe = "/&'(),[];!+=@"),
-                             parsedURL.params,
-                             parsedURL.query,
-                             parsedURL.fragment))
-    return encodedURL
-
 def SQLEncodeURL(url):
     """
     Escape quote characters in URL for SQL use.
     """
     return url.replace("'", "''")
 
-def imputeTrackFields(track):
+def logTrack(level, message, track, trackNumber = None):
     """
-    Clean up the track parameters if there are missing fields.
+    Log the message followed by the iTunes fields of the Track record.
     """
-    if 'Skip Count' not in track:
-        track['Skip Count'] = 0
-    if 'Skip Date' not in track:
-        track['Skip Date'] = 0 # TODO Not right.
-    if 'Artist' not in track:
-        track['Artist'] = 'Unknown'
-    if 'Name' not in track:
-        track['Name'] = 'Untitled'
-    if 'Play Count' not in track:
-        track['Play Count'] = 0
-    if 'Play Date UTC' not in track:
-        track['Play Date UTC'] = datetime.utcnow()
-    return track
+    if appLogger.isEnabledFor(level):
+        if trackNumber is not None:
+            message = f"{message} # {trackNumber}"
+        appLogger.log(level, "%s: %s, %s, %s, %s, %s, %s, %s", message, track.name, track.artist, track.playCount, track.playDate,
+                      track.skipCount, track.skipDate, track.location)
 
 def updatePlayDetails(strawberryDatabaseCursor, track, cleanedURL, alternateURL):
-    # convert the Play Date UTC value into the integer used by Strawberry:
-    newLastPlayed = int(track['Play Date UTC'].timestamp())
     # Set the track with the unassigned play count, last played date, and skip counts to the iTunes values:
-    updateCounts = "UPDATE songs SET playcount = {Play Count}, skipcount = {Skip Count}, lastplayed = {newLastPlayed} WHERE (url = '{cleanedURL}' OR url = '{alternateURL}') AND playcount = 0".format(newLastPlayed = newLastPlayed, cleanedURL = SQLEncodeURL(cleanedURL), alternateURL = SQLEncodeURL(alternateURL), **track)
+    updateCounts = f"UPDATE songs SET playcount = {track.playCount}, skipcount = {track.skipCount}, lastplayed = {track.lastPlayed} WHERE (url = '{SQLEncodeURL(cleanedURL)}' OR url = '{SQLEncodeURL(alternateURL)}') AND playcount = 0"
     appLogger.debug(updateCounts)
-    strawberryDatabaseCursor.execute(updateCounts)
     # Determine if the field was updated.
-    strawberryDatabaseCursor.execute('SELECT changes() FROM songs')
-    result = strawberryDatabaseCursor.fetchone()
-    if result[0] == 0:
-        appLogger.warning(f"Unable to update {cleanedURL}")
+    if executeUpdate(strawberryDatabaseCursor, updateCounts) == 0:
+        appLogger.warning("Unable to update %s", cleanedURL)
         return False
     else:
-        appLogger.info("Updated Track: {Name}, {Artist}, {Play Count}, {Play Date UTC}, {Skip Count}, {Skip Date}, {Location}".format(**track))
+        logTrack(logging.INFO, "Updated Track", track)
         return True
     
-def processUnplayedStrawberyFiles(iTunesTree, strawberryDatabaseCursor, replaceURL,
-                                  replaceWith, findClause = ''):
+def buildTrackIndex(iTunesLibrary, urlRewriter):
+    """
+    Index the iTunes tracks by their converted URL, their alternate URL and their (artist, title),
+    so each Strawberry row can be matched with a single lookup.
+    Returns a tuple of the URL index and the artist/title index. Where several tracks share a key,
+    the first in the library is indexed, matching the order of an exhaustive search.
+    """
+    urlIndex = {}
+    artistTitleIndex = {}
+    # For some crazy reason we can have entries in the iTunes Library without file URLs?
+    locatedTracks = [track for track in runStatistics.timed('xml_parse', iTunesLibrary.trackRecords()) if track.location is not None]
+    with runStatistics.phase('url_conversion'):
+        cleanedURLs = iTunesLibrary.convertURLs([track.location for track in locatedTracks])
+        # Generate the alternative version of the URLs, rewritten by the URL replacement rules.
+        alternateURLs = [urlRewriter.rewrite(cleanedURL) for cleanedURL in cleanedURLs]
+    with runStatistics.phase('matching'):
+        for track, cleanedURL, alternateURL in zip(locatedTracks, cleanedURLs, alternateURLs):
+            entry = (track, cleanedURL, alternateURL)
+            urlIndex.setdefault(cleanedURL, entry)
+            urlIndex.setdefault(alternateURL, entry)
+            artistTitleIndex.setdefault((track.artist, track.name), entry)
+    return urlIndex, artistTitleIndex
+
+def processUnplayedStrawberyFiles(iTunesLibrary, strawberryDatabaseCursor, urlRewriter, findClause = '', findParameters = ()):
     """
-    Only update files in the strawberry database which have play counts of zero.
+    Only update files in the strawberry database which have play counts of zero, and match the
+    findClause, if given, with its findParameters.
     Returns the number of updates performed.
     """
-    appLogger.debug(iTunesTree.keys())
-    appLogger.info("Searching for unplayed tracks in database in iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesTree))
-    URLreplace = re.compile(replaceURL)
+    appLogger.debug(iTunesLibrary.header.keys())
+    appLogger.info("Searching for unplayed tracks in database in iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesLibrary.header))
+    urlIndex, artistTitleIndex = buildTrackIndex(iTunesLibrary, urlRewriter)
     allUnplayedSongs = "SELECT url, artist, title, playcount, skipcount, lastplayed FROM songs WHERE playcount = 0"
     if findClause is not None and len(findClause) > 0:
         allUnplayedSongs += ' AND ' + findClause
     appLogger.debug(allUnplayedSongs)
     updateCount = 0
-    strawberryDatabaseCursor.execute(allUnplayedSongs)
-    for row in strawberryDatabaseCursor.fetchall():
-        appLogger.debug(row[0])
-        found = False
-        # Now we need to iterate through the tree, which is unsorted, so exhaustively searching it.
-        # TODO Perhaps sort?
-        for trackCount, (trackNumber, track) in enumerate(iTunesTree['Tracks'].items()):
-            # For some crazy reason we can have entries in the iTunes Library without file URLs?
-            if 'Location' not in track:
-                continue
-            cleanedURL = convertURL(track['Location'])
-            # Generate the alternative version of the URL, with the specified replacements prefix.
-            alternateURL = URLreplace.sub(replaceWith, cleanedURL, count = 1)
-            # Find the track in iTunes
-            track = imputeTrackFields(track)
-            if row[0] == cleanedURL or row[0] == alternateURL:
-                found = True
-                appLogger.debug(f"Matched URL {cleanedURL}, {alternateURL}")
-                if track['Play Count'] > 0:
+    with runStatistics.phase('matching'):
+        strawberryDatabaseCursor.execute(allUnplayedSongs, findParameters)
+        for row in strawberryDatabaseCursor.fetchall():
+            appLogger.debug("%s", row[0])
+            # URL matches take precedence, the artist and title is the fallback.
+            if row[0] in urlIndex:
+                track, cleanedURL, alternateURL = urlIndex[row[0]]
+                appLogger.debug("Matched URL %s, %s", cleanedURL, alternateURL)
+                runStatistics.count('matched_url' if row[0] == cleanedURL else 'matched_alternate_url')
+                if track.playCount > 0:
                     if updatePlayDetails(strawberryDatabaseCursor, track, cleanedURL, alternateURL):
                         updateCount += 1
                 else:
-                    appLogger.warning(f"Unplayed in iTunes database, not altering play count: {row[0]}")
-                break
-            elif row[1] == track['Artist'] and row[2] == track['Name']:
-                found = True
-                appLogger.debug("Perhaps this track # {trackNumber}: {Name}, {Artist}, {Play Count}, {Play Date UTC}, {Skip Count}, {Skip Date}, {Location}".format(trackNumber = trackNumber, **track))
-                appLogger.debug(f"In database {row[0]}")
+                    appLogger.warning("Unplayed in iTunes database, not altering play count: %s", row[0])
+            elif (row[1], row[2]) in artistTitleIndex:
+                track, cleanedURL, alternateURL = artistTitleIndex[(row[1], row[2])]
+                runStatistics.count('matched_artist_title')
+                logTrack(logging.DEBUG, "Perhaps this track", track, track.trackId)
+                appLogger.debug("In database %s", row[0])
                 if updatePlayDetails(strawberryDatabaseCursor, track, row[0], ''):
                     updateCount += 1
-                break
-        if not found:
-            appLogger.warning(f"Unable to find {row[0]}")
+            else:
+                runStatistics.count('unmatched')
+                appLogger.warning("Unable to find %s", row[0])
     return updateCount
 
-def processAlliTunesFiles(iTunesTree, strawberryDatabaseCursor,
-                          findClause, updateExisting, replaceURL, replaceWith):
+def processAlliTunesFiles(iTunesLibrary, strawberryDatabaseCursor,
+                          findClause, updateExisting, urlRewriter, findParameters = ()):
     """
-    Iterate through all tracks in the iTunes library tree structure.
+    Iterate through all tracks in the iTunes library, as they are read.
 
-    :param findClause: A dictionary of keys and regexps to match on.
+    :param findClause: The SQL condition the songs updated must meet, such as being of an album.
     :param updateExisting:
-    :param replaceURL: 
-    :param replaceWith:
+    :param urlRewriter: The URLRewriter of the URL replacement rules.
+    :param findParameters: The parameters of the findClause.
+    :return: The number of tracks whose songs were updated.
     """
-    appLogger.debug(iTunesTree.keys())
-    appLogger.info("Reading {trackCount} tracks from iTunes library file v{Major Version}.{Minor Version} created {Date}".format(trackCount = len(iTunesTree['Tracks']), **iTunesTree))
-    URLreplace = re.compile(replaceURL)
+    appLogger.debug(iTunesLibrary.header.keys())
+    appLogger.info("Reading tracks from iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesLibrary.header))
+    matchingSongs = ''
+    if findClause is not None and len(findClause) > 0:
+        matchingSongs = f" AND ({findClause})"
 
     updateCount = 0
-    for trackCount, (trackNumber, track) in enumerate(iTunesTree['Tracks'].items()):
+    trackCount = 0
+    for trackCount, track in enumerate(runStatistics.timed('xml_parse', iTunesLibrary.trackRecords()), start = 1):
         # For some crazy reason we can have entries in the iTunes Library without file URLs?
-        if 'Location' not in track:
-            appLogger.warning(f"No Location field, skipping {track}")
+        if track.location is None:
+            appLogger.warning("No Location field, skipping %s", track)
             continue
-        track = imputeTrackFields(track)
-        # convert the Play Date UTC value into the integer used by Strawberry:
-        newLastPlayed = int(track['Play Date UTC'].timestamp())
-        appLogger.debug("New last played timestamp {}".format(newLastPlayed))
-
-        try:
-            appLogger.debug("Track # {trackNumber}: {Name}, {Artist}, {Play Count}, {Play Date UTC}, {Skip Count}, {Skip Date}, {Location}".format(trackNumber = trackNumber, **track))
-        except Exception as e:
-            appLogger.error("Missing {} in {}".format(e, track))
-
-        cleanedURL = convertURL(track['Location'])
-        # Generate the alternative version of the URL, with the specified replacements prefix.
-        alternateURL = URLreplace.sub(replaceWith, cleanedURL, count = 1)
+        appLogger.debug("New last played timestamp %s", track.lastPlayed)
+        logTrack(logging.DEBUG, "Track", track, track.trackId)
+
+        with runStatistics.phase('url_conversion'):
+            cleanedURL = iTunesLibrary.convertURL(track.location)
+            # Generate the alternative version of the URL, rewritten by the URL replacement rules.
+            alternateURL = urlRewriter.rewrite(cleanedURL)
         didUpdate = False
         if updateExisting:
             # If there are tracks already in the SQLite DB, just update the play count
             # adding the count from iTunes, but leave the last played date unchanged.
-            updateCounts = "UPDATE songs SET playcount = playcount + {Play Count}, skipcount = skipcount + {Skip Count} WHERE (url = '{cleanedURL}' OR url = '{alternateURL}') AND playcount <> 0".format(cleanedURL = SQLEncodeURL(cleanedURL), alternateURL = SQLEncodeURL(alternateURL), **track)
+            updateCounts = f"UPDATE songs SET playcount = playcount + {track.playCount}, skipcount = skipcount + {track.skipCount} WHERE (url = '{SQLEncodeURL(cleanedURL)}' OR url = '{SQLEncodeURL(alternateURL)}') AND playcount <> 0{matchingSongs}"
             appLogger.debug(updateCounts)
-            strawberryDatabaseCursor.execute(updateCounts)
             # Determine if the field was updated.
-            strawberryDatabaseCursor.execute('SELECT changes() FROM songs')
-            result = strawberryDatabaseCursor.fetchone()
-            didUpdate = result[0] > 0
+            didUpdate = executeUpdate(strawberryDatabaseCursor, updateCounts, findParameters) > 0
+        if didUpdate:
             updateCount += 1
-        if not didUpdate:
-            # TODO updatePlayDetails(strawberryDatabaseCursor, track)
+        else:
             # Set all tracks with unassigned play counts, last played date, and skip counts to the iTunes values:
-            updateCounts = "UPDATE songs SET playcount = {Play Count}, skipcount = {Skip Count}, lastplayed = {newLastPlayed} WHERE (url = '{cleanedURL}' OR url = '{alternateURL}') AND playcount = 0".format(newLastPlayed = newLastPlayed, cleanedURL = SQLEncodeURL(cleanedURL), alternateURL = SQLEncodeURL(alternateURL), **track)
-            # updateCounts = "SELECT playcount, skipcount, lastplayed FROM songs WHERE (url = '{Location}' OR url = '{alternateURL}') AND lastplayed = -1".format(newLastPlayed = newLastPlayed, alternateURL = alternateURL, **track)
+            updateCounts = f"UPDATE songs SET playcount = {track.playCount}, skipcount = {track.skipCount}, lastplayed = {track.lastPlayed} WHERE (url = '{SQLEncodeURL(cleanedURL)}' OR url = '{SQLEncodeURL(alternateURL)}') AND playcount = 0{matchingSongs}"
             appLogger.debug(updateCounts)
-            strawberryDatabaseCursor.execute(updateCounts)
             # Determine if the field was updated.
-            strawberryDatabaseCursor.execute('SELECT changes() FROM songs')
-            result = strawberryDatabaseCursor.fetchone()
-            if result[0] == 0:
-                appLogger.debug(f"Unable to update {cleanedURL}")
+            if executeUpdate(strawberryDatabaseCursor, updateCounts, findParameters) == 0:
+                # Played songs, or those not in the database.
+                runStatistics.count('unmatched')
+                appLogger.debug("Unable to update %s", cleanedURL)
             else:
-                appLogger.info("Updated Track # {trackNumber}: {Name}, {Artist}, {Play Count}, {Play Date UTC}, {Skip Count}, {Skip Date}, {Location}".format(trackNumber = trackNumber, **track))
+                updateCount += 1
+                logTrack(logging.INFO, "Updated Track", track, track.trackId)
+    appLogger.info(f"Read {trackCount} tracks")
     return updateCount
-    
-    
+
+def pipelineAlliTunesFiles(iTunesLibrary, strawberryDatabasePath, findClause, updateExisting, urlRewriter,
+                           matcherCount = MATCHER_COUNT, findParameters = ()):
+    """
+    The pipelined equivalent of processAlliTunesFiles. The tracks are read and their URLs
+    converted on this thread, while matcher threads look up the songs with either URL, and a
+    writer thread updates those songs by rowid, committing the updates in batches.
+    Only songs matching the findClause, if given, with its findParameters, are updated.
+    Returns the number of tracks whose songs were updated.
+    """
+    appLogger.debug(iTunesLibrary.header.keys())
+    appLogger.info("Reading tracks from iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesLibrary.header))
+    findSongs = "SELECT rowid FROM songs WHERE (url = ? OR url = ?)"
+    if findClause is not None and len(findClause) > 0:
+        findSongs += ' AND ' + findClause
+    appLogger.debug(findSongs)
+    # The index of the update setting the counts of unplayed songs.
+    setIndex = 1 if updateExisting else 0
+
+    def matchTrack(readCursor, entry):
+        track, cleanedURL, alternateURL = entry
+        readCursor.execute(findSongs, (cleanedURL, alternateURL) + tuple(findParameters))
+        songIds = tuple(row[0] for row in readCursor.fetchall())
+        if len(songIds) == 0:
+            return None, []
+        songs = ', '.join('?' * len(songIds))
+        updates = []
+        if updateExisting:
+            # If there are tracks already in the SQLite DB, just update the play count
+            # adding the count from iTunes, but leave the last played date unchanged.
+            updates.append((f"UPDATE songs SET playcount = playcount + ?, skipcount = skipcount + ? WHERE rowid IN ({songs}) AND playcount <> 0",
+                            (track.playCount, track.skipCount) + songIds))
+        # Set all tracks with unassigned play counts, last played date, and skip counts to the iTunes values:
+        updates.append((f"UPDATE songs SET playcount = ?, skipcount = ?, lastplayed = ? WHERE rowid IN ({songs}) AND playcount = 0",
+                        (track.playCount, track.skipCount, track.lastPlayed) + songIds))
+        return songIds, updates
+
+    updateCount = 0
+    def trackWritten(entry, songIds, updateIndex):
+        nonlocal updateCount
+        track, cleanedURL, alternateURL = entry
+        if updateIndex is None:
+            # Played songs, or those not in the database.
+            runStatistics.count('unmatched')
+            appLogger.debug("Unable to update %s", cleanedURL)
+            return
+        updateCount += 1
+        if updateIndex == setIndex:
+            logTrack(logging.INFO, "Updated Track", track, track.trackId)
+
+    trackCount = 0
+    with Pipeline(strawberryDatabasePath, matchTrack, trackWritten, matcherCount = matcherCount) as trackPipeline:
+        for trackCount, track in enumerate(runStatistics.timed('xml_parse', iTunesLibrary.trackRecords()), start = 1):
+            # For some crazy reason we can have entries in the iTunes Library without file URLs?
+            if track.location is None:
+                appLogger.warning("No Location field, skipping %s", track)
+                continue
+            logTrack(logging.DEBUG, "Track", track, track.trackId)
+            with runStatistics.phase('url_conversion'):
+                cleanedURL = iTunesLibrary.convertURL(track.location)
+                # Generate the alternative version of the URL, rewritten by the URL replacement rules.
+                alternateURL = urlRewriter.rewrite(cleanedURL)
+            trackPipeline.put((track, cleanedURL, alternateURL))
+    appLogger.info(f"Read {trackCount} tracks")
+    return updateCount
+
+def stageiTunesTracks(iTunesLibrary, strawberryDatabaseCursor, urlRewriter):
+    """
+    Load the converted iTunes tracks into the TEMP itunes_tracks table, so they can be matched
+    against the songs table with set-based statements.
+    Returns the number of tracks staged.
+    """
+    strawberryDatabaseCursor.execute("DROP TABLE IF EXISTS temp.itunes_tracks")
+    strawberryDatabaseCursor.execute("""CREATE TEMP TABLE itunes_tracks (
+        track_number TEXT, track_url TEXT, track_alternate_url TEXT, track_artist TEXT, track_title TEXT,
+        track_location TEXT, track_play_count INTEGER, track_skip_count INTEGER, track_last_played INTEGER)""")
+
+    def stagedTracks():
+        for track in runStatistics.timed('xml_parse', iTunesLibrary.trackRecords()):
+            # For some crazy reason we can have entries in the iTunes Library without file URLs?
+            if track.location is None:
+                appLogger.warning("No Location field, skipping %s", track)
+                continue
+            with runStatistics.phase('url_conversion'):
+                cleanedURL = iTunesLibrary.convertURL(track.location)
+                # Generate the alternative version of the URL, rewritten by the URL replacement rules.
+                alternateURL = urlRewriter.rewrite(cleanedURL)
+            yield (track.trackId, cleanedURL, alternateURL, track.artist, track.name, track.location,
+                   track.playCount, track.skipCount, track.lastPlayed)
+
+    with runStatistics.phase('staging'):
+        strawberryDatabaseCursor.executemany("INSERT INTO itunes_tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", stagedTracks())
+        stagedCount = strawberryDatabaseCursor.rowcount
+        strawberryDatabaseCursor.execute("CREATE INDEX temp.itunes_tracks_url ON itunes_tracks (track_url)")
+        strawberryDatabaseCursor.execute("CREATE INDEX temp.itunes_tracks_alternate_url ON itunes_tracks (track_alternate_url)")
+        strawberryDatabaseCursor.execute("CREATE INDEX temp.itunes_tracks_artist_title ON itunes_tracks (track_artist, track_title)")
+    strawberryDatabaseCursor.execute("DROP TABLE IF EXISTS temp.itunes_matches")
+    strawberryDatabaseCursor.execute("CREATE TEMP TABLE itunes_matches (track_row INTEGER, song_id INTEGER, method TEXT)")
+    strawberryDatabaseCursor.execute("CREATE INDEX temp.itunes_matches_track_row ON itunes_matches (track_row)")
+    return stagedCount
+
+def countStagedMatches(strawberryDatabaseCursor):
+    """
+    Add the number of songs matched by the URL, the alternate URL, and the artist and title of
+    the staged iTunes tracks to the run statistics.
+    """
+    countMatches = """SELECT method = 'artist and title', songs.url = itunes_tracks.track_url, COUNT(1)
+        FROM itunes_matches JOIN itunes_tracks ON (itunes_tracks.rowid = itunes_matches.track_row)
+        JOIN songs ON (songs.rowid = itunes_matches.song_id) GROUP BY 1, 2"""
+    appLogger.debug(countMatches)
+    strawberryDatabaseCursor.execute(countMatches)
+    for byArtistTitle, byURL, matchCount in strawberryDatabaseCursor.fetchall():
+        runStatistics.count('matched_artist_title' if byArtistTitle else 'matched_url' if byURL else 'matched_alternate_url', matchCount)
+
+def reportStagedMatches(strawberryDatabaseCursor):
+    """
+    Log the outcome for each staged iTunes track, from the matches recorded in the staging tables.
+    """
+    if not appLogger.isEnabledFor(logging.INFO):
+        return
+    reportMatches = """SELECT track_number, track_title, track_artist, track_play_count, track_last_played, track_skip_count, track_location, track_url, method
+        FROM itunes_tracks LEFT JOIN itunes_matches ON (itunes_matches.track_row = itunes_tracks.rowid)
+        ORDER BY itunes_tracks.rowid"""
+    appLogger.debug(reportMatches)
+    strawberryDatabaseCursor.execute(reportMatches)
+    for trackNumber, name, artist, playCount, lastPlayed, skipCount, location, cleanedURL, method in strawberryDatabaseCursor:
+        if method is None:
+            appLogger.debug("Unable to update %s", cleanedURL)
+        else:
+            appLogger.info("Updated Track # %s by %s: %s, %s, %s, %s, %s, %s", trackNumber, method, name, artist, playCount, datetime.fromtimestamp(lastPlayed), skipCount, location)
+
+def bulkUpdateUnplayed(iTunesLibrary, strawberryDatabaseCursor, urlRewriter, findClause = '', findParameters = ()):
+    """
+    The set-based equivalent of processUnplayedStrawberyFiles. Stages all iTunes tracks, then
+    updates the songs with play counts of zero using joined UPDATE statements.
+    A song matches the first iTunes track with the same converted or alternate URL, or failing
+    that, the first iTunes track with the same artist and title.
+    Returns the number of updates performed.
+    """
+    appLogger.info("Staging iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesLibrary.header))
+    stagedCount = stageiTunesTracks(iTunesLibrary, strawberryDatabaseCursor, urlRewriter)
+    appLogger.info(f"Staged {stagedCount} tracks")
+    unplayedSongs = "songs.playcount = 0"
+    if findClause is not None and len(findClause) > 0:
+        unplayedSongs += ' AND ' + findClause
+
+    matchByURL = f"""INSERT INTO itunes_matches (track_row, song_id, method)
+        SELECT MIN(itunes_tracks.rowid), songs.rowid, 'URL' FROM songs JOIN itunes_tracks
+        ON (songs.url = itunes_tracks.track_url OR songs.url = itunes_tracks.track_alternate_url)
+        WHERE {unplayedSongs} GROUP BY songs.rowid"""
+    matchByArtistTitle = f"""INSERT INTO itunes_matches (track_row, song_id, method)
+        SELECT MIN(itunes_tracks.rowid), songs.rowid, 'artist and title' FROM songs JOIN itunes_tracks
+        ON (songs.artist = itunes_tracks.track_artist AND songs.title = itunes_tracks.track_title)
+        WHERE {unplayedSongs} AND songs.rowid NOT IN (SELECT song_id FROM itunes_matches) GROUP BY songs.rowid"""
+    with runStatistics.phase('matching'):
+        appLogger.debug(matchByURL)
+        strawberryDatabaseCursor.execute(matchByURL, findParameters)
+        appLogger.debug(matchByArtistTitle)
+        strawberryDatabaseCursor.execute(matchByArtistTitle, findParameters)
+    if runStatistics.enabled:
+        countStagedMatches(strawberryDatabaseCursor)
+
+    strawberryDatabaseCursor.execute(f"""SELECT url FROM songs WHERE {unplayedSongs}
+        AND rowid NOT IN (SELECT song_id FROM itunes_matches)""", findParameters)
+    for row in strawberryDatabaseCursor.fetchall():
+        runStatistics.count('unmatched')
+        appLogger.warning("Unable to find %s", row[0])
+
+    # Matching URLs are only updated if they have been played in iTunes.
+    strawberryDatabaseCursor.execute("""SELECT url FROM itunes_matches JOIN itunes_tracks ON (itunes_tracks.rowid = itunes_matches.track_row)
+        JOIN songs ON (songs.rowid = itunes_matches.song_id) WHERE method = 'URL' AND track_play_count = 0""")
+    for row in strawberryDatabaseCursor.fetchall():
+        appLogger.warning("Unplayed in iTunes database, not altering play count: %s", row[0])
+    strawberryDatabaseCursor.execute("""DELETE FROM itunes_matches WHERE method = 'URL'
+        AND track_row IN (SELECT rowid FROM itunes_tracks WHERE track_play_count = 0)""")
+
+    updateCounts = """UPDATE songs SET playcount = track_play_count, skipcount = track_skip_count, lastplayed = track_last_played
+        FROM itunes_matches JOIN itunes_tracks ON (itunes_tracks.rowid = itunes_matches.track_row)
+        WHERE songs.rowid = itunes_matches.song_id AND songs.playcount = 0"""
+    appLogger.debug(updateCounts)
+    updateCount = executeUpdate(strawberryDatabaseCursor, updateCounts)
+
+    reportStagedMatches(strawberryDatabaseCursor)
+    return updateCount
+
+def bulkUpdateAlliTunesFiles(iTunesLibrary, strawberryDatabaseCursor, findClause, updateExisting, urlRewriter, findParameters = ()):
+    """
+    The set-based equivalent of processAlliTunesFiles. Stages all iTunes tracks, then updates
+    the songs with joined UPDATE statements.
+    If updateExisting, songs which have already been played have the iTunes play and skip counts
+    added to them. Songs which have not been played are set to the iTunes values of the first
+    iTunes track matching them, unless that track has already been added to a played song.
+    Returns the number of updates performed.
+    """
+    appLogger.info("Staging iTunes library file v{Major Version}.{Minor Version} created {Date}".format(**iTunesLibrary.header))
+    stagedCount = stageiTunesTracks(iTunesLibrary, strawberryDatabaseCursor, urlRewriter)
+    appLogger.info(f"Staged {stagedCount} tracks")
+    matchingSongs = "TRUE"
+    if findClause is not None and len(findClause) > 0:
+        matchingSongs = findClause
+
+    # Record the matches against the play counts before any are updated.
+    matchByURL = f"""INSERT INTO itunes_matches (track_row, song_id, method)
+        SELECT itunes_tracks.rowid, songs.rowid, iif(songs.playcount <> 0, 'adding to existing', 'URL') FROM songs JOIN itunes_tracks
+        ON (songs.url = itunes_tracks.track_url OR songs.url = itunes_tracks.track_alternate_url)
+        WHERE {matchingSongs}"""
+    appLogger.debug(matchByURL)
+    with runStatistics.phase('matching'):
+        strawberryDatabaseCursor.execute(matchByURL, findParameters)
+    if runStatistics.enabled:
+        countStagedMatches(strawberryDatabaseCursor)
+        strawberryDatabaseCursor.execute("SELECT COUNT(1) FROM itunes_tracks WHERE rowid NOT IN (SELECT track_row FROM itunes_matches)")
+        runStatistics.count('unmatched', strawberryDatabaseCursor.fetchone()[0])
+
+    updateCount = 0
+    if updateExisting:
+        # Add the counts from iTunes, but leave the last played date unchanged.
+        addCounts = """UPDATE songs SET playcount = songs.playcount + totals.playCount, skipcount = songs.skipcount + totals.skipCount
+            FROM (SELECT song_id, SUM(track_play_count) AS playCount, SUM(track_skip_count) AS skipCount
+                  FROM itunes_matches JOIN itunes_tracks ON (itunes_tracks.rowid = itunes_matches.track_row)
+                  WHERE method = 'adding to existing' GROUP BY song_id) AS totals
+            WHERE songs.rowid = totals.song_id"""
+        appLogger.debug(addCounts)
+        updateCount += executeUpdate(strawberryDatabaseCursor, addCounts)
+        # Those tracks added to played songs are not also used to set unplayed songs.
+        strawberryDatabaseCursor.execute("""DELETE FROM itunes_matches WHERE method = 'URL'
+            AND track_row IN (SELECT track_row FROM itunes_matches WHERE method = 'adding to existing')""")
+    else:
+        strawberryDatabaseCursor.execute("DELETE FROM itunes_matches WHERE method = 'adding to existing'")
+    # Only the first track matching each unplayed song is used.
+    strawberryDatabaseCursor.execute("""DELETE FROM itunes_matches WHERE method = 'URL'
+        AND (song_id, track_row) NOT IN (SELECT song_id, MIN(track_row) FROM itunes_matches WHERE method = 'URL' GROUP BY song_id)""")
+
+    # Set all songs with unassigned play counts, last played date, and skip counts to the iTunes values:
+    setCounts = """UPDATE songs SET playcount = track_play_count, skipcount = track_skip_count, lastplayed = track_last_played
+        FROM itunes_matches JOIN itunes_tracks ON (itunes_tracks.rowid = itunes_matches.track_row)
+        WHERE songs.rowid = itunes_matches.song_id AND itunes_matches.method = 'URL' AND songs.playcount = 0"""
+    appLogger.debug(setCounts)
+    updateCount += executeUpdate(strawberryDatabaseCursor, setCounts)
+
+    reportStagedMatches(strawberryDatabaseCursor)
+    return updateCount
+
+def updatePlayCounts(iTunesLibrary, strawberryDatabaseCursor, findClause, updateUnplayed, updateExisting, bulk, urlRewriter,
+                     findParameters = ()):
+    """
+    Update the play and skip counts, and last played dates, of the Strawberry songs from the
+    iTunes library, by the method selected by the command line flags. Only the songs matching
+    the findClause, if given, with its findParameters, are updated.
+    Returns the number of updates performed.
+    """
+    if bulk and updateUnplayed:
+        return bulkUpdateUnplayed(iTunesLibrary, strawberryDatabaseCursor, urlRewriter, findClause = findClause,
+                                  findParameters = findParameters)
+    elif bulk:
+        return bulkUpdateAlliTunesFiles(iTunesLibrary, strawberryDatabaseCursor, findClause, updateExisting, urlRewriter,
+                                        findParameters = findParameters)
+    elif updateUnplayed:
+        return processUnplayedStrawberyFiles(iTunesLibrary, strawberryDatabaseCursor, urlRewriter, findClause = findClause,
+                                             findParameters = findParameters)
+    return processAlliTunesFiles(iTunesLibrary, strawberryDatabaseCursor, findClause, updateExisting, urlRewriter,
+                                 findParameters = findParameters)
+
+def albumClause(album):
+    """
+    Returns the find clause, and its parameters, of the songs of the album, or no clause if the
+    album is empty.
+    """
+    return ("album = ?", (album, )) if len(album) > 0 else ('', ())
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'Alters a Strawberry music player database, setting the play and skip counts, and last played date and time from the iTunes Library XML file.')
     parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
@@ -203,40 +451,79 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--find', action = 'store', help = 'Only update the named album', default = '')
     parser.add_argument('-p', '--update-unplayed', action = 'store_true', help = 'Update existing records if they have a zero play count')
     parser.add_argument('-u', '--update-existing', action = 'store_true', help = 'Update the existing records if they already have play counts')
+    parser.add_argument('-b', '--bulk', action = 'store_true', help = 'Stage all iTunes tracks in a temporary table and update the database with a few set-based statements')
+    parser.add_argument('-P', '--pipeline', action = 'store_true', help = 'Match and update the tracks on separate threads as they are read, committing the updates in batches')
+    parser.add_argument('--matchers', action = 'store', type = int, help = 'The number of threads matching the tracks with --pipeline. Defaults to %(default)s', default = MATCHER_COUNT)
     parser.add_argument('-d', '--dump-existing', action = 'store_true', help = 'Display the existing tracks if they already have play counts')
-    parser.add_argument('-r', '--replace-url', action = 'store', help = 'The URL regexp to replace', default = '')
-    parser.add_argument('-w', '--replace-with', action = 'store', help = 'The URL fragment to replace with', default = '')
+    parser.add_argument('-r', '--replace-url', action = 'append', help = 'The URL regexp to replace. May be repeated, each paired with the -w in the same position', default = [])
+    parser.add_argument('-w', '--replace-with', action = 'append', help = 'The URL fragment to replace with, or nothing if there is no -w for the -r', default = [])
+    parser.add_argument('--snapshot', action = 'store', nargs = '?', const = '', metavar = 'FILE',
+                        help = 'Read the parsed iTunes library from a snapshot, written to the file, or the library path with .snapshot appended, by the first run, and read by later runs while the library is unchanged. The snapshot holds the whole library in memory')
+    parser.add_argument('--index', action = 'store', nargs = '?', const = '', metavar = 'FILE',
+                        help = 'With --find, read only the iTunes tracks of the album, by an index of the iTunes library XML file, decoding only those tracks. The index is written by the first run, to the file, or the library path with .index appended')
+    parser.add_argument('-j', '--jobs', action = 'store', type = int, help = 'Parse the tracks of the iTunes library XML file with this many processes. Defaults to %(default)s.', default = 1)
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of tracks matched by each method, as JSON to the file, or standard output')
     
     args = parser.parse_args()
+    if args.pipeline and (args.bulk or args.update_unplayed):
+        parser.error("--pipeline updates all the iTunes tracks, so can not be used with --bulk or --update-unplayed")
+    if len(args.replace_with) > len(args.replace_url):
+        parser.error("Each --replace-with needs a --replace-url")
+    if args.index is not None and len(args.find) == 0:
+        parser.error("--index only reads the tracks of the album named by --find")
 
-    # We set the logging value here so it's available to the core and master nodes.
-    appLogger = logging.getLogger("iTunes2Strawberry")
     logging.basicConfig()
 
     if args.verbose > 1:
         appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("librarySnapshot").setLevel(logging.DEBUG)
+        logging.getLogger("parallelLibrary").setLevel(logging.DEBUG)
+        logging.getLogger("libraryIndex").setLevel(logging.DEBUG)
+        logging.getLogger("pipeline").setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
     elif args.verbose > 0:
         appLogger.setLevel(logging.INFO)
+        logging.getLogger("librarySnapshot").setLevel(logging.INFO)
+        logging.getLogger("parallelLibrary").setLevel(logging.INFO)
+        logging.getLogger("libraryIndex").setLevel(logging.INFO)
+        logging.getLogger("pipeline").setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
 
-    sqlClient = sqlite3.connect(args.strawberry)
-    cursor = sqlClient.cursor()
+    if args.stats is not None:
+        runStatistics.enable()
 
-    if args.dump_existing:
-        dumpAllPlayed(cursor)
+    with databaseToUpdate(args.strawberry, args.live) as databasePath:
+        sqlClient = sqlite3.connect(databasePath)
+        cursor = sqlClient.cursor()
+
+        if args.dump_existing:
+            dumpAllPlayed(cursor)
     
-    with open(args.itunes, 'rb') as libraryFile:
-        root = plistlib.load(libraryFile, fmt = plistlib.FMT_XML)
-        findClause = f"album = '{args.find}'" if len(args.find) > 0 else ''
-        if args.update_unplayed:
-            updateCount = processUnplayedStrawberyFiles(root, cursor, args.replace_url, args.replace_with,
-                                                        findClause = findClause)
+        snapshotPath = None if args.snapshot is None else (args.snapshot or args.itunes + '.snapshot')
+        if args.index is not None:
+            libraryOpened = openIndexedLibrary(args.itunes, args.index or args.itunes + '.index', album = args.find)
         else:
-            updateCount = processAlliTunesFiles(root, cursor, findClause, args.update_existing, args.replace_url, args.replace_with)
+            libraryOpened = openLibrary(args.itunes, snapshotPath, args.jobs)
+        urlRewriter = URLRewriter(itertools.zip_longest(args.replace_url, args.replace_with, fillvalue = ''))
+        with libraryOpened as root:
+            findClause, findParameters = albumClause(args.find)
+            if args.pipeline:
+                # The updates are committed by the pipeline's own connection.
+                updateCount = pipelineAlliTunesFiles(root, databasePath, findClause, args.update_existing,
+                                                     urlRewriter, matcherCount = args.matchers, findParameters = findParameters)
+            else:
+                updateCount = updatePlayCounts(root, cursor, findClause, args.update_unplayed, args.update_existing, args.bulk,
+                                               urlRewriter, findParameters = findParameters)
+        urlRewriter.logRuleCounts(appLogger)
 
-    # Save (commit) the changes
-    appLogger.info(f"Updated {updateCount} tracks")
-    if updateCount > 0:
-        # Save (commit) the changes
-        sqlClient.commit()
+        appLogger.info(f"Updated {updateCount} tracks")
+        if updateCount > 0:
+            # Save (commit) the changes
+            with runStatistics.phase('commit'):
+                sqlClient.commit()
 
-    sqlClient.close()
+        sqlClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
@@ -0,0 +1,261 @@
+"""
+Incremental reader of the iTunes exported library XML file.
+
+Rather than loading the entire property list into memory with plistlib, the tracks and
+playlists are decoded one at a time as the file is parsed, and discarded once they have been
+handed on, so memory use is independent of the size of the library.
+"""
+
+import re
+import sys
+import base64
+from datetime import datetime
+from xml.etree import ElementTree
+from urlConversion import convertURL, convertURLs
+
+# The top level keys of the library which are streamed, rather than decoded whole.
+SECTIONS = ('Tracks', 'Playlists')
+
+# The fields of a track retained by a Track record.
+RECORD_FIELDS = ('Name', 'Artist', 'Location', 'Play Count', 'Play Date UTC', 'Skip Count', 'Skip Date')
+
+# Matches the ISO 8601 dates used in property lists, as plistlib does.
+dateParser = re.compile(r"(?P<year>\d\d\d\d)(?:-(?P<month>\d\d)(?:-(?P<day>\d\d)(?:T(?P<hour>\d\d)(?::(?P<minute>\d\d)(?::(?P<second>\d\d))?)?)?)?)?Z", re.ASCII)
+
+def decodeDate(dateString):
+    """
+    Returns the naive UTC datetime of the property list date, as plistlib.load does.
+    """
+    fields = dateParser.match(dateString).groupdict()
+    order = ('year', 'month', 'day', 'hour', 'minute', 'second')
+    components = []
+    for key in order:
+        value = fields[key]
+        if value is None:
+            break
+        components.append(int(value))
+    # Default the missing day and month to 1.
+    while len(components) < 3:
+        components.append(1)
+    return datetime(*components)
+
+def decodeElement(element):
+    """
+    Returns the Python value of a completely parsed property list element.
+    """
+    tag = element.tag
+    if tag == 'dict':
+        decoded = {}
+        key = None
+        for child in element:
+            if child.tag == 'key':
+                key = child.text or ''
+            else:
+                decoded[key] = decodeElement(child)
+        return decoded
+    elif tag == 'array':
+        return [decodeElement(child) for child in element]
+    elif tag == 'string':
+        return element.text or ''
+    elif tag == 'integer':
+        return int(element.text)
+    elif tag == 'real':
+        return float(element.text)
+    elif tag == 'true':
+        return True
+    elif tag == 'false':
+        return False
+    elif tag == 'date':
+        return decodeDate(element.text)
+    elif tag == 'data':
+        return base64.b64decode(element.text or '')
+    else:
+        raise ValueError(f"Unknown property list element {tag}")
+
+def decodeFields(element, fields):
+    """
+    Returns the dictionary of only the named fields of a completely parsed property list dict
+    element, without decoding the values of the others.
+    """
+    decoded = {}
+    key = None
+    for child in element:
+        if child.tag == 'key':
+            key = child.text or ''
+        elif key in fields:
+            decoded[key] = decodeElement(child)
+    return decoded
+
+class Track:
+    """
+    The fields of an iTunes track used to update the play counts, with those missing given
+    their defaults once, when the record is made. Artists are interned, as they are shared by
+    many tracks. The last played time is held as the integer timestamp used by Strawberry.
+    """
+    __slots__ = ('trackId', 'name', 'artist', 'location', 'playCount', 'skipCount', 'lastPlayed', 'skipDate')
+
+    def __init__(self, trackId, name, artist, location, playCount, skipCount, lastPlayed, skipDate):
+        self.trackId = trackId
+        self.name = name
+        self.artist = artist
+        self.location = location
+        self.playCount = playCount
+        self.skipCount = skipCount
+        self.lastPlayed = lastPlayed
+        self.skipDate = skipDate
+
+    @classmethod
+    def fromProperties(cls, trackId, track, defaultLastPlayed):
+        """
+        Returns the record of the track dictionary, with a missing play date given the
+        defaultLastPlayed timestamp.
+        """
+        playDate = track.get('Play Date UTC')
+        lastPlayed = int(playDate.timestamp()) if playDate is not None else defaultLastPlayed
+        # TODO A missing Skip Date of 0 is not right.
+        return cls(trackId, track.get('Name', 'Untitled'), sys.intern(track.get('Artist', 'Unknown')), track.get('Location'),
+                   track.get('Play Count', 0), track.get('Skip Count', 0), lastPlayed, track.get('Skip Date', 0))
+
+    @property
+    def playDate(self):
+        """
+        The last played time as a naive datetime, as it is in the library.
+        """
+        return datetime.fromtimestamp(self.lastPlayed)
+
+    def __repr__(self):
+        return "Track({})".format(', '.join(f"{field}={getattr(self, field)!r}" for field in self.__slots__))
+
+def defaultLastPlayed():
+    """
+    Returns the timestamp given to tracks which have never been played, the current time.
+    """
+    return int(datetime.utcnow().timestamp())
+
+class LibraryReader:
+    """
+    Reads an iTunes library XML file in a single pass.
+
+    The header holds the top level values (such as 'Major Version' and 'Date') which precede
+    the tracks. tracks() generates (track id, track) tuples, or trackRecords() Track records, and
+    playlists() generates each playlist dictionary, in the order they are in the file. iTunes
+    writes the tracks before the playlists, so the tracks should be read first. If a file has the
+    playlists first, they are held until the tracks have been read. Tracks which have not been
+    read before reading the playlists are skipped.
+    """
+
+    def __init__(self, libraryFile):
+        self.header = {}
+        self.events = ElementTree.iterparse(libraryFile, events = ('start', 'end'))
+        self.items = self.parse()
+        self.bufferedPlaylists = []
+        # Read the header values up to the first track or playlist.
+        self.pending = None
+        for item in self.items:
+            if item[0] == 'header':
+                self.header[item[1]] = item[2]
+            else:
+                self.pending = item
+                break
+
+    def parse(self):
+        """
+        Generates ('header', key, value), ('track', track id, element), ('playlist', None, element)
+        and ('end', section name, None) tuples as the file is parsed. The track and playlist
+        elements are cleared once the next item is requested, so must be decoded before then.
+        """
+        depth = 0
+        rootDict = None
+        sectionElement = None
+        topKey = None
+        itemKey = None
+        for event, element in self.events:
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    rootDict = element
+                elif depth == 3 and topKey in SECTIONS and element.tag != 'key':
+                    sectionElement = element
+                continue
+            # The end of an element, which has now been completely parsed.
+            if depth == 3:
+                if element.tag == 'key':
+                    topKey = element.text
+                else:
+                    if topKey in SECTIONS:
+                        sectionElement = None
+                        yield ('end', topKey, None)
+                    else:
+                        yield ('header', topKey, decodeElement(element))
+                    # Free the values already handed on.
+                    rootDict.clear()
+            elif depth == 4 and sectionElement is not None:
+                if element.tag == 'key':
+                    itemKey = element.text
+                else:
+                    if topKey == 'Tracks':
+                        yield ('track', itemKey, element)
+                    else:
+                        yield ('playlist', None, element)
+                    sectionElement.clear()
+            depth -= 1
+
+    def nextItems(self):
+        """
+        Generates the parsed items, starting with any read ahead while reading the header.
+        Header values found after the tracks or playlists are added to the header.
+        """
+        if self.pending is not None:
+            pending = self.pending
+            self.pending = None
+            yield pending
+        for item in self.items:
+            if item[0] == 'header':
+                self.header[item[1]] = item[2]
+            else:
+                yield item
+
+    def tracks(self, fields = None):
+        """
+        Generates a (track id, track dictionary) tuple for each track in the library. If fields
+        are given, the dictionaries only hold those fields.
+        """
+        for kind, key, value in self.nextItems():
+            if kind == 'track':
+                yield key, decodeElement(value) if fields is None else decodeFields(value, fields)
+            elif kind == 'playlist':
+                self.bufferedPlaylists.append(decodeElement(value))
+            elif kind == 'end' and key == 'Tracks':
+                return
+
+    def trackRecords(self):
+        """
+        Generates a Track record for each track in the library.
+        """
+        lastPlayed = defaultLastPlayed()
+        for trackId, track in self.tracks(RECORD_FIELDS):
+            yield Track.fromProperties(trackId, track, lastPlayed)
+
+    def playlists(self):
+        """
+        Generates each playlist dictionary in the library.
+        """
+        while len(self.bufferedPlaylists) > 0:
+            yield self.bufferedPlaylists.pop(0)
+        for kind, key, value in self.nextItems():
+            if kind == 'playlist':
+                yield decodeElement(value)
+            elif kind == 'end' and key == 'Playlists':
+                return
+
+    def convertURL(self, location):
+        """
+        Returns the Strawberry URL of a track Location.
+        """
+        return convertURL(location)
+
+    def convertURLs(self, locations):
+        """
+        Returns a list of the Strawberry URLs of the track Locations, as convertURLs does.
+        """
+        return convertURLs(locations)
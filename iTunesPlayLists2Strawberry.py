@@ -4,37 +4,24 @@ Converts an iTunes exported library XML file, updating the Strawberry music play
 database, with the play and skip counts, and the last played date and time.
 """
 
-import plistlib
+import json
+import difflib
 import logging
 import argparse
 import sqlite3
-import re
+from collections import deque
 from datetime import datetime, timezone
-from urllib.parse import quote, unquote, urlparse, urlunparse
-import unicodedata
-
-def convertURL(iTunesURL):
-    """
-    Converts the iTunes URLs to a URL that can be found in the Strawberry database.
-    """
-    # Convert XML encoding of ampersands in the URL.
-    iTunesURL = iTunesURL.replace('&#38;', '&')
-    # iTunes encodes URLs, using UTF-8 encoding, but using a character and the combining diacritic,
-    # instead of the noramlized, singular combined character including the diacritic, that Strawberry uses.
-    # For example, iTunes: "n%CC%83", Strawberry: "%C3%B1"
-    # So we need to decode the URL encoding, normalize the characters to the Normal Form
-    # Composed form, then decode the unicode encoding into UTF-8, then reencode the URL.
-    parsedURL = urlparse(iTunesURL) # parse the URL to ensure the URL separators don't get encoded.
-    decodedPath = unquote(parsedURL.path)
-    normalizedUnicodePath = unicodedata.normalize('NFC', decodedPath)
-    # While Strawberry encodes the URL, it leaves a lot of characters unquoted.
-    encodedURL = urlunparse((parsedURL.scheme,
-                             parsedURL.netloc,
-                             quote(normalizedUnicodePath, safe = "/&'(),[];!+=@"),
-                             parsedURL.params,
-                             parsedURL.query,
-                             parsedURL.fragment))
-    return encodedURL
+from librarySnapshot import openLibrary
+from libraryIndex import IndexedLibraryReader, openIndexedLibrary
+from liveDatabase import databaseToUpdate
+from smartPlaylists import compileSmartPlaylist
+from urlRewriting import URLRewriter
+from runStatistics import runStatistics
+
+# The table of the strawberry database holding the compiled criteria of the smart playlists.
+SMART_PLAYLISTS_TABLE = 'itunes_smart_playlists'
+
+appLogger = logging.getLogger("iTunesPlayLists2Strawberry")
 
 def SQLEncodeString(queryString):
     """
@@ -62,117 +49,313 @@ def createPlaylist(dbCursor, playlistName):
         appLogger.error(f"Playlist named {playlistName} already present in strawberry database, not overwriting")
     return -1
 
-def writePlayListItem(dbCursor, playlistName, playlistId, url):
+def findPlaylist(dbCursor, playlistName):
+    """
+    Returns the row id of the first playlist of the given name in the strawberry database, or None if there is none.
+    """
+    findPlaylistId = "SELECT rowid FROM playlists WHERE name = ? ORDER BY rowid"
+    appLogger.debug(findPlaylistId)
+    dbCursor.execute(findPlaylistId, (playlistName,))
+    row = dbCursor.fetchone()
+    return row[0] if row is not None else None
+
+def readPlaylistItems(dbCursor, playlistId = None):
+    """
+    Returns a dictionary, keyed by the playlist row id, of the lists of (rowid, collection_id) of each playlist's
+    items, in the order of the playlist, read in a single query. If playlistId is given, only its items are read.
+    """
+    findItems = "SELECT playlist, rowid, collection_id FROM playlist_items" + (" WHERE playlist = ?" if playlistId is not None else "") + " ORDER BY playlist, rowid"
+    appLogger.debug(findItems)
+    playlistItems = {}
+    for itemPlaylistId, rowid, collectionId in dbCursor.execute(findItems, () if playlistId is None else (playlistId,)):
+        playlistItems.setdefault(itemPlaylistId, []).append((rowid, collectionId))
+    return playlistItems
+
+def findSongRowids(dbCursor):
     """
-    Write each of the 'rowid's as 'collection_ids' for tracks in 'songs' that match the cleaned URLs to 'url' to playlist_items
+    Returns a dictionary of the 'rowid' of the songs, keyed by their URL, read in a single query.
+    Where songs share a URL, the first is used.
+    """
+    findSongs = "SELECT rowid, url FROM songs ORDER BY rowid"
+    appLogger.debug(findSongs)
+    songRowids = {}
+    for rowid, url in dbCursor.execute(findSongs):
+        songRowids.setdefault(url, rowid)
+    return songRowids
+
+def writePlaylistItems(dbCursor, playlistId, collectionIds):
+    """
+    Write each of the 'rowid's of songs as 'collection_ids' of the playlist to playlist_items, in a single batch.
+    Returns the number of items written.
     """
-    findURL = f"SELECT rowid FROM songs WHERE url='{SQLEncodeString(url)}'"
-    appLogger.debug(findURL)
     # These were determined by inspection of the database.
     item_type = 2  # These are hardwired to signal to Strawberry to refer back to the collection id when updating.
     source_type = 2 # Hardwired.
-    dbCursor.execute(findURL)
+    writePlaylistItem = "INSERT INTO playlist_items (playlist, collection_id, type, source) VALUES (?, ?, ?, ?)"
+    appLogger.debug(writePlaylistItem)
+    with runStatistics.phase('sql_writes'):
+        dbCursor.executemany(writePlaylistItem, [(playlistId, collectionId, item_type, source_type) for collectionId in collectionIds])
+    writtenCount = dbCursor.rowcount if len(collectionIds) > 0 else 0
+    runStatistics.count('rows_written', writtenCount)
+    return writtenCount
+
+def diffPlaylistItems(existingItems, collectionIds):
+    """
+    Returns the edits altering the existing (rowid, collection_id) items of a playlist to be the songs with the 'rowid's
+    collectionIds, in that order: a list of the rowids of the items to delete, a list of the (collection_id, rowid) of
+    the items to update, and a list of the collection_ids of the items to append.
+    Items are in the order of their rowid, so an item can not be inserted between two others. The items matching the
+    longest common runs of the old and new playlists are retained, those removed deleted, and those inserted or moved
+    written over the items following them, in place, until as many items have been removed, or appended at the end.
+    """
+    deletedRowids = []
+    updatedItems = []
+    # The collection ids inserted, in order, waiting for the item following them to be written over.
+    pendingIds = deque()
+    existingIds = [collectionId for rowid, collectionId in existingItems]
+    matcher = difflib.SequenceMatcher(None, existingIds, collectionIds, autojunk = False)
+    for tag, existingStart, existingEnd, newStart, newEnd in matcher.get_opcodes():
+        if tag == 'equal' and len(pendingIds) == 0:
+            continue
+        pendingIds.extend(collectionIds[newStart:newEnd])
+        for rowid, collectionId in existingItems[existingStart:existingEnd]:
+            if len(pendingIds) == 0:
+                deletedRowids.append(rowid)
+            else:
+                pendingId = pendingIds.popleft()
+                if pendingId != collectionId:
+                    updatedItems.append((pendingId, rowid))
+    return deletedRowids, updatedItems, list(pendingIds)
+
+def syncPlaylistItems(dbCursor, playlistName, playlistId, collectionIds, existingItems):
+    """
+    Alter the items of an existing playlist to be the songs with the 'rowid's collectionIds, in that order, deleting,
+    updating and appending only the items which differ.
+    Returns the number of items deleted, updated and written, zero if the playlist is unchanged.
+    """
+    deletedRowids, updatedItems, appendedIds = diffPlaylistItems(existingItems, collectionIds)
+    if len(deletedRowids) == 0 and len(updatedItems) == 0 and len(appendedIds) == 0:
+        appLogger.info(f"Playlist {playlistName} is unchanged")
+        return 0
+    deleteItem = "DELETE FROM playlist_items WHERE rowid = ?"
+    appLogger.debug(deleteItem)
+    # Items written over refer to the collection, as those written by writePlaylistItems do.
+    updateItem = "UPDATE playlist_items SET collection_id = ?, type = 2, source = 2 WHERE rowid = ?"
+    appLogger.debug(updateItem)
+    with runStatistics.phase('sql_writes'):
+        dbCursor.executemany(deleteItem, [(rowid,) for rowid in deletedRowids])
+        dbCursor.executemany(updateItem, updatedItems)
+    runStatistics.count('rows_written', len(deletedRowids) + len(updatedItems))
+    writtenCount = writePlaylistItems(dbCursor, playlistId, appendedIds)
+    appLogger.info(f"Playlist {playlistName} updated, deleting {len(deletedRowids)} items, updating {len(updatedItems)}, writing {writtenCount}")
+    return len(deletedRowids) + len(updatedItems) + writtenCount
+
+def writeSmartPlaylist(dbCursor, playlistName, smartSQL, smartParameters, replace = False):
+    """
+    Store the SQL compiled from the criteria of the smart playlist, and its parameters, in the smart playlists table of
+    the strawberry database, rather than the songs it selects, creating the table if needed.
+    Returns 1 if the smart playlist was stored, or 0 if it was stored already, or is present and not to be replaced.
+    """
+    dbCursor.execute(f"CREATE TABLE IF NOT EXISTS {SMART_PLAYLISTS_TABLE} (name TEXT PRIMARY KEY, query TEXT NOT NULL, parameters TEXT NOT NULL)")
+    encodedParameters = json.dumps(smartParameters)
+    dbCursor.execute(f"SELECT query, parameters FROM {SMART_PLAYLISTS_TABLE} WHERE name = ?", (playlistName,))
     row = dbCursor.fetchone()
-    if row is not None:
-        collection_id = row[0] # songs rowid, i.e. the collection_id
-        writePlaylistItem = f"INSERT INTO playlist_items (playlist, collection_id, type, source) VALUES ({playlistId}, {collection_id}, {item_type}, {source_type})"
-        appLogger.debug(writePlaylistItem)
-        dbCursor.execute(writePlaylistItem)
-        # Check the insertion worked 
-        dbCursor.execute('SELECT changes() FROM playlist_items')
-        result = dbCursor.fetchone()
-        return result[0] > 0
-    else:
-        appLogger.warning(f"Unable to find {url} in strawberry database to insert into {playlistName}")
-    return False
+    if row == (smartSQL, encodedParameters):
+        appLogger.info(f"Smart playlist {playlistName} is unchanged")
+        return 0
+    if row is not None and not replace:
+        appLogger.error(f"Smart playlist named {playlistName} already present in strawberry database, not overwriting")
+        return 0
+    storeSmartPlaylist = f"INSERT OR REPLACE INTO {SMART_PLAYLISTS_TABLE} (name, query, parameters) VALUES (?, ?, ?)"
+    appLogger.debug(storeSmartPlaylist)
+    with runStatistics.phase('sql_writes'):
+        dbCursor.execute(storeSmartPlaylist, (playlistName, smartSQL, encodedParameters))
+    runStatistics.count('rows_written')
+    return 1
 
-def importPlaylists(iTunesTree, strawberryDatabaseCursor, replaceURLList, onlyPlaylist = None, includeSmartPlaylists = False):
+def importPlaylists(iTunesLibrary, strawberryDatabaseCursor, urlRewriter, onlyPlaylist = None, includeSmartPlaylists = False, syncPlaylists = False):
     """
     Create strawberry playlists from either all iTunes playlists or a single playlist.
-    :param iTunesTree: Reads from the iTunes dictionary tree.
+    :param iTunesLibrary: Reads the tracks, then the playlists, from the iTunes library reader.
     :param strawberryDatabaseCursor: writes to the strawberry database indexed by this cursor.
-    :param replaceURLList: A list of tuples, each containing a regular expression and it's replacement to apply to the URL.
+    :param urlRewriter: The URLRewriter of the URL replacement rules, each a regular expression and its replacement.
     :param onlyPlaylist: If not None, only the named playlist will be imported.
-    :param includeSmartPlaylists: if True, convert iTunes smart playlists into Strawberry static playlists.
+    :param includeSmartPlaylists: if True, store the compiled criteria of iTunes smart playlists, or convert those which
+    can not be compiled into Strawberry static playlists.
+    :param syncPlaylists: if True, playlists already in the strawberry database are altered to match those of iTunes.
+    Returns the number of playlist items written, and when synchronising, deleted, and of smart playlists stored.
     """
-    appLogger.debug(iTunesTree.keys())
-    appLogger.info("Searching for playlist {onlyPlaylist} tracks in database in iTunes library file v{Major Version}.{Minor Version} created {Date}".format(onlyPlaylist = onlyPlaylist, **iTunesTree))
-    
+    appLogger.debug(iTunesLibrary.header.keys())
+    appLogger.info("Searching for playlist {onlyPlaylist} tracks in database in iTunes library file v{Major Version}.{Minor Version} created {Date}".format(onlyPlaylist = onlyPlaylist, **iTunesLibrary.header))
+    if onlyPlaylist is not None and isinstance(iTunesLibrary, IndexedLibraryReader):
+        # Only the tracks of the playlist are decoded, as they are looked up.
+        iTunesTracks = iTunesLibrary.trackTable()
+    else:
+        # Only retain the compact record of each track, holding the fields needed to find it in the strawberry database.
+        iTunesTracks = {track.trackId: track for track in runStatistics.timed('xml_parse', iTunesLibrary.trackRecords())}
+
+    with runStatistics.phase('matching'):
+        songRowids = findSongRowids(strawberryDatabaseCursor)
+    # The strawberry URL and songs rowid of each track, found once, however many playlists it is in.
+    foundTracks = {}
+    existingPlaylistItems = readPlaylistItems(strawberryDatabaseCursor) if syncPlaylists else {}
+
     updateCount = 0
     # iTunes include some playlists which hold the entire collection, so we exclude
     # creating those, unless they are explicitly named as an onlyPlaylist.
     excludePlaylists = ['Library', 'Music', 'Downloaded']
-    for playlistCount, playlist in enumerate(iTunesTree['Playlists']):
+    for playlistCount, playlist in enumerate(runStatistics.timed('xml_parse', iTunesLibrary.playlists())):
         smartPlaylist = 'Smart Criteria' in playlist
-        appLogger.debug(f"Playlist {playlistCount}: {playlist['Name']}, {playlist['Description']}, Smart playlist {smartPlaylist}")
+        appLogger.debug("Playlist %s: %s, %s, Smart playlist %s", playlistCount, playlist['Name'], playlist['Description'], smartPlaylist)
         if (playlist['Name'] not in excludePlaylists and onlyPlaylist is None) or playlist['Name'] == onlyPlaylist:
-            if 'Playlist Items' not in playlist:
+            # Smart playlists are stored as their compiled criteria, rather than copying the tracks iTunes found.
+            smartSQL = None
+            if smartPlaylist and includeSmartPlaylists:
+                smartSQL, smartParameters, uncompiled = compileSmartPlaylist(playlist.get('Smart Info', b''), playlist['Smart Criteria'])
+                if smartSQL is None:
+                    appLogger.warning(f"Smart playlist '{playlist['Name']}' criteria not compiled, copying the tracks iTunes found instead: {'; '.join(uncompiled)}")
+            if smartSQL is not None:
+                appLogger.debug(smartSQL)
+                updateCount += writeSmartPlaylist(strawberryDatabaseCursor, playlist['Name'], smartSQL, smartParameters, replace = syncPlaylists)
+            elif 'Playlist Items' not in playlist:
                 appLogger.warning(f"No items in {playlist['Name']}, not creating.")
             elif smartPlaylist and not includeSmartPlaylists:
                 appLogger.warning(f"Smart playlist '{playlist['Name']}' excluded, needs manual recreation in Strawberry.")
             else:
-                strawberryPlayListId = createPlaylist(strawberryDatabaseCursor, playlist['Name'])
+                existingPlayListId = findPlaylist(strawberryDatabaseCursor, playlist['Name']) if syncPlaylists else None
+                if existingPlayListId is not None:
+                    strawberryPlayListId = existingPlayListId
+                else:
+                    strawberryPlayListId = createPlaylist(strawberryDatabaseCursor, playlist['Name'])
                 if strawberryPlayListId < 0:
                     continue
+                collectionIds = []
                 for itemPosition, playlistItem in enumerate(playlist['Playlist Items']):
                     trackId = str(playlistItem['Track ID'])
-                    if trackId in iTunesTree['Tracks']:
-                        trackToAdd = iTunesTree['Tracks'][trackId]
+                    if trackId in iTunesTracks:
+                        trackToAdd = iTunesTracks[trackId]
                         # For some crazy reason we can have entries in the iTunes Library without file URLs?
-                        if 'Location' not in trackToAdd:
-                            appLogger.warning(f"No Location field, skipping {trackId} '{trackToAdd['Name']}' by {trackToAdd['Artist']}.")
+                        if trackToAdd.location is None:
+                            appLogger.warning("No Location field, skipping %s '%s' by %s.", trackId, trackToAdd.name, trackToAdd.artist)
                             continue
 
-                        # Retrieve the URL, apply the cleaning and replacement to search for
-                        # the equivalent song in strawberry database.
-                        cleanedURL = convertURL(trackToAdd['Location'])
-                        alternateURL = cleanedURL
-                        # Apply all substitutions to the same cleaned URL
-                        for URLreplace, replaceWith in replaceURLList:
-                            alternateURL = re.sub(URLreplace, replaceWith, alternateURL, count = 1)
-                            # appLogger.debug(f"{URLreplace} replaced by {replaceWith} producing {alternateURL}")
-                        appLogger.info(f"Searching for track id: {trackId} at {alternateURL} in strawberry")
-                        if writePlayListItem(strawberryDatabaseCursor, playlist['Name'], strawberryPlayListId, alternateURL):
-                            updateCount += 1
+                        if trackId not in foundTracks:
+                            # Retrieve the URL, apply the cleaning and replacement to search for
+                            # the equivalent song in strawberry database.
+                            with runStatistics.phase('url_conversion'):
+                                # Apply all the replacement rules to the cleaned URL in a single pass.
+                                alternateURL = urlRewriter.rewrite(iTunesLibrary.convertURL(trackToAdd.location))
+                            foundTracks[trackId] = (alternateURL, songRowids.get(alternateURL))
+                        alternateURL, collectionId = foundTracks[trackId]
+                        appLogger.info("Searching for track id: %s at %s in strawberry", trackId, alternateURL)
+                        if collectionId is not None:
+                            runStatistics.count('matched_url')
+                            collectionIds.append(collectionId)
                         else:
-                            appLogger.error(f"Unable to write {alternateURL} to playlist {playlist['Name']} at position {itemPosition}.")
+                            runStatistics.count('unmatched')
+                            appLogger.warning("Unable to find %s in strawberry database to insert into %s", alternateURL, playlist['Name'])
+                            appLogger.error("Unable to write %s to playlist %s at position %s.", alternateURL, playlist['Name'], itemPosition)
                     else:
-                        appLogger.warning(f"Can't find track id: {trackId} in iTunes library?")
+                        appLogger.warning("Can't find track id: %s in iTunes library?", trackId)
+                if existingPlayListId is not None:
+                    updateCount += syncPlaylistItems(strawberryDatabaseCursor, playlist['Name'], strawberryPlayListId, collectionIds,
+                                                     existingPlaylistItems.get(strawberryPlayListId, []))
+                else:
+                    updateCount += writePlaylistItems(strawberryDatabaseCursor, strawberryPlayListId, collectionIds)
+                if syncPlaylists:
+                    # A later iTunes playlist of the same name is synchronised with the items as they are now.
+                    existingPlaylistItems[strawberryPlayListId] = readPlaylistItems(strawberryDatabaseCursor, strawberryPlayListId).get(strawberryPlayListId, [])
     return updateCount
 
+def reportSmartPlaylists(iTunesLibrary, strawberryDatabaseCursor):
+    """
+    Prints the SQL compiled from the criteria of each smart playlist, and the number of songs of the strawberry database
+    it selects, or the criteria which could not be compiled.
+    Returns the number of smart playlists which could not be compiled.
+    """
+    # The tracks are not needed, and are skipped undecoded by reading the playlists.
+    uncompiledCount = 0
+    for playlist in iTunesLibrary.playlists():
+        if 'Smart Criteria' in playlist:
+            smartSQL, smartParameters, uncompiled = compileSmartPlaylist(playlist.get('Smart Info', b''), playlist['Smart Criteria'])
+            if smartSQL is not None:
+                songCount = len(strawberryDatabaseCursor.execute(smartSQL, smartParameters).fetchall())
+                print(f"{playlist['Name']}: {smartSQL} {smartParameters} selects {songCount} songs")
+            else:
+                uncompiledCount += 1
+                print(f"{playlist['Name']}: Not compiled: {'; '.join(uncompiled)}")
+    return uncompiledCount
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'Alters a Strawberry music player database, adding playlists from the iTunes Library XML file.')
     parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
     parser.add_argument('-s', '--strawberry', action = 'store', help = 'Path to the Strawberry database file. Defaults to %(default)s.', type = str, default = 'strawberry.db')
     parser.add_argument('-i', '--itunes', action = 'store', help = 'Path to the iTunes exported Library.xml file. Defaults to %(default)s.', type = str, default = 'Library.xml')
-    parser.add_argument('--convert-smart-playlists', action = 'store_true', help = 'Convert iTunes smart playlists to Strawberry static playlists.')
+    parser.add_argument('--convert-smart-playlists', action = 'store_true', help = 'Store the compiled criteria of iTunes smart playlists in the Strawberry database, converting those which can not be compiled to static playlists.')
+    parser.add_argument('--smart-report', action = 'store_true', help = 'Only report the SQL compiled from the criteria of each smart playlist, and the number of songs it selects, and the criteria which could not be compiled.')
+    parser.add_argument('--sync', action = 'store_true', help = 'Update playlists already in the Strawberry database to match those of iTunes, rather than skipping them.')
     parser.add_argument('-p', '--import-playlist', action = 'store', help = 'Only import the named playlist.', default = None)
-    parser.add_argument('-r', '--replace-url', action = 'append', nargs=2, help = 'The URL regexp to replace, and the URL fragment to replace with.')
+    parser.add_argument('-r', '--replace-url', action = 'append', nargs=2, help = 'The URL regexp to replace, and the URL fragment to replace with.', default = [])
+    parser.add_argument('--snapshot', action = 'store', nargs = '?', const = '', metavar = 'FILE',
+                        help = 'Read the parsed iTunes library from a snapshot, written to the file, or the library path with .snapshot appended, by the first run, and read by later runs while the library is unchanged. The snapshot holds the whole library in memory.')
+    parser.add_argument('--index', action = 'store', nargs = '?', const = '', metavar = 'FILE',
+                        help = 'With --import-playlist, look up the tracks of the playlist by an index of the iTunes library XML file, decoding only those tracks. The index is written by the first run, to the file, or the library path with .index appended.')
+    parser.add_argument('-j', '--jobs', action = 'store', type = int, help = 'Parse the tracks of the iTunes library XML file with this many processes. Defaults to %(default)s.', default = 1)
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended.')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of playlist items found, as JSON to the file, or standard output.')
     
     args = parser.parse_args()
+    if args.index is not None and args.import_playlist is None:
+        parser.error("--index only reads the tracks of the playlist named by --import-playlist")
 
-    # We set the logging value here so it's available to the core and master nodes.
-    appLogger = logging.getLogger("iTunesPlayLists2Strawberry")
     logging.basicConfig()
 
     if args.verbose > 1:
         appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("librarySnapshot").setLevel(logging.DEBUG)
+        logging.getLogger("parallelLibrary").setLevel(logging.DEBUG)
+        logging.getLogger("libraryIndex").setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
     elif args.verbose > 0:
         appLogger.setLevel(logging.INFO)
+        logging.getLogger("librarySnapshot").setLevel(logging.INFO)
+        logging.getLogger("parallelLibrary").setLevel(logging.INFO)
+        logging.getLogger("libraryIndex").setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
 
-    sqlClient = sqlite3.connect(args.strawberry)
-    cursor = sqlClient.cursor()
+    if args.stats is not None:
+        runStatistics.enable()
 
-    with open(args.itunes, 'rb') as libraryFile:
-        root = plistlib.load(libraryFile, fmt = plistlib.FMT_XML)
-        updateCount = importPlaylists(root, cursor, args.replace_url,
-                                      onlyPlaylist = args.import_playlist,
-                                      includeSmartPlaylists = args.convert_smart_playlists)
+    with databaseToUpdate(args.strawberry, args.live) as databasePath:
+        sqlClient = sqlite3.connect(databasePath)
+        cursor = sqlClient.cursor()
+
+        snapshotPath = None if args.snapshot is None else (args.snapshot or args.itunes + '.snapshot')
+        if args.index is not None:
+            libraryOpened = openIndexedLibrary(args.itunes, args.index or args.itunes + '.index')
+        else:
+            libraryOpened = openLibrary(args.itunes, snapshotPath, args.jobs)
+        urlRewriter = URLRewriter(args.replace_url)
+        with libraryOpened as root:
+            if args.smart_report:
+                uncompiledCount = reportSmartPlaylists(root, cursor)
+                appLogger.info(f"{uncompiledCount} smart playlists could not be compiled")
+                updateCount = 0
+            else:
+                updateCount = importPlaylists(root, cursor, urlRewriter,
+                                              onlyPlaylist = args.import_playlist,
+                                              includeSmartPlaylists = args.convert_smart_playlists,
+                                              syncPlaylists = args.sync)
+                urlRewriter.logRuleCounts(appLogger)
 
-    # Save (commit) the changes
-    appLogger.info(f"Added {updateCount} tracks")
-    if updateCount > 0:
         # Save (commit) the changes
-        sqlClient.commit()
+        appLogger.info(f"Added {updateCount} tracks" if not args.sync else f"Added or removed {updateCount} tracks")
+        if updateCount > 0:
+            # Save (commit) the changes
+            with runStatistics.phase('commit'):
+                sqlClient.commit()
 
-    sqlClient.close()
+        sqlClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
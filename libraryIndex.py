@@ -0,0 +1,228 @@
+"""
+A byte offset index of the tracks of an iTunes library XML file, so runs needing only a few
+tracks, such as importing a single playlist, or updating a single album, decode only those.
+
+The index is made by a single scan of the dict tags of the Tracks section, without parsing the
+XML, and holds the byte range of each track's dict, keyed by its Track ID, and the Track IDs of
+each album. It is written alongside the library, and keyed by the size and modification time
+of the library, so it is made again whenever the library changes. The library is memory mapped,
+and each track decoded as it is looked up. The header and playlists are read by a LibraryReader
+of the file without its Tracks section.
+"""
+
+import os
+import re
+import html
+import mmap
+import marshal
+import logging
+import contextlib
+import unicodedata
+import collections.abc
+from xml.etree import ElementTree
+from iTunesLibrary import LibraryReader, Track, RECORD_FIELDS, decodeElement, decodeFields, defaultLastPlayed
+from parallelLibrary import SplicedFile, tracksStart, dictTag
+from urlConversion import convertURL, convertURLs
+
+INDEX_MAGIC = 'ITLINDEX1'
+
+# The key of a track, preceding its dict.
+trackKey = re.compile(rb"<key>([^<]*)</key>\s*$")
+albumValue = re.compile(rb"<key>Album</key>\s*<string>([^<]*)</string>")
+
+moduleLogger = logging.getLogger("libraryIndex")
+
+def indexTracks(libraryMap):
+    """
+    Returns a tuple of the start and end byte offsets of the content of the Tracks dict, the
+    dictionary of the (start, end) byte offsets of each track's dict, keyed by its Track ID, in
+    the order of the library, and the dictionary of the list of the Track IDs of each album,
+    keyed by its NFC normalised name.
+    Returns None if there is no Tracks section.
+    """
+    start = tracksStart.search(libraryMap)
+    if start is None:
+        return None
+    contentStart = start.end()
+    trackOffsets = {}
+    albumTracks = {}
+
+    def addTrack(keyEnd, trackStart, trackEnd):
+        key = trackKey.search(libraryMap, keyEnd, trackStart)
+        trackId = key.group(1).decode('utf-8')
+        trackOffsets[trackId] = (trackStart, trackEnd)
+        album = albumValue.search(libraryMap, trackStart, trackEnd)
+        if album is not None:
+            albumName = unicodedata.normalize('NFC', html.unescape(album.group(1).decode('utf-8')))
+            albumTracks.setdefault(albumName, []).append(trackId)
+
+    depth = 1
+    # The end of the previous track, after which the key of the next is found.
+    keyEnd = contentStart
+    trackStart = None
+    for tag in dictTag.finditer(libraryMap, contentStart):
+        closing, empty = tag.group(1), tag.group(2)
+        if empty:
+            if depth == 1:
+                addTrack(keyEnd, tag.start(), tag.end())
+                keyEnd = tag.end()
+        elif closing:
+            depth -= 1
+            if depth == 0:
+                return contentStart, tag.start(), trackOffsets, albumTracks
+            if depth == 1:
+                addTrack(keyEnd, trackStart, tag.end())
+                keyEnd = tag.end()
+        else:
+            if depth == 1:
+                trackStart = tag.start()
+            depth += 1
+    return None
+
+def writeIndex(indexPath, fingerprint, trackSection):
+    """
+    Writes the index of the tracks of the library, atomically replacing any previous index.
+    """
+    temporaryPath = indexPath + '.tmp'
+    with open(temporaryPath, 'wb') as indexFile:
+        marshal.dump((INDEX_MAGIC, fingerprint, trackSection), indexFile)
+    os.replace(temporaryPath, indexPath)
+
+def readIndex(indexPath, fingerprint):
+    """
+    Returns the track section of the index written by writeIndex, as indexTracks does, or False
+    if there is no index of the library with the fingerprint.
+    """
+    try:
+        with open(indexPath, 'rb') as indexFile:
+            magic, indexedFingerprint, trackSection = marshal.load(indexFile)
+    except (OSError, EOFError, ValueError, TypeError) as error:
+        moduleLogger.debug(f"No index read from {indexPath}: {error}")
+        return False
+    if magic != INDEX_MAGIC or tuple(indexedFingerprint) != fingerprint:
+        moduleLogger.info(f"The index {indexPath} is not of the library as it is now")
+        return False
+    return trackSection
+
+class TrackTable(collections.abc.Mapping):
+    """
+    The Track records of an indexed library, keyed by Track ID, decoded as they are looked up.
+    """
+
+    def __init__(self, libraryReader):
+        self.libraryReader = libraryReader
+        self.decodedTracks = {}
+
+    def __getitem__(self, trackId):
+        track = self.decodedTracks.get(trackId)
+        if track is None:
+            track = self.decodedTracks[trackId] = self.libraryReader.trackRecord(trackId)
+        return track
+
+    def __contains__(self, trackId):
+        return trackId in self.libraryReader.trackOffsets
+
+    def __iter__(self):
+        return iter(self.libraryReader.trackOffsets)
+
+    def __len__(self):
+        return len(self.libraryReader.trackOffsets)
+
+class IndexedLibraryReader:
+    """
+    Reads an iTunes library XML file by its index, with the same interface as LibraryReader,
+    except the tracks and playlists may be read in either order, and tracks may be looked up
+    by their Track ID. If an album is given, only the tracks of that album are generated.
+    """
+
+    def __init__(self, libraryFile, trackSection, album = None):
+        self.libraryFile = libraryFile
+        self.lastPlayed = defaultLastPlayed()
+        if trackSection is None:
+            self.libraryMap = None
+            self.trackOffsets = albumTracks = {}
+            self.reader = LibraryReader(libraryFile)
+        else:
+            contentStart, contentEnd, self.trackOffsets, albumTracks = trackSection
+            self.libraryMap = mmap.mmap(libraryFile.fileno(), 0, access = mmap.ACCESS_READ)
+            self.reader = LibraryReader(SplicedFile(libraryFile, contentStart, contentEnd))
+        self.trackIds = self.trackOffsets.keys() if album is None else albumTracks.get(unicodedata.normalize('NFC', album), [])
+        self.header = self.reader.header
+
+    def close(self):
+        if self.libraryMap is not None:
+            self.libraryMap.close()
+
+    def trackElement(self, trackId):
+        start, end = self.trackOffsets[trackId]
+        return ElementTree.fromstring(self.libraryMap[start:end])
+
+    def trackRecord(self, trackId):
+        """
+        Returns the Track record of the Track ID, raising KeyError if there is no such track.
+        """
+        return Track.fromProperties(trackId, decodeFields(self.trackElement(trackId), RECORD_FIELDS), self.lastPlayed)
+
+    def trackTable(self):
+        """
+        Returns a mapping of the Track record of each Track ID, decoding each track when it is first looked up.
+        """
+        return TrackTable(self)
+
+    def tracks(self, fields = None):
+        """
+        Generates a (track id, track dictionary) tuple for each track in the library. If fields
+        are given, the dictionaries only hold those fields.
+        """
+        for trackId in self.trackIds:
+            element = self.trackElement(trackId)
+            yield trackId, decodeElement(element) if fields is None else decodeFields(element, fields)
+
+    def trackRecords(self):
+        """
+        Generates a Track record for each track in the library.
+        """
+        for trackId in self.trackIds:
+            yield self.trackRecord(trackId)
+
+    def playlists(self):
+        """
+        Generates each playlist dictionary in the library.
+        """
+        return self.reader.playlists()
+
+    def convertURL(self, location):
+        """
+        Returns the Strawberry URL of a track Location.
+        """
+        return convertURL(location)
+
+    def convertURLs(self, locations):
+        """
+        Returns a list of the Strawberry URLs of the track Locations, as convertURLs does.
+        """
+        return convertURLs(locations)
+
+@contextlib.contextmanager
+def openIndexedLibrary(libraryPath, indexPath, album = None):
+    """
+    Opens the library, returning an IndexedLibraryReader of it. The index is read from the
+    indexPath, or if there is none of the library as it is now, made and written there.
+    """
+    libraryStat = os.stat(libraryPath)
+    fingerprint = (libraryStat.st_size, libraryStat.st_mtime_ns)
+    with open(libraryPath, 'rb') as libraryFile:
+        trackSection = readIndex(indexPath, fingerprint)
+        if trackSection is False:
+            with mmap.mmap(libraryFile.fileno(), 0, access = mmap.ACCESS_READ) as libraryMap:
+                trackSection = indexTracks(libraryMap)
+            try:
+                writeIndex(indexPath, fingerprint, trackSection)
+                moduleLogger.info(f"Wrote the index {indexPath} of {libraryPath}")
+            except OSError as error:
+                moduleLogger.warning(f"Unable to write the index {indexPath}: {error}")
+        libraryReader = IndexedLibraryReader(libraryFile, trackSection, album)
+        try:
+            yield libraryReader
+        finally:
+            libraryReader.close()
@@ -0,0 +1,272 @@
+"""
+A compact binary snapshot of an iTunes library XML file, so later runs against the same,
+unchanged, library skip parsing the XML.
+
+The snapshot holds the header, the fields of each track used by the utilities, with the track's
+URL already converted to that of Strawberry, and the playlists. It is keyed by the size,
+modification time and SHA-256 hash of the XML file it was made from: a snapshot is used if the
+size and modification time are unchanged, or if only the modification time has changed (such as
+by copying the library), the hash is unchanged. The snapshot is memory mapped and decoded with
+marshal, and tracks are only built into dictionaries as they are read.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import marshal
+import hashlib
+import logging
+import contextlib
+from datetime import datetime, timedelta
+from iTunesLibrary import LibraryReader, Track, RECORD_FIELDS, defaultLastPlayed
+from parallelLibrary import ParallelLibraryReader
+from urlConversion import convertURL
+from runStatistics import runStatistics
+
+SNAPSHOT_MAGIC = b'ITLSNAP1'
+# The size, modification time in nanoseconds and SHA-256 hash of the library XML file.
+FINGERPRINT = struct.Struct('>Qq32s')
+
+# The fields of each track retained in the snapshot, and those of them which are dates.
+TRACK_FIELDS = ('Track ID', 'Name', 'Artist', 'Album', 'Location', 'Play Count', 'Play Date UTC', 'Skip Count', 'Skip Date')
+DATE_FIELDS = ('Play Date UTC', 'Skip Date')
+
+# Dates are stored as seconds since the epoch, and decoded to the naive UTC datetimes of plistlib.
+EPOCH = datetime(1970, 1, 1)
+
+READ_SIZE = 1 << 20
+
+moduleLogger = logging.getLogger("librarySnapshot")
+
+def encodeValue(value):
+    """
+    Returns the property list value in a form marshal can write. Dates, which marshal can not,
+    are written as a tuple of their seconds since the epoch, as property lists have no tuples.
+    """
+    if isinstance(value, datetime):
+        return (int((value - EPOCH).total_seconds()),)
+    elif isinstance(value, dict):
+        return {key: encodeValue(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [encodeValue(item) for item in value]
+    return value
+
+def decodeValue(value):
+    """
+    Returns the property list value of a value written by encodeValue.
+    """
+    if isinstance(value, tuple):
+        return EPOCH + timedelta(seconds = value[0])
+    elif isinstance(value, dict):
+        return {key: decodeValue(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [decodeValue(item) for item in value]
+    return value
+
+def encodePlaylist(playlist):
+    # The items are only track ids, and are the bulk of the playlist, so are written unaltered.
+    return {key: value if key == 'Playlist Items' else encodeValue(value) for key, value in playlist.items()}
+
+def decodePlaylist(playlist):
+    return {key: value if key == 'Playlist Items' else decodeValue(value) for key, value in playlist.items()}
+
+class HashingFile:
+    """
+    Reads a file, hashing its content as it is read.
+    """
+
+    def __init__(self, readFile):
+        self.readFile = readFile
+        self.hasher = hashlib.sha256()
+
+    def read(self, size = -1):
+        data = self.readFile.read(size)
+        self.hasher.update(data)
+        return data
+
+def hashFile(filePath):
+    """
+    Returns the SHA-256 hash of the content of the file.
+    """
+    hasher = hashlib.sha256()
+    with open(filePath, 'rb') as hashedFile:
+        while True:
+            data = hashedFile.read(READ_SIZE)
+            if len(data) == 0:
+                return hasher.digest()
+            hasher.update(data)
+
+class SnapshotReader:
+    """
+    Reads the tracks and playlists of a library from its snapshot, with the same interface as
+    LibraryReader, except the tracks and playlists may be read in either order, and the URLs
+    of the tracks are already converted.
+    """
+
+    def __init__(self, header, trackRows, playlists):
+        self.header = header
+        # Tuples of the track id, the value of each of TRACK_FIELDS or None, and the converted URL.
+        self.trackRows = trackRows
+        self.encodedPlaylists = playlists
+        location = 1 + TRACK_FIELDS.index('Location')
+        self.convertedURLs = {row[location]: row[-1] for row in trackRows if row[location] is not None}
+
+    def tracks(self):
+        """
+        Generates a (track id, track dictionary) tuple for each track in the library.
+        """
+        dateIndices = [TRACK_FIELDS.index(field) + 1 for field in DATE_FIELDS]
+        for row in self.trackRows:
+            track = {field: value for field, value in zip(TRACK_FIELDS, row[1:]) if value is not None}
+            for dateIndex in dateIndices:
+                if row[dateIndex] is not None:
+                    track[TRACK_FIELDS[dateIndex - 1]] = EPOCH + timedelta(seconds = row[dateIndex])
+            yield row[0], track
+
+    def trackRecords(self):
+        """
+        Generates a Track record for each track in the library.
+        """
+        lastPlayed = defaultLastPlayed()
+        indices = [TRACK_FIELDS.index(field) + 1 for field in RECORD_FIELDS]
+        for row in self.trackRows:
+            # Built from the row, rather than a track dictionary, with the defaults of Track.fromProperties.
+            name, artist, location, playCount, playDate, skipCount, skipDate = [row[index] for index in indices]
+            yield Track(row[0], 'Untitled' if name is None else name, 'Unknown' if artist is None else sys.intern(artist), location,
+                        playCount or 0, skipCount or 0,
+                        lastPlayed if playDate is None else int((EPOCH + timedelta(seconds = playDate)).timestamp()),
+                        0 if skipDate is None else EPOCH + timedelta(seconds = skipDate))
+
+    def playlists(self):
+        """
+        Generates each playlist dictionary in the library.
+        """
+        for playlist in self.encodedPlaylists:
+            yield decodePlaylist(playlist)
+
+    def convertURL(self, location):
+        """
+        Returns the Strawberry URL of the track Location, converted when the snapshot was made.
+        """
+        convertedURL = self.convertedURLs.get(location)
+        return convertedURL if convertedURL is not None else convertURL(location)
+
+    def convertURLs(self, locations):
+        return [self.convertURL(location) for location in locations]
+
+def snapshotLibrary(libraryReader):
+    """
+    Reads the whole library, returning a tuple of the header, the track rows and the encoded
+    playlists of its snapshot.
+    """
+    trackRows = []
+    for trackId, track in libraryReader.tracks(TRACK_FIELDS):
+        row = [trackId]
+        for field in TRACK_FIELDS:
+            value = track.get(field)
+            if field in DATE_FIELDS and value is not None:
+                value = int((value - EPOCH).total_seconds())
+            row.append(value)
+        trackRows.append(row)
+    locations = [row[1 + TRACK_FIELDS.index('Location')] for row in trackRows]
+    convertedURLs = libraryReader.convertURLs([location for location in locations if location is not None])
+    convertedURLs.reverse()
+    trackRows = [tuple(row) + (convertedURLs.pop() if location is not None else None,)
+                 for row, location in zip(trackRows, locations)]
+    playlists = [encodePlaylist(playlist) for playlist in libraryReader.playlists()]
+    return libraryReader.header, trackRows, playlists
+
+def writeSnapshot(snapshotPath, fingerprint, header, trackRows, playlists):
+    """
+    Writes the snapshot, replacing any previous snapshot only once it is complete.
+    """
+    temporaryPath = snapshotPath + '.tmp'
+    with open(temporaryPath, 'wb') as snapshotFile:
+        snapshotFile.write(SNAPSHOT_MAGIC)
+        snapshotFile.write(FINGERPRINT.pack(*fingerprint))
+        marshal.dump((encodeValue(header), trackRows, playlists), snapshotFile)
+    os.replace(temporaryPath, snapshotPath)
+
+def readSnapshot(snapshotPath, libraryPath):
+    """
+    Returns the SnapshotReader of the snapshot, or None if there is no snapshot, or it is not
+    of the library as it is now.
+    """
+    try:
+        snapshotFile = open(snapshotPath, 'rb')
+    except OSError:
+        return None
+    fingerprintEnd = len(SNAPSHOT_MAGIC) + FINGERPRINT.size
+    if os.fstat(snapshotFile.fileno()).st_size < fingerprintEnd:
+        snapshotFile.close()
+        moduleLogger.warning(f"{snapshotPath} is not a library snapshot, ignoring it")
+        return None
+    with snapshotFile, mmap.mmap(snapshotFile.fileno(), 0, access = mmap.ACCESS_READ) as snapshotMap:
+        if snapshotMap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            moduleLogger.warning(f"{snapshotPath} is not a library snapshot, ignoring it")
+            return None
+        size, modifiedTime, contentHash = FINGERPRINT.unpack(snapshotMap[len(SNAPSHOT_MAGIC):fingerprintEnd])
+        libraryStat = os.stat(libraryPath)
+        if libraryStat.st_size != size:
+            moduleLogger.info(f"{libraryPath} has changed since the snapshot was made")
+            return None
+        if libraryStat.st_mtime_ns != modifiedTime and hashFile(libraryPath) != contentHash:
+            moduleLogger.info(f"{libraryPath} has changed since the snapshot was made")
+            return None
+        with memoryview(snapshotMap)[fingerprintEnd:] as snapshotView:
+            try:
+                header, trackRows, playlists = marshal.loads(snapshotView)
+            except (EOFError, ValueError, TypeError) as error:
+                moduleLogger.warning(f"Unable to read the snapshot {snapshotPath}, ignoring it: {error}")
+                return None
+    moduleLogger.info(f"Read {len(trackRows)} tracks and {len(playlists)} playlists from the snapshot {snapshotPath}")
+    return SnapshotReader(decodeValue(header), trackRows, playlists)
+
+@contextlib.contextmanager
+def openLibrary(libraryPath, snapshotPath = None, processCount = 1):
+    """
+    Opens the library, returning a reader of its tracks and playlists. Without a snapshotPath,
+    the XML is parsed as it is read by a LibraryReader, or with more than one processCount, by
+    a ParallelLibraryReader. Otherwise the library is read from the snapshot, or if there is
+    none of the library as it is now, the XML is parsed and the snapshot written for later runs.
+    """
+    if snapshotPath is None:
+        if processCount > 1:
+            parallelReader = ParallelLibraryReader(libraryPath, processCount)
+            try:
+                yield parallelReader
+            finally:
+                parallelReader.close()
+        else:
+            with open(libraryPath, 'rb') as libraryFile:
+                yield LibraryReader(libraryFile)
+        return
+    with runStatistics.phase('snapshot_read'):
+        snapshotReader = readSnapshot(snapshotPath, libraryPath)
+    if snapshotReader is None:
+        libraryStat = os.stat(libraryPath)
+        if processCount > 1:
+            parallelReader = ParallelLibraryReader(libraryPath, processCount)
+            try:
+                with runStatistics.phase('xml_parse'):
+                    header, trackRows, playlists = snapshotLibrary(parallelReader)
+            finally:
+                parallelReader.close()
+            contentHash = hashFile(libraryPath)
+        else:
+            with open(libraryPath, 'rb') as libraryFile, runStatistics.phase('xml_parse'):
+                hashingFile = HashingFile(libraryFile)
+                header, trackRows, playlists = snapshotLibrary(LibraryReader(hashingFile))
+                # Hash any content following the end of the property list.
+                while len(hashingFile.read(READ_SIZE)) > 0:
+                    pass
+            contentHash = hashingFile.hasher.digest()
+        try:
+            writeSnapshot(snapshotPath, (libraryStat.st_size, libraryStat.st_mtime_ns, contentHash),
+                          header, trackRows, playlists)
+            moduleLogger.info(f"Wrote the snapshot {snapshotPath} of {libraryPath}")
+        except OSError as error:
+            moduleLogger.warning(f"Unable to write the snapshot {snapshotPath}: {error}")
+        snapshotReader = SnapshotReader(header, trackRows, playlists)
+    yield snapshotReader
@@ -0,0 +1,169 @@
+"""
+Streaming readers of exported listening histories, generating the same Listens as those
+retrieved from ListenBrainz, one at a time, so exports of any size are read in constant memory.
+
+The exports read are ListenBrainz JSON (an array of listens) and JSON lines exports, Last.fm
+JSON exports (arrays of the user.getRecentTracks API pages, or of the tracks within them), and
+the AudioScrobbler .scrobbler.log files written by Rockbox and other portable players.
+"""
+
+import json
+import time
+from datetime import datetime, timezone
+from listenbrainzHistory import Listen, listenFromPayload
+
+# The size of each read of a JSON export.
+READ_SIZE = 1 << 16
+
+def timestampSeconds(timestamp):
+    """
+    Returns the Unix epoch seconds of an export timestamp, which may be seconds or milliseconds,
+    as a number or string, or an ISO 8601 date and time.
+    """
+    if isinstance(timestamp, str) and not timestamp.isdigit():
+        parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo = timezone.utc)
+        return int(parsed.timestamp())
+    seconds = int(timestamp)
+    # Milliseconds since the epoch are too large to be seconds of any plausible date.
+    return seconds // 1000 if seconds > 100000000000 else seconds
+
+def iterateJSONArray(textFile):
+    """
+    Generates each element of the JSON array in the file, decoding them as the file is read,
+    rather than loading the whole array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = textFile.read(READ_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Expected a JSON array")
+    position = 1
+    endOfFile = False
+    while True:
+        # Skip the separators between the elements.
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Incomplete element", buffer, position)
+            element, end = decoder.raw_decode(buffer, position)
+            # A number may continue past the end of what has been read.
+            if end == len(buffer) and not endOfFile:
+                raise json.JSONDecodeError("Incomplete element", buffer, position)
+        except json.JSONDecodeError:
+            if endOfFile:
+                raise
+            moreText = textFile.read(READ_SIZE)
+            endOfFile = len(moreText) == 0
+            buffer = buffer[position:] + moreText
+            position = 0
+            continue
+        yield element
+        position = end
+
+def listenBrainzListens(listenPayloads):
+    """
+    Generates the Listens of ListenBrainz export listens.
+    """
+    for listenPayload in listenPayloads:
+        yield listenFromPayload(dict(listenPayload, listened_at = timestampSeconds(listenPayload['listened_at'])))
+
+def lastfmTrackListen(track):
+    """
+    Returns the Listen of a Last.fm scrobbled track, or None if the track is being played now,
+    rather than having been scrobbled.
+    """
+    artist = track.get('artist', '')
+    if isinstance(artist, dict):
+        artist = artist.get('#text') or artist.get('name', '')
+    date = track.get('date', track.get('uts', track.get('timestamp')))
+    if isinstance(date, dict):
+        date = date.get('uts')
+    if date is None:
+        return None
+    trackName = track.get('name', track.get('track', ''))
+    listenedAt = timestampSeconds(date)
+    return Listen(artist, trackName, listenedAt, track.get('mbid') or f"{artist}\t{trackName}")
+
+def lastfmListens(elements):
+    """
+    Generates the Listens of a Last.fm export, of either user.getRecentTracks pages, or tracks.
+    """
+    for element in elements:
+        if 'recenttracks' in element:
+            tracks = element['recenttracks'].get('track', [])
+            # A page of a single track is not in a list.
+            for track in (tracks if isinstance(tracks, list) else [tracks]):
+                listen = lastfmTrackListen(track)
+                if listen is not None:
+                    yield listen
+        else:
+            listen = lastfmTrackListen(element)
+            if listen is not None:
+                yield listen
+
+def jsonExportListens(elements):
+    """
+    Generates the Listens of the elements of a ListenBrainz or Last.fm JSON export, identifying
+    the export by the form of each element.
+    """
+    for element in elements:
+        if 'track_metadata' in element:
+            yield from listenBrainzListens([element])
+        else:
+            yield from lastfmListens([element])
+
+def scrobblerLogListens(logFile):
+    """
+    Generates the Listens of the tracks listened to in an AudioScrobbler .scrobbler.log file.
+    Each line is the tab separated artist, album, title, track number, duration, rating,
+    timestamp and MusicBrainz track id. Skipped tracks, rated S rather than L, are ignored.
+    """
+    localTime = True
+    for line in logFile:
+        line = line.rstrip('\r\n')
+        if line.startswith('#'):
+            if line.startswith('#TZ/'):
+                localTime = line != '#TZ/UTC'
+            continue
+        fields = line.split('\t')
+        if len(fields) < 7 or fields[5] != 'L':
+            continue
+        listenedAt = int(fields[6])
+        if localTime:
+            # The timestamp is the player's local time counted as if UTC, so its fields, read by
+            # gmtime, are local time, converted by mktime in the time zone here, taken as the player's.
+            listenedAt = int(time.mktime(time.gmtime(listenedAt)))
+        recording = fields[7] if len(fields) > 7 and len(fields[7]) > 0 else f"{fields[0]}\t{fields[2]}"
+        yield Listen(fields[0], fields[2], listenedAt, recording)
+
+def isJSONLine(line):
+    """
+    Returns True if the line is a complete JSON object.
+    """
+    try:
+        return isinstance(json.loads(line), dict)
+    except json.JSONDecodeError:
+        return False
+
+def exportListens(exportPath):
+    """
+    Generates the Listens of an exported listening history, identifying the form of the export
+    from its content.
+    """
+    with open(exportPath, encoding = 'utf-8', errors = 'replace') as exportFile:
+        firstLine = exportFile.readline()
+        exportFile.seek(0)
+        if firstLine.startswith('#AUDIOSCROBBLER'):
+            yield from scrobblerLogListens(exportFile)
+        elif firstLine.lstrip().startswith('['):
+            yield from jsonExportListens(iterateJSONArray(exportFile))
+        elif isJSONLine(firstLine):
+            # JSON lines, of a listen on each line.
+            yield from jsonExportListens(json.loads(line) for line in exportFile if len(line.strip()) > 0)
+        else:
+            # A single Last.fm page, rather than an array of them.
+            yield from jsonExportListens([json.load(exportFile)])
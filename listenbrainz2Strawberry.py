@@ -2,13 +2,28 @@
 """
 Updates the Strawberry music player SQLite database, with the play counts, and the last
 played date and time from a nominated ListenBrainz account.
+
+The listens are retrieved into a local cache, so each run only retrieves the listens since
+the last run, and the plays are then updated from only those listens.
 """
 
 import logging
 import argparse
 import sqlite3
-import pylistenbrainz
 import time
+import json
+import re
+import unicodedata
+from strawberryDatabase import executeUpdate
+from runStatistics import runStatistics
+from liveDatabase import databaseToUpdate
+from listenExports import exportListens
+from listenbrainzHistory import LISTENBRAINZ_API_URL, MAX_LISTENS_PER_PAGE, ListenBrainzPages, ListenCache, ReplayServer, syncListens
+
+appLogger = logging.getLogger("listenbrainz2strawberry")
+
+# Separates the artists named in a multiple artist name.
+artist_separators = re.compile(r"\s*(?:[,;/&+]|\b(?:and|feat|ft|featuring|with|vs)\b\.?)\s*", re.IGNORECASE)
 
 def sql_encode(string):
     """
@@ -16,70 +31,149 @@ def sql_encode(string):
     """
     return string.replace("'", "''")
 
-def get_track_from_strawberry(cursor, listen):
+def normalise_name(name):
+    """
+    Returns the artist or track name case folded, with punctuation and spacing removed, so
+    names which differ only in those match.
+    """
+    return ''.join(character for character in unicodedata.normalize('NFKC', name or '').casefold() if character.isalnum())
+
+def artist_parts_key(artist_name):
+    """
+    Returns the normalised names of each artist of a multiple artist name, sorted so the key is
+    independent of the order the artists were named in, or None for a single artist.
+    """
+    artist_parts = [normalise_name(part) for part in artist_separators.split(artist_name or '')]
+    artist_parts = sorted(part for part in artist_parts if len(part) > 0)
+    return '\t'.join(artist_parts) if len(artist_parts) > 1 else None
+
+def load_track_index(cursor):
+    """
+    Reads the songs table once, returning a tuple of dictionaries of the tracks, keyed by the
+    (artist, title) names matched in order of preference: case folded, then normalised, then
+    normalised with the artists of a multiple artist name in any order.
+    """
+    find_tracks = "SELECT url, artist, title, playcount, lastplayed FROM songs ORDER BY rowid"
+    appLogger.debug(find_tracks)
+    cursor.execute(find_tracks)
+    case_folded_index = dict()
+    normalised_index = dict()
+    artist_parts_index = dict()
+    for row in cursor.fetchall():
+        track = {
+            'url': row[0],
+            'playcount': row[3],
+            'lastplayed': row[4]
+        }
+        # As with the search of the database, the last matching track is used.
+        case_folded_index[((row[1] or '').casefold(), (row[2] or '').casefold())] = track
+        title_key = normalise_name(row[2])
+        normalised_index[(normalise_name(row[1]), title_key)] = track
+        parts_key = artist_parts_key(row[1])
+        if parts_key is not None:
+            artist_parts_index[(parts_key, title_key)] = track
+    appLogger.info(f"Indexed {len(case_folded_index)} tracks")
+    return case_folded_index, normalised_index, artist_parts_index
+
+def get_track_from_strawberry(track_index, listen):
     """
     Returns the object of the track in the strawberry database, matching the listened
     object. Returns None if unable to find it.
     """
     # Search on the track name and the artist name. We need to do it in a case insensitive
     # manner, since the track and artists strings can often differ in capitalisation
-    # compared between Strawberry and Listenbrainz.
-    find_track = f"SELECT url, playcount, lastplayed FROM songs WHERE artist = '{sql_encode(listen.artist_name)}' COLLATE NOCASE AND title = '{sql_encode(listen.track_name)}' COLLATE NOCASE"
-    appLogger.debug(find_track)
-    cursor.execute(find_track)
-    found_track = None
-    for row in cursor.fetchall():
-        found_track = {
-            'url': row[0],
-            'playcount': row[1],
-            'lastplayed': row[2]
-        }
-    return found_track
+    # compared between Strawberry and Listenbrainz, as can punctuation and the order of
+    # multiple artists.
+    case_folded_index, normalised_index, artist_parts_index = track_index
+    found_track = case_folded_index.get(((listen.artist_name or '').casefold(), (listen.track_name or '').casefold()))
+    match_method = 'matched_artist_title'
+    if found_track is None:
+        title_key = normalise_name(listen.track_name)
+        found_track = normalised_index.get((normalise_name(listen.artist_name), title_key))
+        match_method = 'matched_normalised_artist_title'
+        parts_key = artist_parts_key(listen.artist_name)
+        if found_track is None and parts_key is not None:
+            found_track = artist_parts_index.get((parts_key, title_key))
+            match_method = 'matched_artist_parts_title'
+    runStatistics.count(match_method if found_track is not None else 'unmatched')
+    # The caller updates the track found, so the index remains that of the database.
+    return dict(found_track) if found_track is not None else None
 
 def get_updated_plays(cursor, listens):
     """
     Returns dictionary (keyed by strawberry file URL) of play counts and last played
     times for tracks in the listens which are newer than that in the strawberry database.
+    The listens may be in any order.
     """
     updated_plays = dict()
-    for listen in listens:
-        appLogger.info(f"Track name: {listen.track_name}")
-        appLogger.info(f"Artist name: {listen.artist_name}")
-        appLogger.info(f"At: {time.ctime(listen.listened_at)}")
-        #appLogger.debug(f"From: {listen.listening_from}")
-        strawberry_track = get_track_from_strawberry(cursor, listen)
-        if strawberry_track is not None:
-            # Check if we should increment the play count, if the last_played timestamp is
-            # greater than the strawberry track's last played timestamp.
-            appLogger.info("In Strawberry database last played {}".format(time.ctime(strawberry_track['lastplayed'])))
-            if listen.listened_at > strawberry_track['lastplayed']: # Needs better fuzzy match.
-                # The updated plays are indexed by the strawberry track URL.
-                if strawberry_track['url'] not in updated_plays:
-                    # Update the play count and the last played time.
-                    strawberry_track['lastplayed'] = listen.listened_at
-                    strawberry_track['playcount'] += 1
-                    updated_plays[strawberry_track['url']] = strawberry_track
-                else:
-                    updated_plays[strawberry_track['url']]['playcount'] += 1
-        else:
-            appLogger.warning(f"Track '{listen.track_name}' by '{listen.artist_name}' not in Strawberry database?")
+    log_listens = appLogger.isEnabledFor(logging.INFO)
+    with runStatistics.phase('matching'):
+        track_index = load_track_index(cursor)
+        for listen in runStatistics.timed('listen_read', listens):
+            if log_listens:
+                appLogger.info("Track name: %s", listen.track_name)
+                appLogger.info("Artist name: %s", listen.artist_name)
+                appLogger.info("At: %s", time.ctime(listen.listened_at))
+            #appLogger.debug(f"From: {listen.listening_from}")
+            strawberry_track = get_track_from_strawberry(track_index, listen)
+            if strawberry_track is not None:
+                # Check if we should increment the play count, if the last_played timestamp is
+                # greater than the strawberry track's last played timestamp.
+                if log_listens:
+                    appLogger.info("In Strawberry database last played %s", time.ctime(strawberry_track['lastplayed']))
+                if listen.listened_at > strawberry_track['lastplayed']: # Needs better fuzzy match.
+                    # The updated plays are indexed by the strawberry track URL.
+                    if strawberry_track['url'] not in updated_plays:
+                        # Update the play count and the last played time.
+                        strawberry_track['lastplayed'] = listen.listened_at
+                        strawberry_track['playcount'] += 1
+                        updated_plays[strawberry_track['url']] = strawberry_track
+                    else:
+                        updated_track = updated_plays[strawberry_track['url']]
+                        updated_track['playcount'] += 1
+                        updated_track['lastplayed'] = max(updated_track['lastplayed'], listen.listened_at)
+            else:
+                appLogger.warning("Track '%s' by '%s' not in Strawberry database?", listen.track_name, listen.artist_name)
     return updated_plays
                     
+def exported_listens(export_paths, min_ts = None, max_ts = None):
+    """
+    Generates the listens of each exported listening history file, listened after min_ts and
+    before max_ts.
+    """
+    for export_path in export_paths:
+        appLogger.info(f"Reading listens from {export_path}")
+        for listen in exportListens(export_path):
+            if (min_ts is None or listen.listened_at > min_ts) and (max_ts is None or listen.listened_at < max_ts):
+                yield listen
+
+def sync_cached_listens(listen_cache, pages, user, min_ts = None, max_ts = None):
+    """
+    Retrieves the listens of the user into the listen cache, then generates the cached listens
+    to apply: those listened after min_ts, or if it is None, after the high water mark of the
+    previous run, whose listens have been applied already, and before max_ts.
+    """
+    previous_mark = listen_cache.highWaterMark(user)
+    retrieved_count, added_count = syncListens(listen_cache, pages, user, min_ts, max_ts)
+    runStatistics.count('listens_retrieved', retrieved_count)
+    runStatistics.count('listens_added', added_count)
+    appLogger.info(f"Retrieved {retrieved_count} listens, {added_count} not previously retrieved")
+    return listen_cache.listens(user, min_ts if min_ts is not None else previous_mark, max_ts)
+
 def update_database(cursor, updated_plays):
     """
     Updates the Strawberry database with the new play counts and last played timestamps
     for tracks that were determined to be newer than those already in the database.
     """
     update_count = 0
+    log_updates = appLogger.isEnabledFor(logging.INFO)
     for track_url, track_plays in updated_plays.items():
-        appLogger.info(f"Update {track_url} with {track_plays['playcount']} plays most recently at {time.ctime(track_plays['lastplayed'])}")
+        if log_updates:
+            appLogger.info("Update %s with %s plays most recently at %s", track_url, track_plays['playcount'], time.ctime(track_plays['lastplayed']))
         update_plays = f"UPDATE songs SET playcount = {track_plays['playcount']}, lastplayed = {track_plays['lastplayed']} WHERE url = '{sql_encode(track_url)}'"
         appLogger.debug(update_plays)
-        cursor.execute(update_plays)
         # Determine if the field was updated.
-        cursor.execute('SELECT changes() FROM songs')
-        result = cursor.fetchone()
-        update_count += int(result[0] > 0)
+        update_count += int(executeUpdate(cursor, update_plays) > 0)
     return update_count
         
 if __name__ == '__main__':
@@ -87,35 +181,78 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
     parser.add_argument('-s', '--strawberry', action = 'store', help = 'Path to the Strawberry database file.', type = str, default = 'strawberry.db')
     parser.add_argument('-b', '--before', action  = 'store', help = 'Retrieve listens before the given date & time', default = None)
-    parser.add_argument('user', action = 'store', help = 'The ListenBrainz user', default = '')
+    parser.add_argument('-a', '--after', action  = 'store', help = 'Retrieve listens after the given date & time, rather than those since the last run', default = None)
+    parser.add_argument('-c', '--cache', action = 'store', help = 'Path to the cache of retrieved listens. Defaults to %(default)s.', type = str, default = 'listenbrainz_cache.db')
+    parser.add_argument('--page-size', action = 'store', help = 'The number of listens retrieved in each request. Defaults to %(default)s.', type = int, default = MAX_LISTENS_PER_PAGE)
+    parser.add_argument('--api-url', action = 'store', help = 'The ListenBrainz API URL. Defaults to %(default)s.', type = str, default = LISTENBRAINZ_API_URL)
+    parser.add_argument('--record', action = 'store', help = 'Record the ListenBrainz responses to the file, for use with --replay.', type = str, default = None)
+    parser.add_argument('--replay', action = 'store', help = 'Test against a local server replaying the ListenBrainz responses recorded in the file.', type = str, default = None)
+    parser.add_argument('-i', '--import', action = 'append', dest = 'imports', metavar = 'EXPORT', default = [],
+                        help = 'Update from an exported ListenBrainz JSON or JSON lines, Last.fm JSON, or .scrobbler.log file, rather than from ListenBrainz. May be repeated.')
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended.')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of listens matched by each method, as JSON to the file, or standard output.')
+    parser.add_argument('user', action = 'store', nargs = '?', help = 'The ListenBrainz user', default = None)
     args = parser.parse_args()
+    if len(args.imports) == 0 and args.user is None:
+        parser.error('The ListenBrainz user is required, unless using --import')
 
-    # We set the logging value here so it's available to the core and master nodes.
-    appLogger = logging.getLogger("listenbrainz2strawberry")
     logging.basicConfig()
 
     if args.verbose > 1:
         appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("listenbrainzHistory").setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
     elif args.verbose > 0:
         appLogger.setLevel(logging.INFO)
+        logging.getLogger("listenbrainzHistory").setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
+
+    if args.stats is not None:
+        runStatistics.enable()
 
-    sqlClient = sqlite3.connect(args.strawberry)
-    strawberry_db_cursor = sqlClient.cursor()
     listenbrainz_user = args.user
     # Determine the Unix epoch time from the human readable local timezone time.
     max_ts = int(time.mktime(time.strptime(args.before))) if args.before is not None else None
-    appLogger.debug(f"Maximum timestamp {max_ts}")
+    min_ts = int(time.mktime(time.strptime(args.after))) if args.after is not None else None
+    appLogger.debug(f"Maximum timestamp {max_ts} minimum timestamp {min_ts}")
+
+    with databaseToUpdate(args.strawberry, args.live) as databasePath:
+        sqlClient = sqlite3.connect(databasePath)
+        strawberry_db_cursor = sqlClient.cursor()
+
+        if len(args.imports) > 0:
+            listens = exported_listens(args.imports, min_ts, max_ts)
+            updated_plays = get_updated_plays(strawberry_db_cursor, listens)
+        else:
+            listen_cache = ListenCache(args.cache)
+            recording = dict() if args.record is not None else None
+            if args.replay is not None:
+                with open(args.replay) as replay_file:
+                    replay_server = ReplayServer(json.load(replay_file))
+                with replay_server, runStatistics.phase('retrieval'):
+                    pages = ListenBrainzPages(replay_server.apiURL, args.page_size, recording)
+                    listens = sync_cached_listens(listen_cache, pages, listenbrainz_user, min_ts, max_ts)
+            else:
+                with runStatistics.phase('retrieval'):
+                    pages = ListenBrainzPages(args.api_url, args.page_size, recording)
+                    listens = sync_cached_listens(listen_cache, pages, listenbrainz_user, min_ts, max_ts)
+            if recording is not None:
+                with open(args.record, 'w') as record_file:
+                    json.dump(recording, record_file)
 
-    client = pylistenbrainz.ListenBrainz()
-    listens = client.get_listens(username=listenbrainz_user, max_ts=max_ts, count=100)
-    updated_plays = get_updated_plays(strawberry_db_cursor, listens)
-    # Now update the playcounts and last played using the dictionary
-    update_count = update_database(strawberry_db_cursor, updated_plays)
+            updated_plays = get_updated_plays(strawberry_db_cursor, listens)
+            listen_cache.close()
+        # Now update the playcounts and last played using the dictionary
+        update_count = update_database(strawberry_db_cursor, updated_plays)
 
-    # Save (commit) the changes
-    appLogger.info(f"Updated {update_count} tracks")
-    if update_count > 0:
         # Save (commit) the changes
-        sqlClient.commit()
+        appLogger.info(f"Updated {update_count} tracks")
+        if update_count > 0:
+            # Save (commit) the changes
+            with runStatistics.phase('commit'):
+                sqlClient.commit()
 
-    sqlClient.close()
+        sqlClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
@@ -0,0 +1,223 @@
+"""
+Retrieval of the listening history of a ListenBrainz account, page by page, with a local cache
+of the listens retrieved, so later runs only retrieve listens newer than those already cached.
+
+The responses of the ListenBrainz API can be recorded to a file, and served again by a local
+stand-in HTTP server, so a retrieval can be repeated without the network.
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LISTENBRAINZ_API_URL = 'https://api.listenbrainz.org'
+
+# The most listens ListenBrainz returns in a single request.
+MAX_LISTENS_PER_PAGE = 1000
+
+# The number of times a request refused by the rate limit is retried.
+RATE_LIMIT_RETRIES = 5
+
+moduleLogger = logging.getLogger("listenbrainzHistory")
+
+# A single play of a track. The recording identifies the track played, so a listen is unique
+# by its recording and listened_at time.
+Listen = collections.namedtuple('Listen', ('artist_name', 'track_name', 'listened_at', 'recording'))
+
+def listenFromPayload(listenPayload):
+    """
+    Returns the Listen of a listen in a ListenBrainz API or export JSON payload.
+    """
+    trackMetadata = listenPayload.get('track_metadata', {})
+    additionalInfo = trackMetadata.get('additional_info') or {}
+    artistName = trackMetadata.get('artist_name', '')
+    trackName = trackMetadata.get('track_name', '')
+    recording = (listenPayload.get('recording_msid') or additionalInfo.get('recording_msid')
+                 or additionalInfo.get('recording_mbid') or f"{artistName}\t{trackName}")
+    return Listen(artistName, trackName, int(listenPayload['listened_at']), recording)
+
+class ListenBrainzPages:
+    """
+    Retrieves the listens of a ListenBrainz user, newest first, a page at a time.
+
+    Requests may be recorded, so that a ReplayServer can serve the same responses later.
+    """
+
+    def __init__(self, apiURL = LISTENBRAINZ_API_URL, pageSize = MAX_LISTENS_PER_PAGE, recording = None):
+        self.apiURL = apiURL.rstrip('/')
+        self.pageSize = min(pageSize, MAX_LISTENS_PER_PAGE)
+        # Dictionary of the responses, keyed by the request path and query, or None to not record.
+        self.recording = recording
+        self.complete = False
+
+    def request(self, path, query):
+        """
+        Returns the decoded JSON response of the API request, waiting and retrying if the rate
+        limit has been reached.
+        """
+        pathQuery = f"{path}?{urllib.parse.urlencode(query)}"
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                with urllib.request.urlopen(self.apiURL + pathQuery) as response:
+                    body = response.read()
+                    break
+            except urllib.error.HTTPError as error:
+                if error.code != 429 or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                resetIn = int(error.headers.get('X-RateLimit-Reset-In', 1))
+                moduleLogger.warning(f"Rate limited by ListenBrainz, waiting {resetIn} seconds")
+                time.sleep(resetIn)
+        decoded = json.loads(body)
+        if self.recording is not None:
+            self.recording[pathQuery] = decoded
+        return decoded
+
+    def pages(self, user, minTs = None, maxTs = None):
+        """
+        Generates lists of the Listens of the user listened after minTs and before maxTs, newest
+        first, one list for each page retrieved. complete is True once every page has been read.
+        """
+        self.complete = False
+        path = f"/1/user/{urllib.parse.quote(user)}/listens"
+        while True:
+            # ListenBrainz does not accept both a min_ts and max_ts, so the pages are retrieved
+            # back in time from the maxTs until reaching the minTs.
+            query = {'count': self.pageSize}
+            if maxTs is not None:
+                query['max_ts'] = maxTs
+            listens = [listenFromPayload(listenPayload)
+                       for listenPayload in self.request(path, query)['payload']['listens']]
+            if len(listens) == 0:
+                break
+            oldest = min(listen.listened_at for listen in listens)
+            if minTs is not None:
+                listens = [listen for listen in listens if listen.listened_at > minTs]
+            if len(listens) > 0:
+                yield listens
+            # The max_ts is exclusive, so retrieve the oldest second again, in case the page ended
+            # part way through the listens within it, unless the whole page was within it.
+            nextMaxTs = oldest + 1 if maxTs is None or oldest + 1 < maxTs else oldest
+            if minTs is not None and nextMaxTs <= minTs + 1:
+                break
+            maxTs = nextMaxTs
+        self.complete = True
+
+class ListenCache:
+    """
+    A SQLite database of the listens retrieved of each user, with the high water mark, the
+    time of the newest listen retrieved by a complete retrieval of the latest listens.
+    Listens are unique by user, recording and listened_at time, so adding them again does
+    nothing.
+    """
+
+    def __init__(self, cachePath):
+        self.client = sqlite3.connect(cachePath)
+        self.client.execute("""CREATE TABLE IF NOT EXISTS listens (user TEXT NOT NULL, recording TEXT NOT NULL,
+            listened_at INTEGER NOT NULL, artist_name TEXT, track_name TEXT, PRIMARY KEY (user, recording, listened_at))""")
+        self.client.execute("CREATE INDEX IF NOT EXISTS listens_listened_at ON listens (user, listened_at)")
+        self.client.execute("CREATE TABLE IF NOT EXISTS sync (user TEXT PRIMARY KEY, high_water_mark INTEGER NOT NULL)")
+        self.client.commit()
+
+    def highWaterMark(self, user):
+        """
+        Returns the time of the newest listen of the user from the last complete retrieval, or
+        None if the latest listens have never been retrieved.
+        """
+        row = self.client.execute("SELECT high_water_mark FROM sync WHERE user = ?", (user,)).fetchone()
+        return row[0] if row is not None else None
+
+    def setHighWaterMark(self, user, highWaterMark):
+        self.client.execute("INSERT OR REPLACE INTO sync (user, high_water_mark) VALUES (?, ?)", (user, highWaterMark))
+        self.client.commit()
+
+    def addListens(self, user, listens):
+        """
+        Adds the listens of the user not already in the cache.
+        Returns the number of listens added.
+        """
+        before = self.client.total_changes
+        self.client.executemany("INSERT OR IGNORE INTO listens (user, recording, listened_at, artist_name, track_name) VALUES (?, ?, ?, ?, ?)",
+                                ((user, listen.recording, listen.listened_at, listen.artist_name, listen.track_name) for listen in listens))
+        self.client.commit()
+        return self.client.total_changes - before
+
+    def listens(self, user, minTs = None, maxTs = None):
+        """
+        Generates the cached Listens of the user listened after minTs and before maxTs, newest first.
+        """
+        findListens = "SELECT artist_name, track_name, listened_at, recording FROM listens WHERE user = ? AND listened_at > ? AND listened_at < ? ORDER BY listened_at DESC"
+        parameters = (user, minTs if minTs is not None else -1, maxTs if maxTs is not None else 2**62)
+        for row in self.client.execute(findListens, parameters):
+            yield Listen(*row)
+
+    def close(self):
+        self.client.close()
+
+def syncListens(listenCache, listenBrainzPages, user, minTs = None, maxTs = None):
+    """
+    Retrieves the listens of the user after minTs and before maxTs, or if minTs is None, after
+    the high water mark, into the cache. The high water mark is advanced once the latest listens
+    have been completely retrieved.
+    Returns the tuple of the number of listens retrieved and the number added to the cache.
+    """
+    highWaterMark = listenCache.highWaterMark(user)
+    fetchMinTs = minTs if minTs is not None else highWaterMark
+    retrievedCount = 0
+    addedCount = 0
+    newest = None
+    for listens in listenBrainzPages.pages(user, fetchMinTs, maxTs):
+        retrievedCount += len(listens)
+        addedCount += listenCache.addListens(user, listens)
+        pageNewest = max(listen.listened_at for listen in listens)
+        newest = pageNewest if newest is None else max(newest, pageNewest)
+        moduleLogger.info(f"Retrieved {retrievedCount} listens, back to {time.ctime(min(listen.listened_at for listen in listens))}")
+    # Only a complete retrieval of the latest listens, which reaches the high water mark, can advance it.
+    reachedMark = highWaterMark is None or fetchMinTs is None or fetchMinTs <= highWaterMark
+    if listenBrainzPages.complete and maxTs is None and reachedMark and newest is not None:
+        listenCache.setHighWaterMark(user, max(newest, highWaterMark or newest))
+    return retrievedCount, addedCount
+
+class ReplayServer:
+    """
+    A local stand-in for the ListenBrainz API, serving the responses recorded by
+    ListenBrainzPages, keyed by the request path and query, from a background thread.
+    Requests which were not recorded are answered with an empty page of listens.
+    """
+
+    def __init__(self, recording):
+        recorded = recording
+
+        class ReplayHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                response = recorded.get(self.path, {'payload': {'count': 0, 'listens': []}})
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                moduleLogger.debug(format % args)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+
+    @property
+    def apiURL(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.server.shutdown()
+        self.server.server_close()
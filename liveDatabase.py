@@ -0,0 +1,220 @@
+"""
+Updating a Strawberry database in place, while Strawberry may still have it open, rather than
+copying it aside and back.
+
+A consistent snapshot of the database is taken with SQLite's online backup API, which copies it
+a number of pages at a time, releasing its lock between steps, and starting again if the database
+is written meanwhile. The snapshot is written alongside the database, and updated in its place.
+The updated snapshot is then checked with an integrity check, and the row counts of its tables
+compared with those of the database, before it atomically replaces the database by renaming it.
+The database as it was is kept as the rollback file, and may be renamed back to undo the update.
+
+The database is locked against writers while it is checked for changes made since the snapshot
+was taken, and replaced, so an update is never swapped over changes made by Strawberry. A
+Strawberry left running keeps the database it opened, which is now the rollback file, so it
+should be restarted to see the update.
+"""
+
+import os
+import shutil
+import struct
+import sqlite3
+import logging
+import contextlib
+from urllib.request import pathname2url
+from runStatistics import runStatistics
+from pipeline import BUSY_TIMEOUT
+
+SNAPSHOT_SUFFIX = '.live'
+ROLLBACK_SUFFIX = '.rollback'
+# The pages copied in each step of the backup, between which the database is unlocked.
+PAGES_PER_STEP = 1024
+# The tables the utilities update, but never add rows to or remove rows from.
+FIXED_TABLES = ('songs',)
+# The file change counter in the database header.
+CHANGE_COUNTER_OFFSET = 24
+CHANGE_COUNTER = struct.Struct('>I')
+
+moduleLogger = logging.getLogger("liveDatabase")
+
+class LiveDatabaseError(Exception):
+    """
+    Raised when an updated snapshot can not safely replace the database.
+    """
+
+def fileChangeCounter(path):
+    """
+    Returns the file change counter of the SQLite database header, which each transaction
+    committed to a database not using a write-ahead log increments.
+    """
+    with open(path, 'rb') as databaseFile:
+        databaseFile.seek(CHANGE_COUNTER_OFFSET)
+        changeCounter = databaseFile.read(CHANGE_COUNTER.size)
+    # An empty database has no header.
+    return CHANGE_COUNTER.unpack(changeCounter)[0] if len(changeCounter) == CHANGE_COUNTER.size else 0
+
+def removeFile(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+def tableRowCounts(cursor):
+    """
+    Returns a dictionary of the number of rows of each table of the database, other than the
+    virtual tables and those of SQLite itself.
+    """
+    cursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+                      AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'""")
+    tables = [row[0] for row in cursor.fetchall()]
+    return {table: cursor.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+def databaseToUpdate(databasePath, live):
+    """
+    Returns a context manager of the path of the database to update: the database itself, or if
+    live, a LiveDatabase snapshot of it, which replaces the database at the end of the block.
+    """
+    return LiveDatabase(databasePath) if live else contextlib.nullcontext(databasePath)
+
+class LiveDatabase:
+    """
+    A snapshot of a database, which may be open in Strawberry, to be updated in its place, then
+    checked and swapped for the database.
+
+    As a context manager, it takes the snapshot on entry, returning its path, and on exit replaces
+    the database with the updated snapshot, or if the block raised an exception, removes it,
+    leaving the database as it was.
+    """
+
+    def __init__(self, databasePath, pagesPerStep = PAGES_PER_STEP):
+        self.databasePath = databasePath
+        self.snapshotPath = databasePath + SNAPSHOT_SUFFIX
+        self.rollbackPath = databasePath + ROLLBACK_SUFFIX
+        self.pagesPerStep = pagesPerStep
+        # The connection to the database, held from the snapshot until it is replaced, so its
+        # data version shows whether another connection has written to it.
+        self.connection = None
+
+    def __enter__(self):
+        return self.snapshot()
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if exceptionType is None:
+            self.replace()
+        else:
+            self.discard()
+        return False
+
+    def snapshot(self):
+        """
+        Takes a snapshot of the database, returning the path of the snapshot to be updated.
+        """
+        databaseURI = 'file:' + pathname2url(os.path.abspath(self.databasePath)) + '?mode=rw'
+        self.connection = sqlite3.connect(databaseURI, uri = True, timeout = BUSY_TIMEOUT, isolation_level = None)
+        journalMode = self.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        if journalMode.lower() == 'wal':
+            self.close()
+            # The write-ahead log of the database would be paired with the database replacing it.
+            raise LiveDatabaseError(f"{self.databasePath} uses a write-ahead log, so can not be replaced while it is open. Quit Strawberry and update it without --live")
+        removeFile(self.snapshotPath)
+
+        def progress(status, remaining, total):
+            moduleLogger.debug(f"Copied {total - remaining} of {total} pages of {self.databasePath}")
+
+        try:
+            with runStatistics.phase('snapshot'):
+                snapshotClient = sqlite3.connect(self.snapshotPath)
+                try:
+                    self.connection.backup(snapshotClient, pages = self.pagesPerStep, progress = progress)
+                    self.rowCounts = tableRowCounts(snapshotClient.cursor())
+                finally:
+                    snapshotClient.close()
+        except BaseException:
+            # A partial snapshot is of no use.
+            self.discard()
+            raise
+        self.dataVersion = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        self.snapshotChangeCounter = fileChangeCounter(self.snapshotPath)
+        moduleLogger.info(f"Took the snapshot {self.snapshotPath} of {self.databasePath}")
+        return self.snapshotPath
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def discard(self):
+        """
+        Removes the snapshot, and any journal of an update left uncommitted, leaving the database
+        as it was.
+        """
+        self.close()
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            removeFile(self.snapshotPath + suffix)
+        moduleLogger.info(f"Removed the snapshot {self.snapshotPath}, leaving {self.databasePath} as it was")
+
+    def checkSnapshot(self, fixedTables):
+        """
+        Raises LiveDatabaseError if the updated snapshot fails the integrity check, has lost a
+        table, or has rows added to or removed from one of the fixedTables. Logs the change in the
+        number of rows of each table.
+        """
+        for suffix in ('-journal', '-wal'):
+            journalPath = self.snapshotPath + suffix
+            if os.path.exists(journalPath) and os.path.getsize(journalPath) > 0:
+                raise LiveDatabaseError(f"The snapshot {self.snapshotPath} has an uncommitted journal {journalPath}")
+        with runStatistics.phase('integrity_check'):
+            snapshotClient = sqlite3.connect(self.snapshotPath)
+            try:
+                cursor = snapshotClient.cursor()
+                problems = [row[0] for row in cursor.execute("PRAGMA integrity_check").fetchall()]
+                rowCounts = tableRowCounts(cursor)
+            finally:
+                snapshotClient.close()
+        if problems != ['ok']:
+            raise LiveDatabaseError(f"The updated snapshot {self.snapshotPath} failed the integrity check: {'; '.join(problems)}")
+        for table in sorted(self.rowCounts.keys() | rowCounts.keys()):
+            before = self.rowCounts.get(table)
+            after = rowCounts.get(table)
+            if after is None:
+                raise LiveDatabaseError(f"The table {table} is missing from the updated snapshot {self.snapshotPath}")
+            if before is None:
+                moduleLogger.info(f"Added the table {table} of {after} rows")
+            elif after != before:
+                if table in fixedTables:
+                    raise LiveDatabaseError(f"The table {table} of the updated snapshot {self.snapshotPath} has {after} rows, rather than {before}")
+                moduleLogger.info(f"The table {table} has {after} rows, {after - before:+d} rows")
+            else:
+                moduleLogger.debug(f"The table {table} has {after} rows, as before")
+
+    def replace(self, fixedTables = FIXED_TABLES):
+        """
+        Checks the updated snapshot, and atomically replaces the database with it, keeping the
+        database as it was as the rollback file. Returns True if the database was replaced, or
+        False if no changes were committed to the snapshot, and so it was removed. Raises
+        LiveDatabaseError, leaving the database and snapshot as they are, if the snapshot fails
+        the checks, or the database was written since the snapshot was taken.
+        """
+        try:
+            if fileChangeCounter(self.snapshotPath) == self.snapshotChangeCounter:
+                moduleLogger.info(f"The snapshot {self.snapshotPath} was not changed, leaving {self.databasePath} as it was")
+                removeFile(self.snapshotPath)
+                return False
+            self.checkSnapshot(fixedTables)
+            with runStatistics.phase('swap'):
+                # Holding the reserved lock keeps writers out until the database has been replaced.
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    if self.connection.execute("PRAGMA data_version").fetchone()[0] != self.dataVersion:
+                        raise LiveDatabaseError(f"{self.databasePath} was written while the snapshot {self.snapshotPath} was being updated. Quit Strawberry and run again")
+                    removeFile(self.rollbackPath)
+                    try:
+                        os.link(self.databasePath, self.rollbackPath)
+                    except OSError:
+                        # A file system without hard links.
+                        shutil.copy2(self.databasePath, self.rollbackPath)
+                    os.replace(self.snapshotPath, self.databasePath)
+                finally:
+                    self.connection.execute("ROLLBACK")
+            moduleLogger.info(f"Replaced {self.databasePath} with the updated snapshot, keeping the database as it was as {self.rollbackPath}")
+            return True
+        finally:
+            self.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Merges the play and skip counts, and last played date and time, from any number of Strawberry
+databases and iTunes exported library XML files, updating a single Strawberry database.
+"""
+
+import logging
+import argparse
+import sqlite3
+import itertools
+from strawberryDatabase import executeUpdate
+from pipeline import connectReadOnly
+from urlConversion import convertURL
+from iTunesLibrary import LibraryReader
+from liveDatabase import databaseToUpdate
+from urlRewriting import URLRewriter
+from runStatistics import runStatistics
+
+# How the counts of a source are combined with those of the sources before it.
+COMBINE_POLICIES = ('sum', 'max')
+# The header which starts every SQLite database file.
+SQLITE_HEADER = b'SQLite format 3\0'
+
+appLogger = logging.getLogger("mergePlayStatistics")
+
+class AppendSource(argparse.Action):
+    """
+    Collects the sources in the order given on the command line, with the combining policy of
+    the option used to name them.
+    """
+    def __call__(self, parser, namespace, values, option_string = None):
+        sources = getattr(namespace, self.dest) or []
+        sources.append((self.const, values))
+        setattr(namespace, self.dest, sources)
+
+def isLibraryXML(sourcePath):
+    """
+    Returns True if the source is an iTunes library XML file, rather than a Strawberry database.
+    A source is taken to be XML unless it has the header of a SQLite database, as an XML file
+    may start with a byte order mark or white space before its declaration, or have none.
+    """
+    with open(sourcePath, 'rb') as sourceFile:
+        return sourceFile.read(len(SQLITE_HEADER)) != SQLITE_HEADER
+
+def strawberryStatistics(sourcePath):
+    """
+    Generates (url, play count, skip count, last played) tuples for each played or skipped song
+    in a Strawberry database.
+    """
+    sourceClient = connectReadOnly(sourcePath)
+    try:
+        for row in sourceClient.execute("SELECT url, playcount, skipcount, lastplayed FROM songs WHERE playcount > 0 OR skipcount > 0"):
+            yield row
+    finally:
+        sourceClient.close()
+
+def iTunesStatistics(sourcePath, urlRewriter):
+    """
+    Generates (url, play count, skip count, last played) tuples for each played or skipped track
+    in an iTunes library XML file. The URLs are converted to those of Strawberry, then rewritten
+    by the URL replacement rules.
+    """
+    with open(sourcePath, 'rb') as libraryFile:
+        for trackNumber, track in runStatistics.timed('xml_parse', LibraryReader(libraryFile).tracks()):
+            # For some crazy reason we can have entries in the iTunes Library without file URLs?
+            if 'Location' not in track:
+                continue
+            playCount = track.get('Play Count', 0)
+            skipCount = track.get('Skip Count', 0)
+            if playCount == 0 and skipCount == 0:
+                continue
+            lastPlayed = int(track['Play Date UTC'].timestamp()) if 'Play Date UTC' in track else -1
+            with runStatistics.phase('url_conversion'):
+                url = urlRewriter.rewrite(convertURL(track['Location']))
+            yield url, playCount, skipCount, lastPlayed
+
+def combineSources(sources, urlRewriter):
+    """
+    Reads each source once, combining the statistics of each URL. Counts are combined with the
+    policy of each source, the latest last played time is retained.
+    Returns a dictionary keyed by URL of [play count, skip count, last played] lists.
+    """
+    combined = {}
+    for policy, sourcePath in sources:
+        if isLibraryXML(sourcePath):
+            appLogger.info(f"Reading iTunes library {sourcePath}, combining by {policy}")
+            statistics = iTunesStatistics(sourcePath, urlRewriter)
+        else:
+            appLogger.info(f"Reading Strawberry database {sourcePath}, combining by {policy}")
+            statistics = strawberryStatistics(sourcePath)
+        sourceCount = 0
+        for url, playCount, skipCount, lastPlayed in statistics:
+            sourceCount += 1
+            urlStatistics = combined.get(url)
+            if urlStatistics is None:
+                combined[url] = [playCount, skipCount, lastPlayed]
+            elif policy == 'sum':
+                urlStatistics[0] += playCount
+                urlStatistics[1] += skipCount
+                urlStatistics[2] = max(urlStatistics[2], lastPlayed)
+            else:
+                urlStatistics[0] = max(urlStatistics[0], playCount)
+                urlStatistics[1] = max(urlStatistics[1], skipCount)
+                urlStatistics[2] = max(urlStatistics[2], lastPlayed)
+        appLogger.info(f"Read {sourceCount} played tracks from {sourcePath}")
+    return combined
+
+def writeCombined(strawberryDatabaseCursor, combined, targetPolicy, dryRun = False):
+    """
+    Stages the combined statistics in a TEMP table and applies them to the songs with matching
+    URLs in a single joined UPDATE. The target's existing statistics are combined by the
+    targetPolicy: 'max' or 'sum' with the existing counts, or 'replace' them.
+    Returns the number of songs updated.
+    """
+    strawberryDatabaseCursor.execute("DROP TABLE IF EXISTS temp.merged_statistics")
+    strawberryDatabaseCursor.execute("CREATE TEMP TABLE merged_statistics (url TEXT PRIMARY KEY, playcount INTEGER, skipcount INTEGER, lastplayed INTEGER)")
+    with runStatistics.phase('staging'):
+        strawberryDatabaseCursor.executemany("INSERT INTO merged_statistics VALUES (?, ?, ?, ?)",
+                                             ((url, *urlStatistics) for url, urlStatistics in combined.items()))
+    with runStatistics.phase('matching'):
+        strawberryDatabaseCursor.execute("SELECT url FROM merged_statistics WHERE url NOT IN (SELECT url FROM songs)")
+        unmatchedURLs = strawberryDatabaseCursor.fetchall()
+    for row in unmatchedURLs:
+        appLogger.warning("Unable to find %s", row[0])
+    runStatistics.count('matched_url', len(combined) - len(unmatchedURLs))
+    runStatistics.count('unmatched', len(unmatchedURLs))
+    if dryRun:
+        strawberryDatabaseCursor.execute("SELECT COUNT(1) FROM songs JOIN merged_statistics ON (merged_statistics.url = songs.url)")
+        return strawberryDatabaseCursor.fetchone()[0]
+
+    if targetPolicy == 'sum':
+        assignments = """playcount = songs.playcount + merged.playcount, skipcount = songs.skipcount + merged.skipcount,
+            lastplayed = max(songs.lastplayed, merged.lastplayed)"""
+    elif targetPolicy == 'max':
+        assignments = """playcount = max(songs.playcount, merged.playcount), skipcount = max(songs.skipcount, merged.skipcount),
+            lastplayed = max(songs.lastplayed, merged.lastplayed)"""
+    else:
+        assignments = "playcount = merged.playcount, skipcount = merged.skipcount, lastplayed = merged.lastplayed"
+    mergeCounts = f"UPDATE songs SET {assignments} FROM merged_statistics AS merged WHERE merged.url = songs.url"
+    appLogger.debug(mergeCounts)
+    return executeUpdate(strawberryDatabaseCursor, mergeCounts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Alters a Strawberry music player database, merging the play and skip counts, and last played date and time from any number of Strawberry databases and iTunes Library XML files.')
+    parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
+    parser.add_argument('-s', '--strawberry', action = 'store', help = 'Path to the Strawberry database file to update. Defaults to %(default)s.', type = str, default = 'strawberry.db')
+    parser.add_argument('-a', '--sum-from', action = AppendSource, const = 'sum', dest = 'sources', metavar = 'SOURCE',
+                        help = 'A Strawberry database or iTunes Library.xml file whose counts are added to those of the sources before it. May be repeated.')
+    parser.add_argument('-m', '--max-from', action = AppendSource, const = 'max', dest = 'sources', metavar = 'SOURCE',
+                        help = 'A Strawberry database or iTunes Library.xml file whose counts replace those of the sources before it when larger. May be repeated.')
+    parser.add_argument('-t', '--target-policy', action = 'store', choices = ('max', 'sum', 'replace'), default = 'max',
+                        help = 'How the merged counts are combined with those already in the Strawberry database. Defaults to %(default)s.')
+    parser.add_argument('-r', '--replace-url', action = 'append', help = 'The URL regexp to replace in iTunes track URLs. May be repeated, each paired with the -w in the same position', default = [])
+    parser.add_argument('-w', '--replace-with', action = 'append', help = 'The URL fragment to replace with, or nothing if there is no -w for the -r', default = [])
+    parser.add_argument('-n', '--dry-run', action = 'store_true', help = 'Only report the number of tracks which would be updated')
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of tracks matched, as JSON to the file, or standard output')
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+
+    if args.verbose > 1:
+        appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        appLogger.setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
+
+    if not args.sources:
+        parser.error('At least one source is required, with --sum-from or --max-from')
+    if len(args.replace_with) > len(args.replace_url):
+        parser.error('Each --replace-with needs a --replace-url')
+
+    if args.stats is not None:
+        runStatistics.enable()
+
+    urlRewriter = URLRewriter(itertools.zip_longest(args.replace_url, args.replace_with, fillvalue = ''))
+    combined = combineSources(args.sources, urlRewriter)
+    urlRewriter.logRuleCounts(appLogger)
+    appLogger.info(f"Merged statistics of {len(combined)} tracks")
+
+    with databaseToUpdate(args.strawberry, args.live) as databasePath:
+        sqlClient = sqlite3.connect(databasePath)
+        cursor = sqlClient.cursor()
+        updateCount = writeCombined(cursor, combined, args.target_policy, dryRun = args.dry_run)
+
+        appLogger.info(f"Updated {updateCount} tracks")
+        if updateCount > 0 and not args.dry_run:
+            # Save (commit) the changes
+            with runStatistics.phase('commit'):
+                sqlClient.commit()
+
+        sqlClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Migrates an iTunes exported library XML file to the Strawberry music player SQLite database in
+a single pass, updating the play and skip counts, and the last played date and time, as
+iTunes2Strawberry.py does, then adding the playlists, as iTunesPlayLists2Strawberry.py does.
+
+The library is parsed once, and the URL of each track converted once, for both. Both are
+applied against a single connection, in a single transaction, so a failure leaves the database
+unaltered.
+"""
+
+import logging
+import argparse
+import sqlite3
+import itertools
+from librarySnapshot import openLibrary, snapshotLibrary, SnapshotReader
+from liveDatabase import databaseToUpdate
+from urlRewriting import URLRewriter
+from runStatistics import runStatistics
+from iTunes2Strawberry import updatePlayCounts, albumClause
+from iTunesPlayLists2Strawberry import importPlaylists
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Alters a Strawberry music player database, setting the play and skip counts, and last played date and time, and adding the playlists from the iTunes Library XML file.')
+    parser.add_argument('-v', '--verbose', action = 'count', help = 'Verbose output. Specify twice for debugging.', default = 0)
+    parser.add_argument('-s', '--strawberry', action = 'store', help = 'Path to the Strawberry database file. Defaults to %(default)s.', type = str, default = 'strawberry.db')
+    parser.add_argument('-i', '--itunes', action = 'store', help = 'Path to the iTunes exported Library.xml file. Defaults to %(default)s.', type = str, default = 'Library.xml')
+    parser.add_argument('-f', '--find', action = 'store', help = 'Only update the play counts of the named album.', default = '')
+    parser.add_argument('-p', '--update-unplayed', action = 'store_true', help = 'Update existing records if they have a zero play count.')
+    parser.add_argument('-u', '--update-existing', action = 'store_true', help = 'Update the existing records if they already have play counts.')
+    parser.add_argument('-b', '--bulk', action = 'store_true', help = 'Stage all iTunes tracks in a temporary table and update the play counts with a few set-based statements.')
+    parser.add_argument('-r', '--replace-url', action = 'append', help = 'The URL regexp to replace. May be repeated, each paired with the -w in the same position.', default = [])
+    parser.add_argument('-w', '--replace-with', action = 'append', help = 'The URL fragment to replace with, or nothing if there is no -w for the -r.', default = [])
+    parser.add_argument('--import-playlist', action = 'store', help = 'Only import the named playlist.', default = None)
+    parser.add_argument('--convert-smart-playlists', action = 'store_true', help = 'Store the compiled criteria of iTunes smart playlists in the Strawberry database, converting those which can not be compiled to static playlists.')
+    parser.add_argument('--sync', action = 'store_true', help = 'Update playlists already in the Strawberry database to match those of iTunes, rather than skipping them.')
+    parser.add_argument('--snapshot', action = 'store', nargs = '?', const = '', metavar = 'FILE',
+                        help = 'Read the parsed iTunes library from a snapshot, written to the file, or the library path with .snapshot appended, by the first run, and read by later runs while the library is unchanged. The snapshot holds the whole library in memory.')
+    parser.add_argument('-j', '--jobs', action = 'store', type = int, help = 'Parse the tracks of the iTunes library XML file with this many processes. Defaults to %(default)s.', default = 1)
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended.')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of tracks matched by each method, as JSON to the file, or standard output.')
+
+    args = parser.parse_args()
+    if len(args.replace_with) > len(args.replace_url):
+        parser.error("Each --replace-with needs a --replace-url")
+
+    # We set the logging value here so it's available to the core and master nodes.
+    appLogger = logging.getLogger("migrateiTunesLibrary")
+    logging.basicConfig()
+
+    loggers = [appLogger] + [logging.getLogger(name) for name in ("iTunes2Strawberry", "iTunesPlayLists2Strawberry", "librarySnapshot", "parallelLibrary", "liveDatabase")]
+    for logger in loggers:
+        if args.verbose > 1:
+            logger.setLevel(logging.DEBUG)
+        elif args.verbose > 0:
+            logger.setLevel(logging.INFO)
+
+    if args.stats is not None:
+        runStatistics.enable()
+
+    with databaseToUpdate(args.strawberry, args.live) as databasePath:
+        sqlClient = sqlite3.connect(databasePath)
+        cursor = sqlClient.cursor()
+
+        # The same rules rewrite the URLs of the play counts and playlists.
+        urlRewriter = URLRewriter(itertools.zip_longest(args.replace_url, args.replace_with, fillvalue = ''))
+        snapshotPath = None if args.snapshot is None else (args.snapshot or args.itunes + '.snapshot')
+        with openLibrary(args.itunes, snapshotPath, args.jobs) as root:
+            if not isinstance(root, SnapshotReader):
+                # The tracks are read twice, so are held in memory, converting each URL once.
+                with runStatistics.phase('xml_parse'):
+                    root = SnapshotReader(*snapshotLibrary(root))
+            findClause, findParameters = albumClause(args.find)
+            try:
+                updateCount = updatePlayCounts(root, cursor, findClause, args.update_unplayed, args.update_existing, args.bulk,
+                                               urlRewriter, findParameters = findParameters)
+                appLogger.info(f"Updated {updateCount} tracks")
+                playlistCount = importPlaylists(root, cursor, urlRewriter,
+                                                onlyPlaylist = args.import_playlist,
+                                                includeSmartPlaylists = args.convert_smart_playlists,
+                                                syncPlaylists = args.sync)
+                appLogger.info(f"Added {playlistCount} tracks to playlists" if not args.sync else f"Added or removed {playlistCount} playlist tracks")
+            except Exception:
+                sqlClient.rollback()
+                sqlClient.close()
+                raise
+        urlRewriter.logRuleCounts(appLogger)
+
+        if updateCount > 0 or playlistCount > 0:
+            # Save (commit) the play counts and playlists together.
+            with runStatistics.phase('commit'):
+                sqlClient.commit()
+
+        sqlClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
@@ -0,0 +1,222 @@
+"""
+Parallel reader of the iTunes exported library XML file.
+
+The Tracks section is the bulk of a library, so it is split into byte ranges, each ending at
+the end of a track, which are parsed, and the track URLs converted, by a pool of processes.
+The tracks are generated in the order they are in the file, the same as LibraryReader, however
+many processes are used. The header and playlists are read by a LibraryReader of the rest of
+the file.
+
+Track dictionaries are flat, and property list strings can not contain a '<', so the end of
+each track is found by scanning the dict tags, without parsing the XML.
+"""
+
+import re
+import sys
+import mmap
+import logging
+import collections
+import concurrent.futures
+from xml.etree import ElementTree
+from iTunesLibrary import LibraryReader, Track, RECORD_FIELDS, decodeElement, decodeFields, defaultLastPlayed
+from urlConversion import convertURL, convertURLs
+
+# The ranges each process is given, so the work is balanced as some ranges parse faster.
+RANGES_PER_PROCESS = 4
+# The smallest byte range worth handing to a process.
+MINIMUM_RANGE_SIZE = 1 << 20
+# Ranges parsed ahead of those being read, for each process.
+RANGES_AHEAD = 2
+
+tracksStart = re.compile(rb"<key>Tracks</key>\s*<dict>")
+dictTag = re.compile(rb"<(/?)dict(/?)>")
+
+moduleLogger = logging.getLogger("parallelLibrary")
+
+def findTrackRanges(libraryMap, rangeCount):
+    """
+    Returns a tuple of the start and end byte offsets of the content of the Tracks dict, and the
+    list of (start, end) byte offsets of up to rangeCount ranges of whole tracks within it, or
+    None if there is no Tracks section with tracks.
+    """
+    start = tracksStart.search(libraryMap)
+    if start is None:
+        return None
+    contentStart = start.end()
+    targetSize = None
+    ranges = []
+    rangeStart = contentStart
+    depth = 1
+    for tag in dictTag.finditer(libraryMap, contentStart):
+        closing, empty = tag.group(1), tag.group(2)
+        if empty:
+            if depth != 1:
+                continue
+        elif closing:
+            depth -= 1
+            if depth == 0:
+                # The end of the Tracks dict.
+                if tag.start() > rangeStart:
+                    ranges.append((rangeStart, tag.start()))
+                return (contentStart, tag.start(), ranges) if len(ranges) > 0 else None
+            if depth != 1:
+                continue
+        else:
+            depth += 1
+            continue
+        # The end of a track.
+        if targetSize is None:
+            # The size of the section is not known until its end is found, so it is estimated
+            # from the size of the rest of the file, which is mostly tracks.
+            targetSize = max(MINIMUM_RANGE_SIZE, (len(libraryMap) - contentStart) // rangeCount)
+        if tag.end() - rangeStart >= targetSize:
+            ranges.append((rangeStart, tag.end()))
+            rangeStart = tag.end()
+    return None
+
+def parseTrackRange(libraryPath, start, end):
+    """
+    Returns a list of the (track id, element) tuples of the tracks between the byte offsets.
+    """
+    with open(libraryPath, 'rb') as libraryFile:
+        libraryFile.seek(start)
+        content = libraryFile.read(end - start)
+    tracks = []
+    key = None
+    for child in ElementTree.fromstring(b"<dict>" + content + b"</dict>"):
+        if child.tag == 'key':
+            key = child.text
+        else:
+            tracks.append((key, child))
+    return tracks
+
+def convertLocations(locations):
+    return dict(zip(locations, convertURLs(locations)))
+
+def readTrackDictionaries(libraryPath, start, end, fields):
+    """
+    Returns a tuple of the list of (track id, track dictionary) tuples of the tracks between the
+    byte offsets, holding only the fields, or all if None, and the dictionary of the Strawberry
+    URL of each track Location.
+    """
+    tracks = [(trackId, decodeFields(element, fields) if fields is not None else decodeElement(element))
+              for trackId, element in parseTrackRange(libraryPath, start, end)]
+    return tracks, convertLocations([track['Location'] for trackId, track in tracks if 'Location' in track])
+
+def readTrackRecords(libraryPath, start, end, lastPlayed):
+    """
+    Returns a tuple of the list of the fields of a Track record of each track between the byte
+    offsets, and the dictionary of the Strawberry URL of each track Location.
+    """
+    tracks = [Track.fromProperties(trackId, decodeFields(element, RECORD_FIELDS), lastPlayed)
+              for trackId, element in parseTrackRange(libraryPath, start, end)]
+    # Tuples are quicker to hand back than records.
+    rows = [tuple(getattr(track, field) for field in Track.__slots__) for track in tracks]
+    return rows, convertLocations([track.location for track in tracks if track.location is not None])
+
+class SplicedFile:
+    """
+    Reads a file, omitting a byte range.
+    """
+
+    def __init__(self, readFile, start, end):
+        self.readFile = readFile
+        # The (start, end) byte offsets still to be read, the last to the end of the file.
+        self.parts = collections.deque([(0, start), (end, None)])
+
+    def read(self, size = -1):
+        chunks = []
+        remaining = size
+        while len(self.parts) > 0 and remaining != 0:
+            start, end = self.parts.popleft()
+            length = end - start if end is not None else -1
+            if remaining >= 0 and (length < 0 or remaining < length):
+                length = remaining
+            self.readFile.seek(start)
+            data = self.readFile.read(length)
+            if len(data) > 0 and (end is None or start + len(data) < end):
+                self.parts.appendleft((start + len(data), end))
+            chunks.append(data)
+            if remaining >= 0:
+                remaining -= len(data)
+        return b"".join(chunks)
+
+class ParallelLibraryReader:
+    """
+    Reads an iTunes library XML file, parsing the tracks with a pool of processes, with the same
+    interface as LibraryReader, except the tracks and playlists may be read in either order.
+    """
+
+    def __init__(self, libraryPath, processCount):
+        self.libraryPath = libraryPath
+        self.processCount = processCount
+        self.convertedURLs = {}
+        self.libraryFile = open(libraryPath, 'rb')
+        with mmap.mmap(self.libraryFile.fileno(), 0, access = mmap.ACCESS_READ) as libraryMap:
+            found = findTrackRanges(libraryMap, processCount * RANGES_PER_PROCESS)
+        if found is None:
+            # There are no tracks to parse in parallel, so the whole file is read as usual.
+            self.trackRanges = []
+            self.reader = LibraryReader(self.libraryFile)
+        else:
+            contentStart, contentEnd, self.trackRanges = found
+            moduleLogger.info(f"Parsing {len(self.trackRanges)} ranges of tracks with {processCount} processes")
+            self.reader = LibraryReader(SplicedFile(self.libraryFile, contentStart, contentEnd))
+        self.header = self.reader.header
+
+    def close(self):
+        self.libraryFile.close()
+
+    def readRanges(self, readRange, *arguments):
+        """
+        Generates the results of readRange for each track range, in order, keeping a few ranges
+        for each process parsed ahead of those being read.
+        """
+        with concurrent.futures.ProcessPoolExecutor(max_workers = self.processCount) as executor:
+            pending = collections.deque()
+            for start, end in self.trackRanges:
+                pending.append(executor.submit(readRange, self.libraryPath, start, end, *arguments))
+                if len(pending) >= self.processCount * RANGES_AHEAD:
+                    yield self.convertedResult(pending.popleft().result())
+            while len(pending) > 0:
+                yield self.convertedResult(pending.popleft().result())
+
+    def convertedResult(self, result):
+        tracks, convertedURLs = result
+        self.convertedURLs.update(convertedURLs)
+        return tracks
+
+    def tracks(self, fields = None):
+        """
+        Generates a (track id, track dictionary) tuple for each track in the library. If fields
+        are given, the dictionaries only hold those fields.
+        """
+        for tracks in self.readRanges(readTrackDictionaries, fields):
+            yield from tracks
+        yield from self.reader.tracks(fields)
+
+    def trackRecords(self):
+        """
+        Generates a Track record for each track in the library.
+        """
+        for rows in self.readRanges(readTrackRecords, defaultLastPlayed()):
+            for trackId, name, artist, location, playCount, skipCount, lastPlayed, skipDate in rows:
+                # Interned strings are not shared between processes, so are interned again.
+                yield Track(trackId, name, sys.intern(artist), location, playCount, skipCount, lastPlayed, skipDate)
+        yield from self.reader.trackRecords()
+
+    def playlists(self):
+        """
+        Generates each playlist dictionary in the library.
+        """
+        return self.reader.playlists()
+
+    def convertURL(self, location):
+        """
+        Returns the Strawberry URL of the track Location, converted as the tracks were parsed.
+        """
+        convertedURL = self.convertedURLs.get(location)
+        return convertedURL if convertedURL is not None else convertURL(location)
+
+    def convertURLs(self, locations):
+        return [self.convertURL(location) for location in locations]
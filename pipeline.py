@@ -0,0 +1,200 @@
+"""
+Pipelined updates of a Strawberry database, shared by the utilities.
+
+Rather than reading, matching and updating each item in turn, the calling thread produces the
+items (such as parsing the tracks and converting their URLs), a pool of matcher threads, each
+with its own read-only connection, looks up the rows each item updates, and a single writer
+thread, which owns the read-write connection, executes the updates in the order the items were
+produced, committing them in batches. SQLite releases the GIL while it executes a statement, so
+the stages overlap.
+
+The queue between the stages is bounded, so a producer which gets ahead of the database waits,
+and memory use is independent of the number of items. The outcome of each item is handed back
+to the calling thread, so logging and the run statistics remain on that thread.
+
+The writer holds its changes in memory until they are committed, so the database can be read
+by the matchers until then. Since the updates are committed in batches, an update which fails
+leaves those of the earlier batches committed.
+"""
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import collections
+import concurrent.futures
+from urllib.request import pathname2url
+from runStatistics import runStatistics
+
+# The number of matcher threads.
+MATCHER_COUNT = 2
+# The items matched, or being matched, ahead of the writer.
+QUEUE_SIZE = 1024
+# The items whose updates are committed together.
+COMMIT_SIZE = 5000
+# Seconds a connection waits for the lock held by another, as the writer commits while matchers read.
+BUSY_TIMEOUT = 60.0
+
+moduleLogger = logging.getLogger("pipeline")
+
+def connectReadOnly(databasePath):
+    """
+    Returns a read-only connection to the SQLite database, which may be used by any thread.
+    """
+    databaseURI = 'file:' + pathname2url(os.path.abspath(databasePath)) + '?mode=ro'
+    return sqlite3.connect(databaseURI, uri = True, timeout = BUSY_TIMEOUT, check_same_thread = False)
+
+class Pipeline:
+    """
+    Matches and writes the items put to it, as a context manager which finishes writing them on
+    exit, or abandons those not yet written if the block raised an exception.
+
+    match(readCursor, item) is called on a matcher thread, with a cursor of a read-only connection
+    to the matchDatabasePath, by default the database being updated. It returns a tuple of the
+    result of the match, and the list of (statement, parameters) updates of the item, which are
+    executed in turn until one changes a row. written(item, result, updateIndex) is then called on
+    the calling thread, in the order the items were put, with the index of the update which
+    changed rows, or None if none did.
+    """
+
+    def __init__(self, databasePath, match, written, matchDatabasePath = None, matcherCount = MATCHER_COUNT,
+                 queueSize = QUEUE_SIZE, commitSize = COMMIT_SIZE):
+        self.databasePath = databasePath
+        self.matchDatabasePath = matchDatabasePath or databasePath
+        self.match = match
+        self.written = written
+        self.commitSize = commitSize
+        self.matchers = threading.local()
+        # The read-only connection and time spent matching of each matcher thread.
+        self.matcherStates = []
+        self.matcherLock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = matcherCount, thread_name_prefix = 'matcher',
+                                                              initializer = self.startMatcher)
+        # The futures of the matches, in the order the items were put.
+        self.writeQueue = queue.Queue(maxsize = queueSize)
+        # The (item, result, updateIndex) outcomes written, to be handed back to the calling thread.
+        self.outcomes = collections.deque()
+        self.error = None
+        self.abandoned = False
+        self.writeSeconds = 0.0
+        self.commitSeconds = 0.0
+        self.rowsWritten = 0
+        self.writer = threading.Thread(target = self.write, name = 'writer')
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if exceptionType is not None:
+            self.abandoned = True
+        self.close()
+        return False
+
+    def startMatcher(self):
+        connection = connectReadOnly(self.matchDatabasePath)
+        self.matchers.cursor = connection.cursor()
+        self.matchers.state = [connection, 0.0]
+        with self.matcherLock:
+            self.matcherStates.append(self.matchers.state)
+
+    def matchItem(self, item):
+        started = time.perf_counter()
+        try:
+            return item, self.match(self.matchers.cursor, item)
+        finally:
+            self.matchers.state[1] += time.perf_counter() - started
+
+    def put(self, item):
+        """
+        Queues the item to be matched and written, waiting while the queue is full.
+        """
+        future = self.executor.submit(self.matchItem, item)
+        while True:
+            if self.error is not None:
+                future.cancel()
+                raise self.error
+            try:
+                self.writeQueue.put(future, timeout = 0.1)
+                break
+            except queue.Full:
+                pass
+        self.handOutcomes()
+
+    def handOutcomes(self):
+        while len(self.outcomes) > 0:
+            self.written(*self.outcomes.popleft())
+
+    def write(self):
+        """
+        Executes the updates of each matched item, in order, on the read-write connection.
+        """
+        connection = sqlite3.connect(self.databasePath, timeout = BUSY_TIMEOUT)
+        cursor = connection.cursor()
+        # Spilling the changed pages to the file would take the exclusive lock before the commit,
+        # locking out the matchers, which the writer waits on.
+        cursor.execute("PRAGMA cache_spill = OFF")
+        uncommitted = 0
+        try:
+            while True:
+                future = self.writeQueue.get()
+                if future is None:
+                    break
+                if self.abandoned:
+                    continue
+                item, (result, updates) = future.result()
+                updateIndex = None
+                started = time.perf_counter()
+                for index, (statement, parameters) in enumerate(updates):
+                    cursor.execute(statement, parameters)
+                    if cursor.rowcount > 0:
+                        self.rowsWritten += cursor.rowcount
+                        updateIndex = index
+                        break
+                self.writeSeconds += time.perf_counter() - started
+                self.outcomes.append((item, result, updateIndex))
+                if len(updates) > 0:
+                    uncommitted += 1
+                if uncommitted >= self.commitSize:
+                    self.commit(connection)
+                    uncommitted = 0
+            if self.abandoned:
+                connection.rollback()
+            elif uncommitted > 0:
+                self.commit(connection)
+        except BaseException as error:
+            self.error = error
+            connection.rollback()
+            # Discard the remaining items, so the calling thread is not left waiting on the queue.
+            while self.writeQueue.get() is not None:
+                pass
+        finally:
+            connection.close()
+
+    def commit(self, connection):
+        started = time.perf_counter()
+        connection.commit()
+        self.commitSeconds += time.perf_counter() - started
+        moduleLogger.debug("Committed a batch of updates")
+
+    def close(self):
+        """
+        Waits for the items put to be matched and written, and the final batch committed, hands
+        back their outcomes, and adds the time of each stage to the run statistics.
+        """
+        self.writeQueue.put(None)
+        self.writer.join()
+        self.executor.shutdown(wait = True, cancel_futures = True)
+        for connection, matchSeconds in self.matcherStates:
+            connection.close()
+            runStatistics.addTime('matching', matchSeconds)
+        runStatistics.addTime('sql_writes', self.writeSeconds)
+        runStatistics.addTime('commit', self.commitSeconds)
+        runStatistics.count('rows_written', self.rowsWritten)
+        if self.abandoned:
+            return
+        if self.error is not None:
+            raise self.error
+        self.handOutcomes()
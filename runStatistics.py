@@ -0,0 +1,149 @@
+"""
+Instrumentation shared by each of the utilities, recording the wall time spent in each phase of
+a run (such as parsing the XML, converting URLs, matching, writing to the database and
+committing), and counters of the outcomes (such as the tracks matched by each method, those
+unmatched, and the rows written), reported as JSON by the --stats option.
+
+Phases may be entered within other phases, and the time of the inner phase is not also counted
+as time of the outer phase, so the phase times add up to the time of the run spent within them,
+except in pipelined runs, where the time of the stages running on other threads is added.
+Until enabled, phases are not timed, so the instrumentation can be left in the hot loops.
+"""
+
+import sys
+import json
+import time
+import collections
+
+class Phase:
+    """
+    A context manager adding the wall time spent within it to a phase of the RunStatistics.
+    """
+    __slots__ = ('runStatistics', 'name')
+
+    def __init__(self, runStatistics, name):
+        self.runStatistics = runStatistics
+        self.name = name
+
+    def __enter__(self):
+        self.runStatistics.enter(self.name)
+        return self
+
+    def __exit__(self, *exception):
+        self.runStatistics.exit()
+        return False
+
+class NoPhase:
+    """
+    The context manager of the phases of RunStatistics which are not enabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+NO_PHASE = NoPhase()
+
+class RunStatistics:
+    """
+    The phase times, in seconds, and counters of a run.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        # The total time of each phase, in the order the phases were first entered.
+        self.phases = {}
+        self.counters = collections.Counter()
+        # The names of the phases entered and not yet exited, innermost last, and when the
+        # innermost was entered or resumed.
+        self.activePhases = []
+        self.resumed = None
+
+    def enable(self):
+        """
+        Starts timing the phases, and the run.
+        """
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if len(self.activePhases) > 0:
+            outer = self.activePhases[-1]
+            self.phases[outer] += now - self.resumed
+        self.phases.setdefault(name, 0.0)
+        self.activePhases.append(name)
+        self.resumed = now
+
+    def exit(self):
+        now = time.perf_counter()
+        name = self.activePhases.pop()
+        self.phases[name] += now - self.resumed
+        self.resumed = now
+
+    def phase(self, name):
+        """
+        Returns a context manager timing the statements within it as the named phase.
+        """
+        return Phase(self, name) if self.enabled else NO_PHASE
+
+    def timed(self, name, iterable):
+        """
+        Returns an iterator of the items of the iterable, timing the production of each item as
+        the named phase, such as the parsing of each track as it is read.
+        """
+        if not self.enabled:
+            return iterable
+        return self.timedItems(name, iter(iterable))
+
+    def timedItems(self, name, iterator):
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def addTime(self, name, seconds):
+        """
+        Adds the seconds to the named phase, for time measured on another thread, such as by the
+        stages of a pipeline, which overlaps the phases of the calling thread.
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, increment = 1):
+        """
+        Adds the increment to the named counter.
+        """
+        self.counters[name] += increment
+
+    def report(self):
+        """
+        Returns the dictionary of the run's statistics, as reported by write().
+        """
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'phases': {name: seconds for name, seconds in self.phases.items()},
+            'counters': dict(self.counters)
+        }
+
+    def write(self, statisticsPath):
+        """
+        Writes the statistics as JSON to the file, or to standard output if the path is '-'.
+        """
+        if statisticsPath == '-':
+            json.dump(self.report(), sys.stdout, indent = 2)
+            sys.stdout.write('\n')
+        else:
+            with open(statisticsPath, 'w') as statisticsFile:
+                json.dump(self.report(), statisticsFile, indent = 2)
+
+# The statistics of the current run, shared by each of the modules used by a utility.
+runStatistics = RunStatistics()
@@ -0,0 +1,240 @@
+"""
+Compiles the rules of iTunes smart playlists into SQL selecting the matching songs of the
+Strawberry database, so a smart playlist is evaluated from the current songs, rather than
+copying the tracks iTunes last found. The compiled SQL and its parameters are stored in the
+database, rather than the songs they select, which would go stale as the songs change.
+
+iTunes stores the rules in two undocumented binary blobs of each playlist: 'Smart Info' holds
+whether the rules apply, and the limit and selection order, and 'Smart Criteria' holds the
+rules. The layout used here is that reverse engineered by the community of iTunes library
+tools, and only the common rules are compiled. Rules which cannot be compiled are reported,
+rather than compiling a playlist which would select different songs.
+"""
+
+import struct
+from strawberryDatabase import likePattern
+
+# Smart Info offsets.
+INFO_MATCH_RULES = 1
+INFO_LIMITED = 2
+INFO_LIMIT_UNIT = 3
+INFO_SELECTION = 7
+INFO_LIMIT_VALUE = 8
+INFO_SELECTION_REVERSED = 13
+
+# Smart Criteria offsets, of the rules, then relative to the start of each rule.
+CRITERIA_HEADER = b'SLst'
+CRITERIA_CONJUNCTION = 15
+CRITERIA_FIRST_RULE = 136
+RULE_FIELD = 3
+RULE_SIGN = 4
+RULE_OPERATOR = 7
+RULE_STRING_LENGTH = 55
+RULE_STRING = 56
+RULE_VALUE = 60
+RULE_TIME_VALUE = 68
+RULE_TIME_MULTIPLE = 76
+RULE_UPPER_VALUE = 84
+NUMERIC_RULE_LENGTH = 124
+
+# The sign of a rule is negative (is not, does not contain) when this bit is set.
+SIGN_NEGATIVE = 0x02
+
+OPERATOR_OTHER = 0x00 # A range, or for dates, in the last period.
+OPERATOR_IS = 0x01
+OPERATOR_CONTAINS = 0x02
+OPERATOR_STARTS = 0x04
+OPERATOR_ENDS = 0x08
+OPERATOR_GREATER = 0x10
+OPERATOR_LESS = 0x40
+
+# The value of a date rule which is of the last period, rather than a date range.
+IN_THE_LAST = 0x2dae2dae2dae2dae
+
+# Seconds between the Mac epoch, of 1904, used by iTunes and the Unix epoch.
+MAC_EPOCH_OFFSET = 2082844800
+
+# The songs column of each iTunes field compared as a string.
+STRING_FIELDS = {
+    0x02: 'title',
+    0x03: 'album',
+    0x04: 'artist',
+    0x08: 'genre',
+    0x0e: 'comment',
+    0x12: 'composer',
+    0x27: 'grouping',
+    0x47: 'albumartist'
+}
+
+# The songs column of each iTunes field compared as a number, and the scale to convert the
+# iTunes value to that of Strawberry. iTunes rates 0 to 100, Strawberry 0 to 1, iTunes times
+# are in milliseconds, Strawberry's in nanoseconds.
+NUMERIC_FIELDS = {
+    0x05: ('bitrate', 1),
+    0x07: ('year', 1),
+    0x0b: ('track', 1),
+    0x0d: ('length', 1000000),
+    0x16: ('playcount', 1),
+    0x19: ('rating', 0.01),
+    0x44: ('skipcount', 1)
+}
+
+# The songs column of each iTunes date field. Strawberry records when the file was created,
+# rather than when it was added, which is the nearest to the iTunes date added.
+DATE_FIELDS = {
+    0x10: 'ctime',
+    0x17: 'lastplayed'
+}
+
+# The songs column summed by each limit unit, and the scale to convert it to that unit.
+LIMIT_UNITS = {
+    0x01: ('length', 60 * 1e9),
+    0x02: ('filesize', 1024 * 1024),
+    0x04: ('length', 60 * 60 * 1e9),
+    0x05: ('filesize', 1024 * 1024 * 1024)
+}
+LIMIT_ITEMS = 0x03
+
+# The ordering of the songs of each selection method of a limited playlist, which is reversed
+# by the selection reversed flag.
+SELECTION_ORDERS = {
+    0x01: 'rating ASC',
+    0x02: 'random()',
+    0x05: 'title ASC',
+    0x06: 'album ASC',
+    0x07: 'artist ASC',
+    0x09: 'genre ASC',
+    0x15: 'ctime DESC',
+    0x19: 'playcount DESC',
+    0x1a: 'lastplayed DESC',
+    0x1c: 'rating DESC'
+}
+
+def byteAt(blob, offset):
+    """
+    Returns the byte of the blob at the offset, or zero if the blob is shorter.
+    """
+    return blob[offset] if offset < len(blob) else 0
+
+def integerAt(blob, offset, size = 8):
+    """
+    Returns the signed big endian integer of the blob at the offset.
+    """
+    return int.from_bytes(blob[offset:offset + size], 'big', signed = True)
+
+def compileStringRule(column, operator, value):
+    """
+    Returns the (SQL condition, parameters) of a string rule, or None if it can not be compiled.
+    """
+    if operator == OPERATOR_IS:
+        return f"{column} = ? COLLATE NOCASE", [value]
+    patterns = {OPERATOR_CONTAINS: ('%', '%'), OPERATOR_STARTS: ('', '%'), OPERATOR_ENDS: ('%', '')}
+    if operator in patterns:
+        return f"{column} LIKE ? ESCAPE '\\'", [likePattern(value, *patterns[operator])]
+    return None
+
+def compileNumericRule(column, operator, value, upperValue):
+    """
+    Returns the (SQL condition, parameters) of a numeric rule, or None if it can not be compiled.
+    """
+    comparisons = {OPERATOR_IS: '=', OPERATOR_GREATER: '>', OPERATOR_LESS: '<'}
+    if operator in comparisons:
+        return f"{column} {comparisons[operator]} ?", [value]
+    if operator == OPERATOR_OTHER:
+        return f"{column} BETWEEN ? AND ?", [value, upperValue]
+    return None
+
+def compileRule(criteria, ruleOffset):
+    """
+    Compiles the rule starting at the offset of the criteria.
+    Returns a tuple of the (SQL condition, parameters), or None if it can not be compiled, the
+    description of the rule, and the offset of the next rule.
+    """
+    field = byteAt(criteria, ruleOffset + RULE_FIELD)
+    negative = (byteAt(criteria, ruleOffset + RULE_SIGN) & SIGN_NEGATIVE) != 0
+    operator = byteAt(criteria, ruleOffset + RULE_OPERATOR)
+    condition = None
+    if field in STRING_FIELDS:
+        stringLength = byteAt(criteria, ruleOffset + RULE_STRING_LENGTH)
+        nextRule = ruleOffset + RULE_STRING + stringLength
+        value = criteria[ruleOffset + RULE_STRING:nextRule].decode('utf-16-be', errors = 'replace')
+        description = f"{STRING_FIELDS[field]} {'not ' if negative else ''}operator {operator:#x} '{value}'"
+        condition = compileStringRule(STRING_FIELDS[field], operator, value)
+    else:
+        nextRule = ruleOffset + NUMERIC_RULE_LENGTH
+        value = integerAt(criteria, ruleOffset + RULE_VALUE)
+        upperValue = integerAt(criteria, ruleOffset + RULE_UPPER_VALUE)
+        description = f"field {field:#x} {'not ' if negative else ''}operator {operator:#x} {value} {upperValue}"
+        if field in NUMERIC_FIELDS:
+            column, scale = NUMERIC_FIELDS[field]
+            description = f"{column} {'not ' if negative else ''}operator {operator:#x} {value} {upperValue}"
+            condition = compileNumericRule(column, operator, value * scale, upperValue * scale)
+        elif field in DATE_FIELDS:
+            column = DATE_FIELDS[field]
+            if operator == OPERATOR_OTHER and value == IN_THE_LAST:
+                period = -integerAt(criteria, ruleOffset + RULE_TIME_VALUE) * integerAt(criteria, ruleOffset + RULE_TIME_MULTIPLE)
+                description = f"{column} {'not ' if negative else ''}in the last {period} seconds"
+                condition = f"{column} > CAST(strftime('%s', 'now') AS INTEGER) - ?", [period]
+            else:
+                description = f"{column} {'not ' if negative else ''}operator {operator:#x} {value} {upperValue}"
+                condition = compileNumericRule(column, operator, value - MAC_EPOCH_OFFSET, upperValue - MAC_EPOCH_OFFSET)
+    if nextRule > len(criteria):
+        return None, description + ' (truncated)', len(criteria)
+    if condition is not None and negative:
+        # A song whose column is NULL does not match the rule, so matches its negation.
+        condition = (f"NOT IFNULL(({condition[0]}), 0)", condition[1])
+    return condition, description, nextRule
+
+def compileSmartPlaylist(smartInfo, smartCriteria):
+    """
+    Compiles the smart playlist's rules, limit and selection order.
+    Returns a tuple of the SQL selecting the rowid of each song of the playlist from songs, in
+    order, its list of parameters, and a list of the descriptions of the rules which could not
+    be compiled. The SQL is None if any could not be compiled.
+    """
+    conditions = []
+    parameters = []
+    uncompiled = []
+    if byteAt(smartInfo, INFO_MATCH_RULES) != 0:
+        if smartCriteria[:len(CRITERIA_HEADER)] != CRITERIA_HEADER:
+            uncompiled.append(f"criteria header {smartCriteria[:len(CRITERIA_HEADER)]}")
+        ruleOffset = CRITERIA_FIRST_RULE
+        while ruleOffset < len(smartCriteria):
+            condition, description, ruleOffset = compileRule(smartCriteria, ruleOffset)
+            if condition is None:
+                uncompiled.append(description)
+            else:
+                conditions.append(f"({condition[0]})")
+                parameters.extend(condition[1])
+    conjunction = ' OR ' if byteAt(smartCriteria, CRITERIA_CONJUNCTION) == 1 else ' AND '
+    where = conjunction.join(conditions) if len(conditions) > 0 else '1'
+
+    order = 'rowid'
+    limited = byteAt(smartInfo, INFO_LIMITED) != 0
+    # Without rules, only a limit selects songs from the whole library.
+    if len(conditions) == 0 and not limited:
+        uncompiled.append("no rules or limit, selecting the whole library")
+    if limited:
+        selection = byteAt(smartInfo, INFO_SELECTION)
+        if selection not in SELECTION_ORDERS:
+            uncompiled.append(f"selection {selection:#x}")
+        else:
+            order = SELECTION_ORDERS[selection]
+            if byteAt(smartInfo, INFO_SELECTION_REVERSED) != 0:
+                order = order.replace('ASC', 'REVERSED').replace('DESC', 'ASC').replace('REVERSED', 'DESC')
+        limitUnit = byteAt(smartInfo, INFO_LIMIT_UNIT)
+        limitValue = struct.unpack('>I', smartInfo[INFO_LIMIT_VALUE:INFO_LIMIT_VALUE + 4].rjust(4, b'\0'))[0]
+        if limitUnit != LIMIT_ITEMS and limitUnit not in LIMIT_UNITS:
+            uncompiled.append(f"limit unit {limitUnit:#x}")
+    if len(uncompiled) > 0:
+        return None, parameters, uncompiled
+
+    if not limited:
+        return f"SELECT rowid FROM songs WHERE {where} ORDER BY {order}", parameters, uncompiled
+    if limitUnit == LIMIT_ITEMS:
+        return f"SELECT rowid FROM songs WHERE {where} ORDER BY {order} LIMIT ?", parameters + [limitValue], uncompiled
+    # Limits of time or size select songs in order until their running total reaches the limit.
+    column, scale = LIMIT_UNITS[limitUnit]
+    selectSongs = f"""SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER selection AS position, SUM(max({column}, 0)) OVER selection AS total
+        FROM songs WHERE {where} WINDOW selection AS (ORDER BY {order} ROWS UNBOUNDED PRECEDING)) WHERE total <= ? ORDER BY position"""
+    return selectSongs, parameters + [limitValue * scale], uncompiled
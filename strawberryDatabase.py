@@ -0,0 +1,25 @@
+"""
+Shared access to the Strawberry music player SQLite database, used by each of the utilities.
+"""
+
+from runStatistics import runStatistics
+
+def executeUpdate(databaseCursor, statement, parameters = ()):
+    """
+    Execute a single INSERT, UPDATE or DELETE statement.
+    Returns the number of rows the statement changed, as reported by SQLite for that statement,
+    rather than querying the table afterwards. The time taken and rows changed are recorded as
+    the sql_writes phase and rows_written counter of the run statistics.
+    """
+    with runStatistics.phase('sql_writes'):
+        databaseCursor.execute(statement, parameters)
+    runStatistics.count('rows_written', databaseCursor.rowcount)
+    return databaseCursor.rowcount
+
+def likePattern(value, prefix, suffix):
+    """
+    Returns the LIKE pattern matching the value literally, with the wildcard prefix and suffix,
+    for a LIKE with an ESCAPE '\\' clause.
+    """
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{prefix}{escaped}{suffix}"
@@ -0,0 +1,57 @@
+"""
+Tests of consolidating the play analytics of pairs of tracks.
+"""
+
+import sqlite3
+import unittest
+from consolidateTracks import loadSongs, consolidatePairs, findCandidates, buildURLIndex
+
+class ConsolidatePairsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE songs (url TEXT, artist TEXT, title TEXT, album TEXT, length INTEGER, playcount INTEGER, lastplayed INTEGER, skipcount INTEGER)")
+        self.cursor.executemany("INSERT INTO songs VALUES (?, 'Artist', 'Title', 'Album', 0, ?, ?, ?)",
+                                [('file:///a.mp3', 5, 100, 1), ('file:///b.mp3', 0, 0, 0), ('file:///c.mp3', 4, 300, 2)])
+
+    def songCounts(self, url):
+        self.cursor.execute("SELECT playcount, lastplayed, skipcount FROM songs WHERE url = ?", (url,))
+        return self.cursor.fetchone()
+
+    def test_chained_pairs(self):
+        # Consolidating a into b, then b into c, gives c the plays of all three, as applying the pairs one by one does.
+        trackPairs = [('file:///a.mp3', 'file:///b.mp3'), ('file:///b.mp3', 'file:///c.mp3')]
+        updateCount = consolidatePairs(self.cursor, loadSongs(self.cursor), trackPairs, True)
+        self.assertEqual(updateCount, 2)
+        self.assertEqual(self.songCounts('file:///b.mp3'), (5, 100, 1))
+        self.assertEqual(self.songCounts('file:///c.mp3'), (9, 300, 3))
+
+    def test_repeated_to_track(self):
+        trackPairs = [('file:///a.mp3', 'file:///c.mp3'), ('file:///b.mp3', 'file:///c.mp3')]
+        consolidatePairs(self.cursor, loadSongs(self.cursor), trackPairs, True)
+        self.assertEqual(self.songCounts('file:///c.mp3'), (9, 300, 3))
+
+class FindCandidatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE songs (url TEXT)")
+        self.cursor.executemany("INSERT INTO songs VALUES (?)", [('file:///Music/Track_1.mp3',), ('file:///Music/TrackX1.mp3',), ('file:///Music/50%25.mp3',), ('file:///Music/50-25.mp3',), ('file:///Music/A\\B.mp3',)])
+
+    def candidateURLs(self, trackURL):
+        return [url for rowid, url in findCandidates(self.cursor, trackURL)]
+
+    def test_wildcards_are_literal(self):
+        # The % and _ of a fragment match themselves, rather than any characters.
+        for indexed in (False, True):
+            if indexed:
+                buildURLIndex(self.cursor)
+            self.assertEqual(self.candidateURLs('Track_1'), ['file:///Music/Track_1.mp3'])
+            self.assertEqual(self.candidateURLs('50%25'), ['file:///Music/50%25.mp3'])
+            self.assertEqual(self.candidateURLs('A\\B'), ['file:///Music/A\\B.mp3'])
+            self.assertEqual(self.candidateURLs('Track'), ['file:///Music/Track_1.mp3', 'file:///Music/TrackX1.mp3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests of updating the play counts of a Strawberry database from an iTunes library.
+"""
+
+import io
+import itertools
+import sqlite3
+import plistlib
+import unittest
+from datetime import datetime
+from iTunes2Strawberry import updatePlayCounts, albumClause
+from iTunesLibrary import LibraryReader
+from urlRewriting import URLRewriter
+
+class UpdatePlayCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        library = {'Major Version': 1, 'Minor Version': 1, 'Date': datetime(2022, 5, 1), 'Tracks': {
+            str(trackId): {'Track ID': trackId, 'Name': f"Track {trackId}", 'Artist': 'Artist', 'Location': f"file:///Music/{trackId}.mp3",
+                           'Play Count': trackId, 'Skip Count': 1, 'Play Date UTC': datetime(2020, 1, trackId)}
+            for trackId in range(1, 5)}, 'Playlists': []}
+        self.libraryContent = plistlib.dumps(library, sort_keys = False)
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("""CREATE TABLE songs (url TEXT, artist TEXT, title TEXT, album TEXT,
+            playcount INTEGER, skipcount INTEGER, lastplayed INTEGER)""")
+        # The last song has been played in Strawberry.
+        self.cursor.executemany("INSERT INTO songs VALUES (?, 'Artist', ?, ?, ?, 0, -1)",
+                                [(f"file:///Music/{trackId}.mp3", f"Track {trackId}", "Ray's Album" if trackId % 2 else 'Other', 10 if trackId == 4 else 0)
+                                 for trackId in range(1, 5)])
+
+    def tearDown(self):
+        self.client.close()
+
+    def update(self, album = '', updateUnplayed = False, updateExisting = False, bulk = False):
+        findClause, findParameters = albumClause(album)
+        return updatePlayCounts(LibraryReader(io.BytesIO(self.libraryContent)), self.cursor, findClause, updateUnplayed, updateExisting,
+                                bulk, URLRewriter([]), findParameters = findParameters)
+
+    def playCounts(self):
+        return [row[0] for row in self.cursor.execute("SELECT playcount FROM songs ORDER BY rowid")]
+
+    def test_find(self):
+        # Every mode only updates the songs of the album.
+        for updateUnplayed, updateExisting, bulk in itertools.product((False, True), repeat = 3):
+            if updateUnplayed and updateExisting:
+                continue
+            with self.subTest(updateUnplayed = updateUnplayed, updateExisting = updateExisting, bulk = bulk):
+                self.cursor.execute("UPDATE songs SET playcount = iif(rowid = 4, 10, 0), skipcount = 0, lastplayed = -1")
+                self.update("Ray's Album", updateUnplayed, updateExisting, bulk)
+                self.assertEqual(self.playCounts(), [1, 0, 3, 10])
+
+    def test_update_count(self):
+        # Each mode counts the songs it changed, so the changes are committed.
+        for updateUnplayed, updateExisting, bulk, expected in ((False, False, False, [1, 2, 3, 10]), (False, True, False, [1, 2, 3, 14]),
+                                                               (True, False, False, [1, 2, 3, 10]), (False, False, True, [1, 2, 3, 10]),
+                                                               (False, True, True, [1, 2, 3, 14]), (True, False, True, [1, 2, 3, 10])):
+            with self.subTest(updateUnplayed = updateUnplayed, updateExisting = updateExisting, bulk = bulk):
+                self.cursor.execute("UPDATE songs SET playcount = iif(rowid = 4, 10, 0), skipcount = 0, lastplayed = -1")
+                self.assertEqual(self.update('', updateUnplayed, updateExisting, bulk), 4 if updateExisting else 3)
+                self.assertEqual(self.playCounts(), expected)
+                # Nothing is left to update.
+                self.assertEqual(self.update('', updateUnplayed, False, bulk), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests of the incremental reader of the iTunes library XML file, against plistlib.
+"""
+
+import io
+import plistlib
+import unittest
+from datetime import datetime
+from iTunesLibrary import LibraryReader, Track
+
+def libraryPlist():
+    """
+    Returns a library of a few tracks and playlists, holding each kind of property list value.
+    """
+    tracks = {}
+    for trackId in range(1, 5):
+        tracks[str(trackId)] = {'Track ID': trackId, 'Name': f"Canción {trackId} & <Mix>", 'Artist': 'Björk', 'Total Time': 200000 + trackId,
+                                'Play Count': trackId, 'Play Date UTC': datetime(2020, 1, trackId, 12, 30, 5), 'Compilation': trackId % 2 == 0,
+                                'Volume Adjustment': 0.5, 'Location': f"file:///Music/Bj%C3%B6rk/{trackId:02d}.mp3"}
+    # A track never played, nor with a location.
+    tracks['5'] = {'Track ID': 5, 'Name': '', 'Disabled': False}
+    playlists = [{'Name': 'Library', 'Master': True, 'Playlist Items': [{'Track ID': trackId} for trackId in range(1, 6)]},
+                 {'Name': 'Smart', 'Smart Info': b'\x01\x00\x00', 'Smart Criteria': b'SLst\x00\x01', 'Playlist Items': [{'Track ID': 2}]},
+                 {'Name': 'Empty'}]
+    return {'Major Version': 1, 'Minor Version': 1, 'Date': datetime(2022, 5, 1), 'Application Version': '12.8',
+            'Tracks': tracks, 'Playlists': playlists, 'Music Folder': 'file:///Music/'}
+
+class LibraryReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = libraryPlist()
+        # Unsorted, the tracks precede the playlists, as iTunes writes them.
+        self.xml = plistlib.dumps(self.library, fmt = plistlib.FMT_XML, sort_keys = False)
+
+    def test_as_plistlib(self):
+        reader = LibraryReader(io.BytesIO(self.xml))
+        self.assertEqual(reader.header['Date'], self.library['Date'])
+        self.assertEqual(dict(reader.tracks()), plistlib.loads(self.xml)['Tracks'])
+        self.assertEqual(list(reader.playlists()), self.library['Playlists'])
+
+    def test_fields(self):
+        reader = LibraryReader(io.BytesIO(self.xml))
+        tracks = dict(reader.tracks(('Name', 'Play Count')))
+        self.assertEqual(tracks['2'], {'Name': 'Canción 2 & <Mix>', 'Play Count': 2})
+        self.assertEqual(tracks['5'], {'Name': ''})
+
+    def test_track_records(self):
+        reader = LibraryReader(io.BytesIO(self.xml))
+        records = {track.trackId: track for track in reader.trackRecords()}
+        self.assertIsInstance(records['1'], Track)
+        self.assertEqual((records['3'].name, records['3'].artist, records['3'].playCount), ('Canción 3 & <Mix>', 'Björk', 3))
+        self.assertEqual(records['3'].lastPlayed, int(datetime(2020, 1, 3, 12, 30, 5).timestamp()))
+        self.assertEqual((records['5'].artist, records['5'].location, records['5'].playCount), ('Unknown', None, 0))
+
+    def test_playlists_skip_tracks(self):
+        # Reading the playlists first skips the tracks undecoded.
+        reader = LibraryReader(io.BytesIO(self.xml))
+        self.assertEqual([playlist['Name'] for playlist in reader.playlists()], ['Library', 'Smart', 'Empty'])
+        self.assertEqual(list(reader.tracks()), [])
+
+    def test_playlists_before_tracks(self):
+        # Playlists preceding the tracks are held until the tracks have been read.
+        xml = plistlib.dumps(self.library, fmt = plistlib.FMT_XML, sort_keys = True)
+        self.assertLess(xml.index(b'<key>Playlists</key>'), xml.index(b'<key>Tracks</key>'))
+        reader = LibraryReader(io.BytesIO(xml))
+        self.assertEqual(dict(reader.tracks()), plistlib.loads(xml)['Tracks'])
+        self.assertEqual(list(reader.playlists()), self.library['Playlists'])
+
+if __name__ == '__main__':
+    unittest.main()
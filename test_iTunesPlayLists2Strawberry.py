@@ -0,0 +1,88 @@
+"""
+Tests of synchronising the items of Strawberry playlists with those of iTunes playlists.
+"""
+
+import io
+import sqlite3
+import unittest
+from iTunesLibrary import LibraryReader
+from iTunesPlayLists2Strawberry import readPlaylistItems, writePlaylistItems, syncPlaylistItems, importPlaylists
+from urlRewriting import URLRewriter
+
+def libraryXML(playlists):
+    """
+    Returns an iTunes library XML file of three tracks, and the playlists, each a (name, track ids) tuple.
+    """
+    tracks = ''.join(f"""<key>{trackId}</key><dict><key>Track ID</key><integer>{trackId}</integer><key>Name</key><string>Track {trackId}</string>
+        <key>Location</key><string>file:///Music/{trackId}.mp3</string></dict>""" for trackId in (1, 2, 3))
+    playlistElements = ''.join(f"""<dict><key>Name</key><string>{name}</string><key>Description</key><string></string><key>Playlist Items</key><array>
+        {''.join(f'<dict><key>Track ID</key><integer>{trackId}</integer></dict>' for trackId in trackIds)}</array></dict>""" for name, trackIds in playlists)
+    return io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict>
+        <key>Major Version</key><integer>1</integer><key>Minor Version</key><integer>1</integer><key>Date</key><date>2022-05-01T00:00:00Z</date>
+        <key>Tracks</key><dict>{tracks}</dict><key>Playlists</key><array>{playlistElements}</array></dict></plist>""".encode())
+
+class SyncPlaylistItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE playlists (name TEXT, ui_order INTEGER, is_favorite INTEGER)")
+        self.cursor.execute("CREATE TABLE playlist_items (playlist INTEGER, type INTEGER, collection_id INTEGER, source INTEGER)")
+        self.cursor.execute("CREATE TABLE songs (url TEXT)")
+        self.cursor.executemany("INSERT INTO songs (url) VALUES (?)", [(f"file:///Music/{trackId}.mp3",) for trackId in (1, 2, 3)])
+        self.cursor.execute("INSERT INTO playlists VALUES ('Mix', 0, 1)")
+        writePlaylistItems(self.cursor, 1, list(range(10)))
+
+    def items(self):
+        return readPlaylistItems(self.cursor).get(1, [])
+
+    def sync(self, collectionIds):
+        before = self.items()
+        changedCount = syncPlaylistItems(self.cursor, 'Mix', 1, collectionIds, before)
+        after = self.items()
+        self.assertEqual([collectionId for rowid, collectionId in after], collectionIds)
+        return changedCount, before, after
+
+    def test_unchanged(self):
+        changedCount, before, after = self.sync(list(range(10)))
+        self.assertEqual(changedCount, 0)
+
+    def test_delete(self):
+        changedCount, before, after = self.sync([0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(changedCount, 1)
+        self.assertEqual(after, before[:3] + before[4:])
+
+    def test_append(self):
+        changedCount, before, after = self.sync(list(range(11)))
+        self.assertEqual(changedCount, 1)
+        self.assertEqual(after[:10], before)
+
+    def test_insert(self):
+        # The items following the insertion are written over in place, the last appended.
+        changedCount, before, after = self.sync([0, 1, 2, 3, 4, 5, 6, 7, 99, 8, 9])
+        self.assertEqual(changedCount, 3)
+        self.assertEqual(after[:8], before[:8])
+
+    def test_insert_and_delete(self):
+        # The items between the insertion and the deletion are moved along, leaving the others untouched.
+        changedCount, before, after = self.sync([0, 1, 99, 2, 3, 5, 6, 7, 8, 9])
+        self.assertEqual(changedCount, 3)
+        self.assertEqual(after[5:], before[5:])
+
+    def test_reorder(self):
+        # Moving an item to the end deletes it, and appends it.
+        changedCount, before, after = self.sync([0, 1, 2, 4, 5, 6, 7, 8, 9, 3])
+        self.assertEqual(changedCount, 2)
+        self.assertEqual(after[:9], before[:3] + before[4:])
+
+    def test_same_name_playlists(self):
+        # The second of two iTunes playlists of the same name is synchronised with the items the first left.
+        self.cursor.execute("DELETE FROM playlist_items")
+        self.cursor.execute("INSERT INTO playlists VALUES ('Twice', 0, 1)")
+        writePlaylistItems(self.cursor, 2, [1, 2])
+        library = LibraryReader(libraryXML([('Twice', [3, 2, 1]), ('Twice', [3])]))
+        importPlaylists(library, self.cursor, URLRewriter([]), syncPlaylists = True)
+        self.assertEqual([collectionId for rowid, collectionId in readPlaylistItems(self.cursor)[2]], [3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests of the byte offset index of the tracks of an iTunes library XML file, and of its
+fingerprint of the library.
+"""
+
+import os
+import shutil
+import plistlib
+import tempfile
+import unittest
+from datetime import datetime
+from libraryIndex import openIndexedLibrary, readIndex, writeIndex
+from iTunesLibrary import LibraryReader
+
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.libraryPath = os.path.join(self.directory, 'Library.xml')
+        self.indexPath = self.libraryPath + '.index'
+        # An album name decomposed, with a character escaped in the XML.
+        self.library = {'Major Version': 1, 'Minor Version': 1, 'Date': datetime(2022, 5, 1), 'Tracks': {
+            str(trackId): {'Track ID': trackId, 'Name': f"Track {trackId}", 'Album': 'Ho\u0301moge\u0301nic & Co' if trackId % 2 else 'Post',
+                           'Location': f"file:///Music/{trackId}.mp3", 'Play Count': trackId, 'Play Date UTC': datetime(2020, 1, trackId)}
+            for trackId in range(1, 10)},
+            'Playlists': [{'Name': 'Mix', 'Playlist Items': [{'Track ID': 2}, {'Track ID': 1}]}]}
+        self.writeLibrary()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeLibrary(self):
+        with open(self.libraryPath, 'wb') as libraryFile:
+            plistlib.dump(self.library, libraryFile, sort_keys = False)
+
+    def fingerprint(self):
+        libraryStat = os.stat(self.libraryPath)
+        return libraryStat.st_size, libraryStat.st_mtime_ns
+
+    def readRecords(self, album = None):
+        with openIndexedLibrary(self.libraryPath, self.indexPath, album) as library:
+            return [repr(track) for track in library.trackRecords()], list(library.playlists())
+
+    def test_as_library_reader(self):
+        with open(self.libraryPath, 'rb') as libraryFile:
+            reader = LibraryReader(libraryFile)
+            records = [repr(track) for track in reader.trackRecords()]
+            playlists = list(reader.playlists())
+        self.assertEqual(self.readRecords(), (records, playlists))
+        # Read again by the index written.
+        self.assertIsNot(readIndex(self.indexPath, self.fingerprint()), False)
+        self.assertEqual(self.readRecords(), (records, playlists))
+        with openIndexedLibrary(self.libraryPath, self.indexPath) as library:
+            self.assertEqual(library.header['Date'], datetime(2022, 5, 1))
+            trackTable = library.trackTable()
+            self.assertEqual(len(trackTable), 9)
+            self.assertEqual(trackTable['4'].playCount, 4)
+            self.assertNotIn('10', trackTable)
+
+    def test_album(self):
+        with open(self.libraryPath, 'rb') as libraryFile:
+            records = [repr(track) for track in LibraryReader(libraryFile).trackRecords() if int(track.trackId) % 2 == 1]
+        # Looked up by the composed name.
+        self.assertEqual(self.readRecords('H\u00f3mog\u00e9nic & Co')[0], records)
+        self.assertEqual(self.readRecords('Missing')[0], [])
+
+    def test_fingerprint(self):
+        self.readRecords()
+        fingerprint = self.fingerprint()
+        self.assertIsNot(readIndex(self.indexPath, fingerprint), False)
+        # A different size, or modification time, is another library.
+        self.assertIs(readIndex(self.indexPath, (fingerprint[0] + 1, fingerprint[1])), False)
+        self.assertIs(readIndex(self.indexPath, (fingerprint[0], fingerprint[1] + 1)), False)
+        # The library changed, which is indexed again.
+        self.library['Tracks']['12'] = {'Track ID': 12, 'Name': 'Added', 'Play Date UTC': datetime(2021, 1, 1)}
+        self.writeLibrary()
+        self.assertIs(readIndex(self.indexPath, self.fingerprint()), False)
+        self.assertIn("name='Added'", self.readRecords()[0][-1])
+        self.assertIsNot(readIndex(self.indexPath, self.fingerprint()), False)
+
+    def test_not_an_index(self):
+        self.assertIs(readIndex(os.path.join(self.directory, 'missing'), self.fingerprint()), False)
+        with open(self.indexPath, 'wb') as indexFile:
+            indexFile.write(b'not an index')
+        self.assertIs(readIndex(self.indexPath, self.fingerprint()), False)
+        writeIndex(self.indexPath, self.fingerprint(), None)
+        self.assertIsNone(readIndex(self.indexPath, self.fingerprint()))
+
+if __name__ == '__main__':
+    unittest.main()
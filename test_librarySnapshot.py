@@ -0,0 +1,89 @@
+"""
+Tests of the snapshot of an iTunes library XML file, and of its fingerprint of the library.
+"""
+
+import os
+import shutil
+import plistlib
+import tempfile
+import unittest
+from datetime import datetime
+from librarySnapshot import openLibrary, readSnapshot
+from iTunesLibrary import LibraryReader
+
+class LibrarySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.libraryPath = os.path.join(self.directory, 'Library.xml')
+        self.snapshotPath = self.libraryPath + '.snapshot'
+        self.library = {'Major Version': 1, 'Minor Version': 1, 'Date': datetime(2022, 5, 1), 'Tracks': {
+            '1': {'Track ID': 1, 'Name': 'One', 'Artist': 'Björk', 'Location': 'file:///Music/Bjo%CC%88rk/01.mp3', 'Play Count': 3,
+                  'Play Date UTC': datetime(2020, 1, 2, 3, 4, 5), 'Skip Count': 1, 'Skip Date': datetime(2019, 1, 1)},
+            '2': {'Track ID': 2, 'Name': 'Two'}},
+            'Playlists': [{'Name': 'Mix', 'Smart Info': b'\x01', 'Playlist Items': [{'Track ID': 2}, {'Track ID': 1}]}]}
+        self.writeLibrary(self.library)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeLibrary(self, library):
+        with open(self.libraryPath, 'wb') as libraryFile:
+            plistlib.dump(library, libraryFile, sort_keys = False)
+
+    def readLibrary(self):
+        """
+        Returns the header, Track records, playlists and converted URLs read from the library.
+        """
+        with openLibrary(self.libraryPath, self.snapshotPath) as library:
+            tracks = [(track.trackId, track.name, track.artist, track.location, track.playCount, track.skipCount, track.lastPlayed)
+                      for track in library.trackRecords()]
+            return library.header, tracks, list(library.playlists()), [library.convertURL(track[3]) for track in tracks if track[3] is not None]
+
+    def test_snapshot_as_library(self):
+        parsed = self.readLibrary()
+        self.assertIsNotNone(readSnapshot(self.snapshotPath, self.libraryPath))
+        self.assertEqual(self.readLibrary(), parsed)
+        with open(self.libraryPath, 'rb') as libraryFile:
+            reader = LibraryReader(libraryFile)
+            tracks = [(track.trackId, track.name, track.artist, track.location, track.playCount, track.skipCount, track.lastPlayed)
+                      for track in reader.trackRecords()]
+            self.assertEqual(tracks, parsed[1])
+            self.assertEqual(list(reader.playlists()), parsed[2])
+
+    def test_modified_time_changed(self):
+        # A copy of the library, with a new modification time, is recognised by its hash.
+        self.readLibrary()
+        libraryStat = os.stat(self.libraryPath)
+        os.utime(self.libraryPath, ns = (libraryStat.st_atime_ns, libraryStat.st_mtime_ns + 10**9))
+        self.assertIsNotNone(readSnapshot(self.snapshotPath, self.libraryPath))
+
+    def test_library_changed(self):
+        self.readLibrary()
+        libraryStat = os.stat(self.libraryPath)
+        # The same size, but a different play count.
+        self.library['Tracks']['1']['Play Count'] = 4
+        self.writeLibrary(self.library)
+        self.assertEqual(os.stat(self.libraryPath).st_size, libraryStat.st_size)
+        self.assertIsNone(readSnapshot(self.snapshotPath, self.libraryPath))
+        self.assertEqual(self.readLibrary()[1][0][4], 4)
+        self.assertIsNotNone(readSnapshot(self.snapshotPath, self.libraryPath))
+        # A different size.
+        self.library['Tracks']['2']['Play Count'] = 1
+        self.writeLibrary(self.library)
+        self.assertIsNone(readSnapshot(self.snapshotPath, self.libraryPath))
+
+    def test_not_a_snapshot(self):
+        for content in (b'', b'ITLSNAP0' + bytes(60)):
+            with open(self.snapshotPath, 'wb') as snapshotFile:
+                snapshotFile.write(content)
+            self.assertIsNone(readSnapshot(self.snapshotPath, self.libraryPath))
+        self.assertIsNone(readSnapshot(os.path.join(self.directory, 'missing'), self.libraryPath))
+        # A snapshot of the library cut short.
+        self.readLibrary()
+        os.truncate(self.snapshotPath, os.stat(self.snapshotPath).st_size - 10)
+        self.assertIsNone(readSnapshot(self.snapshotPath, self.libraryPath))
+        self.assertEqual(self.readLibrary()[1][1][1], 'Two')
+
+if __name__ == '__main__':
+    unittest.main()
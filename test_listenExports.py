@@ -0,0 +1,90 @@
+"""
+Tests of reading the listens of exported listening histories of each form.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import listenExports
+from listenExports import exportListens
+from listenbrainzHistory import Listen
+
+class ExportListensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def listens(self, name, content):
+        exportPath = os.path.join(self.directory, name)
+        with open(exportPath, 'w', encoding = 'utf-8') as exportFile:
+            exportFile.write(content)
+        return list(exportListens(exportPath))
+
+    def listenBrainzPayload(self, listenedAt, trackName):
+        return {'listened_at': listenedAt, 'recording_msid': f"msid-{trackName}",
+                'track_metadata': {'artist_name': 'Björk', 'track_name': trackName, 'additional_info': {}}}
+
+    def test_listenbrainz_json_array(self):
+        payloads = [self.listenBrainzPayload(1600000000 + index, f"Track {index}") for index in range(50)]
+        # Elements split across the reads of the file are decoded whole.
+        readSize = listenExports.READ_SIZE
+        listenExports.READ_SIZE = 100
+        try:
+            listens = self.listens('listens.json', json.dumps(payloads, indent = 2))
+        finally:
+            listenExports.READ_SIZE = readSize
+        self.assertEqual(len(listens), 50)
+        self.assertEqual(listens[49], Listen('Björk', 'Track 49', 1600000049, 'msid-Track 49'))
+
+    def test_listenbrainz_json_lines(self):
+        # Timestamps may be ISO 8601 dates.
+        content = json.dumps(self.listenBrainzPayload(1600000000, 'One')) + '\n\n' + json.dumps(self.listenBrainzPayload('2020-09-13T12:26:41Z', 'Two')) + '\n'
+        self.assertEqual(self.listens('listens.jsonl', content),
+                         [Listen('Björk', 'One', 1600000000, 'msid-One'), Listen('Björk', 'Two', 1600000001, 'msid-Two')])
+
+    def test_lastfm_pages(self):
+        pages = [{'recenttracks': {'track': [
+                     {'artist': {'#text': 'Björk'}, 'name': 'Now Playing', '@attr': {'nowplaying': 'true'}},
+                     {'artist': {'#text': 'Björk'}, 'name': 'Army of Me', 'mbid': 'mbid-1', 'date': {'uts': '1600000000'}}]}},
+                 {'recenttracks': {'track': {'artist': {'#text': 'Sigur Rós'}, 'name': 'Hoppípolla', 'mbid': '', 'date': {'uts': '1599999000'}}}}]
+        self.assertEqual(self.listens('lastfm.json', json.dumps(pages)),
+                         [Listen('Björk', 'Army of Me', 1600000000, 'mbid-1'), Listen('Sigur Rós', 'Hoppípolla', 1599999000, 'Sigur Rós\tHoppípolla')])
+
+    def test_lastfm_single_page(self):
+        page = {'recenttracks': {'track': [{'artist': {'#text': 'Björk'}, 'name': 'Army of Me', 'date': {'uts': '1600000000000'}}]}}
+        self.assertEqual(self.listens('lastfm.json', json.dumps(page, indent = 2)), [Listen('Björk', 'Army of Me', 1600000000, 'Björk\tArmy of Me')])
+
+    def scrobblerLog(self, timeZone):
+        return (f"#AUDIOSCROBBLER/1.1\n#TZ/{timeZone}\n#CLIENT/Rockbox\n"
+                "Björk\tPost\tArmy of Me\t1\t234\tL\t1600000000\tmbid-1\n"
+                "Björk\tPost\tHyper-Ballad\t2\t321\tS\t1600000300\t\n"
+                "Björk\tPost\tIsobel\t3\t347\tL\t1600000600\t\n")
+
+    def test_scrobbler_log_utc(self):
+        self.assertEqual(self.listens('.scrobbler.log', self.scrobblerLog('UTC')),
+                         [Listen('Björk', 'Army of Me', 1600000000, 'mbid-1'), Listen('Björk', 'Isobel', 1600000600, 'Björk\tIsobel')])
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), "Needs the time zone to be set")
+    def test_scrobbler_log_local_time(self):
+        # The player's clock was five hours behind UTC, with no daylight saving time.
+        timeZone = os.environ.get('TZ')
+        os.environ['TZ'] = 'EST+05'
+        time.tzset()
+        try:
+            listens = self.listens('.scrobbler.log', self.scrobblerLog('UNKNOWN'))
+        finally:
+            if timeZone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = timeZone
+            time.tzset()
+        self.assertEqual([listen.listened_at for listen in listens], [1600000000 + 5 * 3600, 1600000600 + 5 * 3600])
+
+if __name__ == '__main__':
+    unittest.main()
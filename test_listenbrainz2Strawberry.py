@@ -0,0 +1,44 @@
+"""
+Tests of matching ListenBrainz listens to the songs of the Strawberry database.
+"""
+
+import sqlite3
+import unittest
+from listenbrainzHistory import Listen
+from listenbrainz2Strawberry import load_track_index, get_track_from_strawberry, get_updated_plays, update_database
+
+class TrackIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE songs (url TEXT, artist TEXT, title TEXT, playcount INTEGER, lastplayed INTEGER)")
+        self.cursor.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?)",
+                                [('file:///a.mp3', 'Björk', 'Army of Me', 2, 100),
+                                 ('file:///b.mp3', 'Brian Eno & David Byrne', 'America Is Waiting', 0, -1),
+                                 ('file:///c.mp3', "Guns N' Roses", "Sweet Child O' Mine", 5, 500),
+                                 ('file:///d.mp3', None, None, 0, -1)])
+
+    def matchedURL(self, artistName, trackName):
+        track = get_track_from_strawberry(load_track_index(self.cursor), Listen(artistName, trackName, 1000, 'recording'))
+        return track['url'] if track is not None else None
+
+    def test_matching(self):
+        self.assertEqual(self.matchedURL('BJÖRK', 'army of me'), 'file:///a.mp3')
+        # Punctuation and spacing are ignored, and multiple artists may be in any order.
+        self.assertEqual(self.matchedURL('Guns N Roses', 'Sweet Child O Mine'), 'file:///c.mp3')
+        self.assertEqual(self.matchedURL('David Byrne and Brian Eno', 'America Is Waiting'), 'file:///b.mp3')
+        self.assertEqual(self.matchedURL('David Byrne', 'America Is Waiting'), None)
+        self.assertEqual(self.matchedURL('Björk', 'Hyperballad'), None)
+
+    def test_updated_plays(self):
+        listens = [Listen('Björk', 'Army of Me', 150, 'a1'), Listen('bjork', 'Army of Me', 90, 'a0'), Listen('björk', 'ARMY OF ME', 300, 'a2'),
+                   Listen("Guns N' Roses", "Sweet Child O' Mine", 400, 'c1'), Listen('Unknown', 'Unknown', 500, 'x')]
+        updatedPlays = get_updated_plays(self.cursor, listens)
+        # Only the listens after the last played time are counted, and the index is left as the database is.
+        self.assertEqual(updatedPlays, {'file:///a.mp3': {'url': 'file:///a.mp3', 'playcount': 4, 'lastplayed': 300}})
+        self.assertEqual(update_database(self.cursor, updatedPlays), 1)
+        self.assertEqual(self.cursor.execute("SELECT playcount, lastplayed FROM songs WHERE url = 'file:///a.mp3'").fetchone(), (4, 300))
+
+if __name__ == '__main__':
+    unittest.main()
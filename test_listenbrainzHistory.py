@@ -0,0 +1,81 @@
+"""
+Tests of retrieving the ListenBrainz listening history into the listen cache, from a local
+stand-in server, and of applying the listens retrieved to the Strawberry database.
+"""
+
+import sqlite3
+import unittest
+import urllib.parse
+from listenbrainzHistory import ListenBrainzPages, ListenCache, ReplayServer, syncListens
+from listenbrainz2Strawberry import sync_cached_listens, get_updated_plays, update_database
+
+class ListenHistory(dict):
+    """
+    A recording of the ListenBrainz API which answers every request for the listens of a user
+    from the history of (listened_at, track name) listens, newest first, as ListenBrainz does.
+    """
+    def __init__(self, listens):
+        super().__init__()
+        self.history = sorted(listens, reverse = True)
+
+    def get(self, pathQuery, default = None):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(pathQuery).query))
+        maxTs = int(query.get('max_ts', 2**62))
+        page = [(listenedAt, trackName) for listenedAt, trackName in self.history if listenedAt < maxTs][:int(query['count'])]
+        return {'payload': {'count': len(page), 'listens': [
+            {'listened_at': listenedAt, 'recording_msid': f"msid-{trackName}-{listenedAt}",
+             'track_metadata': {'artist_name': 'Artist', 'track_name': trackName}} for listenedAt, trackName in page]}}
+
+class SyncListensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ListenCache(':memory:')
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE songs (url TEXT, artist TEXT, title TEXT, playcount INTEGER, lastplayed INTEGER)")
+        self.cursor.executemany("INSERT INTO songs VALUES (?, 'Artist', ?, 0, -1)", [('file:///a.mp3', 'A'), ('file:///b.mp3', 'B')])
+
+    def tearDown(self):
+        self.cache.close()
+        self.client.close()
+
+    def songCounts(self):
+        return self.cursor.execute("SELECT url, playcount, lastplayed FROM songs ORDER BY rowid").fetchall()
+
+    def importListens(self, recording, pageSize = 2):
+        """
+        Retrieves the listens served from the recording, and applies them to the songs.
+        Returns the number of songs updated.
+        """
+        with ReplayServer(recording) as replayServer:
+            listens = sync_cached_listens(self.cache, ListenBrainzPages(replayServer.apiURL, pageSize), 'user')
+            return update_database(self.cursor, get_updated_plays(self.cursor, listens))
+
+    def test_record_and_replay(self):
+        recording = {}
+        with ReplayServer(ListenHistory([(100, 'A'), (200, 'B'), (200, 'A'), (300, 'A'), (400, 'B')])) as replayServer:
+            retrievedCount, addedCount = syncListens(self.cache, ListenBrainzPages(replayServer.apiURL, 2, recording), 'user')
+        self.assertEqual(addedCount, 5)
+        replayCache = ListenCache(':memory:')
+        with ReplayServer(recording) as replayServer:
+            syncListens(replayCache, ListenBrainzPages(replayServer.apiURL, 2), 'user')
+        self.assertEqual(list(replayCache.listens('user')), list(self.cache.listens('user')))
+        self.assertEqual(replayCache.highWaterMark('user'), 400)
+        replayCache.close()
+
+    def test_second_run_changes_nothing(self):
+        history = ListenHistory([(100, 'A'), (200, 'B'), (200, 'A'), (300, 'A'), (400, 'B')])
+        self.assertEqual(self.importListens(history), 2)
+        self.assertEqual(self.songCounts(), [('file:///a.mp3', 3, 300), ('file:///b.mp3', 2, 400)])
+        self.assertEqual(self.importListens(history), 0)
+        self.assertEqual(self.songCounts(), [('file:///a.mp3', 3, 300), ('file:///b.mp3', 2, 400)])
+
+    def test_only_new_listens_applied(self):
+        self.importListens(ListenHistory([(100, 'A'), (200, 'B')]))
+        # Song B was scanned into the collection again, losing its plays, which are not applied again.
+        self.cursor.execute("UPDATE songs SET playcount = 0, lastplayed = -1 WHERE url = 'file:///b.mp3'")
+        self.assertEqual(self.importListens(ListenHistory([(100, 'A'), (200, 'B'), (300, 'A'), (350, 'A')])), 1)
+        self.assertEqual(self.songCounts(), [('file:///a.mp3', 3, 350), ('file:///b.mp3', 0, -1)])
+
+if __name__ == '__main__':
+    unittest.main()
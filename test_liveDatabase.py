@@ -0,0 +1,109 @@
+"""
+Tests of updating a snapshot of a Strawberry database, and swapping it for the database.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from liveDatabase import LiveDatabase, LiveDatabaseError, databaseToUpdate, SNAPSHOT_SUFFIX, ROLLBACK_SUFFIX
+
+class LiveDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databasePath = os.path.join(self.directory, 'strawberry.db')
+        self.snapshotPath = self.databasePath + SNAPSHOT_SUFFIX
+        self.rollbackPath = self.databasePath + ROLLBACK_SUFFIX
+        self.execute(self.databasePath, "CREATE TABLE songs (url TEXT, playcount INTEGER)",
+                     "INSERT INTO songs VALUES ('file:///a.mp3', 0), ('file:///b.mp3', 0)",
+                     "CREATE TABLE playlists (name TEXT)")
+        # Strawberry, with the database open.
+        self.strawberryClient = sqlite3.connect(self.databasePath)
+
+    def tearDown(self):
+        self.strawberryClient.close()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def execute(databasePath, *statements):
+        client = sqlite3.connect(databasePath)
+        try:
+            for statement in statements:
+                client.execute(statement)
+            client.commit()
+        finally:
+            client.close()
+
+    @staticmethod
+    def playCounts(databasePath):
+        client = sqlite3.connect(databasePath)
+        try:
+            return client.execute("SELECT url, playcount FROM songs ORDER BY rowid").fetchall()
+        finally:
+            client.close()
+
+    def test_replace(self):
+        with LiveDatabase(self.databasePath) as snapshotPath:
+            self.assertEqual(snapshotPath, self.snapshotPath)
+            self.execute(snapshotPath, "UPDATE songs SET playcount = 3 WHERE url = 'file:///a.mp3'", "INSERT INTO playlists VALUES ('Mix')")
+        self.assertEqual(self.playCounts(self.databasePath), [('file:///a.mp3', 3), ('file:///b.mp3', 0)])
+        self.assertEqual(self.playCounts(self.rollbackPath), [('file:///a.mp3', 0), ('file:///b.mp3', 0)])
+        self.assertFalse(os.path.exists(self.snapshotPath))
+
+    def test_unchanged(self):
+        liveDatabase = LiveDatabase(self.databasePath)
+        snapshotPath = liveDatabase.snapshot()
+        self.assertEqual(self.playCounts(snapshotPath), self.playCounts(self.databasePath))
+        self.assertFalse(liveDatabase.replace())
+        self.assertFalse(os.path.exists(self.snapshotPath))
+        self.assertFalse(os.path.exists(self.rollbackPath))
+
+    def test_block_raised(self):
+        with self.assertRaises(KeyError):
+            with LiveDatabase(self.databasePath) as snapshotPath:
+                self.execute(snapshotPath, "UPDATE songs SET playcount = 3")
+                raise KeyError('stop')
+        self.assertEqual(self.playCounts(self.databasePath), [('file:///a.mp3', 0), ('file:///b.mp3', 0)])
+        self.assertFalse(os.path.exists(self.snapshotPath))
+        self.assertFalse(os.path.exists(self.rollbackPath))
+
+    def test_written_meanwhile(self):
+        with self.assertRaises(LiveDatabaseError):
+            with LiveDatabase(self.databasePath) as snapshotPath:
+                self.execute(snapshotPath, "UPDATE songs SET playcount = 3")
+                self.strawberryClient.execute("UPDATE songs SET playcount = 1 WHERE url = 'file:///b.mp3'")
+                self.strawberryClient.commit()
+        # Strawberry's write is kept, and the snapshot left to be inspected.
+        self.assertEqual(self.playCounts(self.databasePath), [('file:///a.mp3', 0), ('file:///b.mp3', 1)])
+        self.assertEqual(self.playCounts(self.snapshotPath), [('file:///a.mp3', 3), ('file:///b.mp3', 3)])
+        self.assertFalse(os.path.exists(self.rollbackPath))
+
+    def test_failed_checks(self):
+        for statement in ("DROP TABLE playlists", "DELETE FROM songs WHERE url = 'file:///b.mp3'",
+                          "INSERT INTO songs VALUES ('file:///c.mp3', 1)"):
+            with self.subTest(statement = statement):
+                with self.assertRaises(LiveDatabaseError):
+                    with LiveDatabase(self.databasePath) as snapshotPath:
+                        self.execute(snapshotPath, statement)
+                self.assertEqual(self.playCounts(self.databasePath), [('file:///a.mp3', 0), ('file:///b.mp3', 0)])
+                os.remove(self.snapshotPath)
+        # Rows may be added to the other tables.
+        with LiveDatabase(self.databasePath) as snapshotPath:
+            self.execute(snapshotPath, "INSERT INTO playlists VALUES ('Mix')")
+
+    def test_write_ahead_log(self):
+        self.strawberryClient.execute("PRAGMA journal_mode = WAL")
+        with self.assertRaises(LiveDatabaseError):
+            with LiveDatabase(self.databasePath):
+                self.fail("A snapshot was taken of a database using a write-ahead log")
+        self.assertFalse(os.path.exists(self.snapshotPath))
+
+    def test_not_live(self):
+        with databaseToUpdate(self.databasePath, False) as databasePath:
+            self.assertEqual(databasePath, self.databasePath)
+        self.assertFalse(os.path.exists(self.snapshotPath))
+
+if __name__ == '__main__':
+    unittest.main()
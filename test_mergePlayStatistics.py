@@ -0,0 +1,71 @@
+"""
+Tests of merging the play statistics of several Strawberry databases and iTunes libraries.
+"""
+
+import os
+import shutil
+import sqlite3
+import plistlib
+import tempfile
+import unittest
+from datetime import datetime
+from mergePlayStatistics import isLibraryXML, combineSources, writeCombined
+from urlRewriting import URLRewriter
+
+def createDatabase(path, songs):
+    """
+    Creates a database of the (url, playcount, skipcount, lastplayed) songs.
+    """
+    client = sqlite3.connect(path)
+    client.execute("CREATE TABLE songs (url TEXT, playcount INTEGER, skipcount INTEGER, lastplayed INTEGER)")
+    client.executemany("INSERT INTO songs VALUES (?, ?, ?, ?)", songs)
+    client.commit()
+    client.close()
+
+class MergePlayStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.laptopPath = os.path.join(self.directory, 'laptop.db')
+        self.studioPath = os.path.join(self.directory, 'studio.db')
+        self.libraryPath = os.path.join(self.directory, 'Library.xml')
+        createDatabase(self.laptopPath, [('file:///Media/a.mp3', 2, 1, 200), ('file:///Media/b.mp3', 0, 0, -1)])
+        createDatabase(self.studioPath, [('file:///Media/a.mp3', 3, 0, 100), ('file:///Media/b.mp3', 1, 0, 50)])
+        library = {'Major Version': 1, 'Minor Version': 1, 'Tracks': {
+            '1': {'Track ID': 1, 'Location': 'file:///iTunes/a.mp3', 'Play Count': 4, 'Play Date UTC': datetime(1970, 1, 1, 0, 5)},
+            '2': {'Track ID': 2, 'Location': 'file:///iTunes/c.mp3'},
+            '3': {'Track ID': 3, 'Play Count': 1}}, 'Playlists': []}
+        with open(self.libraryPath, 'wb') as libraryFile:
+            # A byte order mark before the declaration.
+            libraryFile.write(b'\xef\xbb\xbf' + plistlib.dumps(library, sort_keys = False))
+        self.urlRewriter = URLRewriter([('iTunes', 'Media')])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_source_kinds(self):
+        self.assertTrue(isLibraryXML(self.libraryPath))
+        self.assertFalse(isLibraryXML(self.laptopPath))
+
+    def test_combine(self):
+        playDate = int(datetime(1970, 1, 1, 0, 5).timestamp())
+        combined = combineSources([('sum', self.laptopPath), ('sum', self.studioPath), ('max', self.libraryPath)], self.urlRewriter)
+        self.assertEqual(combined, {'file:///Media/a.mp3': [5, 1, max(200, playDate)], 'file:///Media/b.mp3': [1, 0, 50]})
+        combined = combineSources([('max', self.laptopPath), ('max', self.studioPath), ('sum', self.libraryPath)], self.urlRewriter)
+        self.assertEqual(combined['file:///Media/a.mp3'], [7, 1, max(200, playDate)])
+
+    def test_write_combined(self):
+        combined = {'file:///Media/a.mp3': [5, 1, 300], 'file:///Media/missing.mp3': [1, 0, 10]}
+        for targetPolicy, expected in (('max', (5, 2, 400)), ('sum', (7, 3, 400)), ('replace', (5, 1, 300))):
+            client = sqlite3.connect(':memory:')
+            client.execute("CREATE TABLE songs (url TEXT, playcount INTEGER, skipcount INTEGER, lastplayed INTEGER)")
+            client.execute("INSERT INTO songs VALUES ('file:///Media/a.mp3', 2, 2, 400)")
+            cursor = client.cursor()
+            self.assertEqual(writeCombined(cursor, combined, targetPolicy, dryRun = True), 1)
+            self.assertEqual(cursor.execute("SELECT playcount, skipcount, lastplayed FROM songs").fetchone(), (2, 2, 400))
+            self.assertEqual(writeCombined(cursor, combined, targetPolicy), 1)
+            self.assertEqual(cursor.execute("SELECT playcount, skipcount, lastplayed FROM songs").fetchone(), expected)
+            client.close()
+
+if __name__ == '__main__':
+    unittest.main()
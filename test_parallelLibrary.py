@@ -0,0 +1,95 @@
+"""
+Tests of the parallel reader of the iTunes library XML file, and the splicing of the rest of
+the file around the tracks it parses.
+"""
+
+import io
+import os
+import shutil
+import plistlib
+import tempfile
+import unittest
+from datetime import datetime
+import parallelLibrary
+from parallelLibrary import SplicedFile, ParallelLibraryReader, findTrackRanges
+from iTunesLibrary import LibraryReader
+from urlConversion import convertURLs
+
+class SplicedFileTest(unittest.TestCase):
+
+    def test_reads(self):
+        content = bytes(range(256)) * 4
+        for start, end in ((0, 0), (0, 10), (100, 300), (1000, 1024), (1024, 1024)):
+            for size in (-1, 1, 7, 100, 2000):
+                splicedFile = SplicedFile(io.BytesIO(content), start, end)
+                chunks = []
+                while True:
+                    chunk = splicedFile.read(size)
+                    if len(chunk) == 0:
+                        break
+                    self.assertLessEqual(len(chunk), size if size >= 0 else len(content))
+                    chunks.append(chunk)
+                self.assertEqual(b''.join(chunks), content[:start] + content[end:], (start, end, size))
+
+class ParallelLibraryReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.libraryPath = os.path.join(self.directory, 'Library.xml')
+        tracks = {str(trackId): {'Track ID': trackId, 'Name': f"Canción {trackId} <{trackId}>", 'Artist': 'Björk', 'Play Count': trackId,
+                                 'Play Date UTC': datetime(2020, 1, 1 + trackId % 28), 'Location': f"file:///Music/Bjo%CC%88rk/{trackId}.mp3"}
+                  for trackId in range(1, 200)}
+        # A track without a location, dated so its record does not default to the time it is read.
+        tracks['200'] = {'Track ID': 200, 'Name': 'Stream', 'Play Date UTC': datetime(2021, 1, 1)}
+        library = {'Major Version': 1, 'Minor Version': 1, 'Date': datetime(2022, 5, 1), 'Tracks': tracks,
+                   'Playlists': [{'Name': 'Mix', 'Playlist Items': [{'Track ID': 2}, {'Track ID': 1}]}], 'Music Folder': 'file:///Music/'}
+        with open(self.libraryPath, 'wb') as libraryFile:
+            plistlib.dump(library, libraryFile, sort_keys = False)
+        # Ranges small enough that the tracks are split between several.
+        self.minimumRangeSize = parallelLibrary.MINIMUM_RANGE_SIZE
+        parallelLibrary.MINIMUM_RANGE_SIZE = 1000
+
+    def tearDown(self):
+        parallelLibrary.MINIMUM_RANGE_SIZE = self.minimumRangeSize
+        shutil.rmtree(self.directory)
+
+    def test_track_ranges(self):
+        with open(self.libraryPath, 'rb') as libraryFile:
+            content = libraryFile.read()
+        contentStart, contentEnd, ranges = findTrackRanges(content, 8)
+        self.assertGreater(len(ranges), 1)
+        # The ranges are contiguous, covering every track of the Tracks dict.
+        self.assertEqual(ranges[0][0], contentStart)
+        self.assertEqual(ranges[-1][1], contentEnd)
+        for (start, end), (nextStart, nextEnd) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, nextStart)
+        self.assertEqual(sum(len(parallelLibrary.parseTrackRange(self.libraryPath, start, end)) for start, end in ranges), 200)
+        self.assertIsNone(findTrackRanges(b'<plist><dict><key>Tracks</key><dict></dict></dict></plist>', 8))
+
+    def test_as_library_reader(self):
+        with open(self.libraryPath, 'rb') as libraryFile:
+            reader = LibraryReader(libraryFile)
+            tracks = list(reader.tracks())
+            playlists = list(reader.playlists())
+        parallelReader = ParallelLibraryReader(self.libraryPath, 2)
+        try:
+            self.assertGreater(len(parallelReader.trackRanges), 1)
+            self.assertEqual(parallelReader.header['Date'], datetime(2022, 5, 1))
+            self.assertEqual(list(parallelReader.tracks()), tracks)
+            self.assertEqual(list(parallelReader.playlists()), playlists)
+            self.assertEqual(parallelReader.convertURLs([track['Location'] for trackId, track in tracks if 'Location' in track]),
+                             convertURLs([track['Location'] for trackId, track in tracks if 'Location' in track]))
+        finally:
+            parallelReader.close()
+
+    def test_track_records(self):
+        with open(self.libraryPath, 'rb') as libraryFile:
+            records = [repr(track) for track in LibraryReader(libraryFile).trackRecords()]
+        parallelReader = ParallelLibraryReader(self.libraryPath, 2)
+        try:
+            self.assertEqual([repr(track) for track in parallelReader.trackRecords()], records)
+        finally:
+            parallelReader.close()
+
+if __name__ == '__main__':
+    unittest.main()
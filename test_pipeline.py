@@ -0,0 +1,81 @@
+"""
+Tests of the pipelined matching and writing of updates to a Strawberry database.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from pipeline import Pipeline
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databasePath = os.path.join(self.directory, 'strawberry.db')
+        client = sqlite3.connect(self.databasePath)
+        client.execute("CREATE TABLE songs (url TEXT, playcount INTEGER)")
+        client.executemany("INSERT INTO songs VALUES (?, 0)", [(f"file:///{index}.mp3", ) for index in range(100)])
+        client.commit()
+        client.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def playCounts(self):
+        client = sqlite3.connect(self.databasePath)
+        try:
+            return client.execute("SELECT url, playcount FROM songs ORDER BY rowid").fetchall()
+        finally:
+            client.close()
+
+    @staticmethod
+    def matchSong(readCursor, item):
+        """
+        Matches the song of the URL, updating it by rowid, or else by URL.
+        """
+        url, playCount = item
+        found = readCursor.execute("SELECT rowid FROM songs WHERE url = ?", (url, )).fetchone()
+        return found, [("UPDATE songs SET playcount = ? WHERE rowid = ?", (playCount, found[0] if found else -1)),
+                       ("UPDATE songs SET playcount = ? WHERE url = ?", (playCount, url))]
+
+    def test_written_in_order(self):
+        outcomes = []
+        items = [(f"file:///{index}.mp3", index + 1) for index in range(0, 120, 3)]
+        # Batches smaller than the items, so several are committed.
+        with Pipeline(self.databasePath, self.matchSong, lambda *outcome: outcomes.append(outcome), matcherCount = 3,
+                      queueSize = 4, commitSize = 7) as songPipeline:
+            for item in items:
+                songPipeline.put(item)
+        self.assertEqual([item for item, found, updateIndex in outcomes], items)
+        self.assertEqual([updateIndex for item, found, updateIndex in outcomes], [0 if item[1] <= 100 else None for item in items])
+        self.assertEqual(self.playCounts(), [(f"file:///{index}.mp3", index + 1 if index % 3 == 0 else 0) for index in range(100)])
+
+    def test_later_update(self):
+        outcomes = []
+        # The first update of each item changes no row, so the second is executed.
+        with Pipeline(self.databasePath, lambda readCursor, item: (None, [("UPDATE songs SET playcount = 1 WHERE rowid = -1", ()),
+                                                                          ("UPDATE songs SET playcount = 2 WHERE url = ?", (item, ))]),
+                      lambda *outcome: outcomes.append(outcome)) as songPipeline:
+            songPipeline.put('file:///5.mp3')
+        self.assertEqual(outcomes, [('file:///5.mp3', None, 1)])
+        self.assertEqual(self.playCounts()[5], ('file:///5.mp3', 2))
+
+    def test_abandoned(self):
+        outcomes = []
+        with self.assertRaises(KeyError):
+            with Pipeline(self.databasePath, self.matchSong, lambda *outcome: outcomes.append(outcome)) as songPipeline:
+                songPipeline.put(('file:///1.mp3', 5))
+                raise KeyError('stop')
+        # The updates not yet committed are rolled back.
+        self.assertEqual(self.playCounts()[1], ('file:///1.mp3', 0))
+
+    def test_failed_update(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with Pipeline(self.databasePath, lambda readCursor, item: (None, [("UPDATE missing SET playcount = 1", ())]),
+                          lambda *outcome: None) as songPipeline:
+                songPipeline.put('file:///1.mp3')
+
+if __name__ == '__main__':
+    unittest.main()
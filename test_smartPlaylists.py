@@ -0,0 +1,122 @@
+"""
+Tests of compiling the rules of iTunes smart playlists, from Smart Info and Smart Criteria blobs
+laid out as iTunes writes them, and of storing the compiled criteria.
+"""
+
+import json
+import time
+import sqlite3
+import unittest
+from smartPlaylists import compileSmartPlaylist
+from iTunesPlayLists2Strawberry import SMART_PLAYLISTS_TABLE, writeSmartPlaylist
+
+def smartInfo(matchRules = 1, limited = 0, limitUnit = 0, limitValue = 0, selection = 0, reversed = 0):
+    info = bytearray(90)
+    info[1] = matchRules
+    info[2] = limited
+    info[3] = limitUnit
+    info[7] = selection
+    info[8:12] = limitValue.to_bytes(4, 'big')
+    info[13] = reversed
+    return bytes(info)
+
+def smartCriteria(rules, conjunction = 0):
+    criteria = bytearray(136)
+    criteria[0:4] = b'SLst'
+    criteria[15] = conjunction
+    return bytes(criteria) + b''.join(rules)
+
+def stringRule(field, operator, value, negative = False):
+    encoded = value.encode('utf-16-be')
+    rule = bytearray(56)
+    rule[3] = field
+    rule[4] = 0x03 if negative else 0x01
+    rule[7] = operator
+    rule[55] = len(encoded)
+    return bytes(rule) + encoded
+
+def numericRule(field, operator, value, upperValue = 0, negative = False, timeValue = 0, timeMultiple = 0):
+    rule = bytearray(124)
+    rule[3] = field
+    rule[4] = 0x03 if negative else 0x01
+    rule[7] = operator
+    rule[60:68] = value.to_bytes(8, 'big', signed = True)
+    rule[68:76] = timeValue.to_bytes(8, 'big', signed = True)
+    rule[76:84] = timeMultiple.to_bytes(8, 'big', signed = True)
+    rule[84:92] = upperValue.to_bytes(8, 'big', signed = True)
+    return bytes(rule)
+
+class CompileSmartPlaylistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sqlite3.connect(':memory:')
+        self.cursor = self.client.cursor()
+        self.cursor.execute("CREATE TABLE songs (title TEXT, album TEXT, artist TEXT, genre TEXT, comment TEXT, composer TEXT, grouping TEXT, albumartist TEXT, "
+                            "bitrate INTEGER, year INTEGER, track INTEGER, length INTEGER, playcount INTEGER, rating REAL, skipcount INTEGER, "
+                            "ctime INTEGER, lastplayed INTEGER, filesize INTEGER)")
+        now = int(time.time())
+        songs = [('One', '100% Hits', 'Artist', 'Rock', 0.8, 10, now - 3600),
+                 ('Two', '100 Hits', 'Artist', 'Jazz', 0.4, 3, now - 30 * 86400),
+                 ('Three', None, 'Other', None, 0.6, 0, -1)]
+        self.cursor.executemany("INSERT INTO songs (title, album, artist, genre, rating, playcount, lastplayed, length, filesize) VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)", songs)
+
+    def selectedTitles(self, info, criteria):
+        smartSQL, smartParameters, uncompiled = compileSmartPlaylist(info, criteria)
+        self.assertEqual(uncompiled, [])
+        rowids = [row[0] for row in self.cursor.execute(smartSQL, smartParameters)]
+        return [self.cursor.execute("SELECT title FROM songs WHERE rowid = ?", (rowid,)).fetchone()[0] for rowid in rowids]
+
+    def test_contains_is_literal(self):
+        # The % of the value is matched literally, rather than as a wildcard.
+        criteria = smartCriteria([stringRule(0x03, 0x02, '100%')])
+        self.assertEqual(self.selectedTitles(smartInfo(), criteria), ['One'])
+
+    def test_negated_rule_matches_null(self):
+        # A song without an album or genre does not contain the text, so is selected by its negation.
+        self.assertEqual(self.selectedTitles(smartInfo(), smartCriteria([stringRule(0x03, 0x02, 'Hits', negative = True)])), ['Three'])
+        self.assertEqual(self.selectedTitles(smartInfo(), smartCriteria([stringRule(0x08, 0x01, 'rock', negative = True)])), ['Two', 'Three'])
+
+    def test_any_rule(self):
+        criteria = smartCriteria([stringRule(0x08, 0x01, 'Jazz'), numericRule(0x16, 0x10, 5)], conjunction = 1)
+        self.assertEqual(self.selectedTitles(smartInfo(), criteria), ['One', 'Two'])
+
+    def test_rating_range(self):
+        # iTunes rates 0 to 100, Strawberry 0 to 1.
+        self.assertEqual(self.selectedTitles(smartInfo(), smartCriteria([numericRule(0x19, 0x00, 50, 100)])), ['One', 'Three'])
+
+    def test_played_in_the_last_week(self):
+        criteria = smartCriteria([numericRule(0x17, 0x00, 0x2dae2dae2dae2dae, timeValue = -7, timeMultiple = 86400)])
+        self.assertEqual(self.selectedTitles(smartInfo(), criteria), ['One'])
+
+    def test_limited_by_items_in_selection_order(self):
+        info = smartInfo(limited = 1, limitUnit = 0x03, limitValue = 2, selection = 0x19)
+        self.assertEqual(self.selectedTitles(info, smartCriteria([stringRule(0x04, 0x04, 'Art')])), ['One', 'Two'])
+        info = smartInfo(limited = 1, limitUnit = 0x03, limitValue = 1, selection = 0x19, reversed = 1)
+        self.assertEqual(self.selectedTitles(info, smartCriteria([stringRule(0x04, 0x04, 'Art')])), ['Two'])
+
+    def test_limit_without_rules(self):
+        # A playlist not matching rules selects from the whole library by its limit.
+        info = smartInfo(matchRules = 0, limited = 1, limitUnit = 0x03, limitValue = 1, selection = 0x1c)
+        self.assertEqual(self.selectedTitles(info, smartCriteria([stringRule(0x08, 0x01, 'Jazz')])), ['One'])
+
+    def test_whole_library_not_compiled(self):
+        smartSQL, smartParameters, uncompiled = compileSmartPlaylist(smartInfo(matchRules = 0), smartCriteria([stringRule(0x08, 0x01, 'Jazz')]))
+        self.assertIsNone(smartSQL)
+        self.assertEqual(len(uncompiled), 1)
+
+    def test_unknown_field_not_compiled(self):
+        smartSQL, smartParameters, uncompiled = compileSmartPlaylist(smartInfo(), smartCriteria([numericRule(0x3f, 0x01, 1), numericRule(0x16, 0x01, 1)]))
+        self.assertIsNone(smartSQL)
+        self.assertEqual(len(uncompiled), 1)
+
+    def test_stored_criteria(self):
+        smartSQL, smartParameters, uncompiled = compileSmartPlaylist(smartInfo(), smartCriteria([stringRule(0x08, 0x01, 'Jazz')]))
+        self.assertEqual(writeSmartPlaylist(self.cursor, 'Jazz', smartSQL, smartParameters), 1)
+        self.assertEqual(writeSmartPlaylist(self.cursor, 'Jazz', smartSQL, smartParameters), 0)
+        query, parameters = self.cursor.execute(f"SELECT query, parameters FROM {SMART_PLAYLISTS_TABLE} WHERE name = 'Jazz'").fetchone()
+        # The stored criteria select the songs as they are when run, rather than when stored.
+        self.cursor.execute("UPDATE songs SET genre = 'Jazz' WHERE title = 'Three'")
+        self.assertEqual([row[0] for row in self.cursor.execute(query, json.loads(parameters))], [2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Tests of merging the play counts of one Strawberry database into another.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from updateStrawberry import mergeStrawberryDatabases, pipelineMergeStrawberryDatabases
+
+def createDatabase(path, songs):
+    """
+    Creates a database of the (url, playcount, lastplayed, skipcount) songs.
+    """
+    client = sqlite3.connect(path)
+    client.execute("CREATE TABLE songs (url TEXT, playcount INTEGER, lastplayed INTEGER, skipcount INTEGER)")
+    client.executemany("INSERT INTO songs VALUES (?, ?, ?, ?)", songs)
+    client.commit()
+    client.close()
+
+class MergeStrawberryDatabasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.updatePath = os.path.join(self.directory, 'strawberry.db')
+        self.fromPath = os.path.join(self.directory, 'from.db')
+        createDatabase(self.updatePath, [('file:///a.mp3', 0, -1, 0), ('file:///b.mp3', 0, -1, 0), ('file:///c.mp3', 0, -1, 0),
+                                         ('file:///d.mp3', 7, 700, 1)])
+        # The first played song of a URL is used, and songs already played are not altered.
+        createDatabase(self.fromPath, [('file:///a.mp3', 0, -1, 0), ('file:///a.mp3', 3, 300, 2), ('file:///a.mp3', 4, 400, 0),
+                                       ('file:///b.mp3', 0, -1, 0), ('file:///d.mp3', 9, 900, 0)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def songCounts(self):
+        client = sqlite3.connect(self.updatePath)
+        try:
+            return client.execute("SELECT url, playcount, lastplayed, skipcount FROM songs ORDER BY rowid").fetchall()
+        finally:
+            client.close()
+
+    def merge(self, dryRun):
+        client = sqlite3.connect(self.updatePath)
+        try:
+            result = mergeStrawberryDatabases(client.cursor(), self.fromPath, dryRun = dryRun)
+            client.commit()
+        finally:
+            client.close()
+        return result
+
+    def test_merge(self):
+        updateCount, summary = self.merge(False)
+        self.assertEqual(updateCount, 1)
+        self.assertEqual(summary, {'matched': 1, 'skipped': 1, 'missing': 1})
+        self.assertEqual(self.songCounts(), [('file:///a.mp3', 3, 300, 2), ('file:///b.mp3', 0, -1, 0), ('file:///c.mp3', 0, -1, 0),
+                                             ('file:///d.mp3', 7, 700, 1)])
+
+    def test_dry_run(self):
+        before = self.songCounts()
+        updateCount, summary = self.merge(True)
+        self.assertEqual(updateCount, 0)
+        self.assertEqual(summary, {'matched': 1, 'skipped': 1, 'missing': 1})
+        self.assertEqual(self.songCounts(), before)
+
+    def test_pipeline_merge(self):
+        # The joined merge of a copy of the database, to compare the pipelined merge with.
+        pipelinedPath = os.path.join(self.directory, 'pipelined.db')
+        shutil.copyfile(self.updatePath, pipelinedPath)
+        expected = self.merge(False)
+        # Pages smaller than the songs, so the unplayed songs are read in several.
+        self.assertEqual(pipelineMergeStrawberryDatabases(pipelinedPath, self.fromPath, matcherCount = 2, pageSize = 2), expected)
+        self.updatePath = pipelinedPath
+        self.assertEqual(self.songCounts(), [('file:///a.mp3', 3, 300, 2), ('file:///b.mp3', 0, -1, 0), ('file:///c.mp3', 0, -1, 0),
+                                             ('file:///d.mp3', 7, 700, 1)])
+
+    def test_pipeline_dry_run(self):
+        before = self.songCounts()
+        self.assertEqual(pipelineMergeStrawberryDatabases(self.updatePath, self.fromPath, dryRun = True, pageSize = 2),
+                         (0, {'matched': 1, 'skipped': 1, 'missing': 1}))
+        self.assertEqual(self.songCounts(), before)
+
+if __name__ == '__main__':
+    unittest.main()
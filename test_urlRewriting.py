@@ -0,0 +1,31 @@
+"""
+Tests of the rewriting of track URLs by the URL replacement rules.
+"""
+
+import re
+import unittest
+from urlRewriting import URLRewriter
+
+class URLRewriterTest(unittest.TestCase):
+
+    def test_chained_rules(self):
+        # The second rule applies to the URL as rewritten by the first.
+        urlRewriter = URLRewriter([('Music', 'Media'), ('Media/Old', 'Archive')])
+        self.assertEqual(urlRewriter.rewrite('file:///Volumes/Music/Old/01%20Track.mp3'), 'file:///Volumes/Archive/01%20Track.mp3')
+        self.assertEqual(urlRewriter.rewrite('file:///Volumes/Music/New/01%20Track.mp3'), 'file:///Volumes/Media/New/01%20Track.mp3')
+        self.assertEqual([count for pattern, replacement, count in urlRewriter.ruleCounts()], [2, 1])
+
+    def test_rules_in_order_as_re_sub(self):
+        rules = [('iTunes/iTunes%20Music', 'Media'), (r'Media/([^/]*)_', r'Media/\1&'), ('Media', 'Music'), (r'\.m4a$', '.flac')]
+        urls = ['file:///Users/me/iTunes/iTunes%20Music/Brian%20Eno%20_%20David%20Byrne/01.m4a',
+                'file:///Users/me/Media/Media/02.mp3',
+                'file:///Users/me/Other/03.m4a']
+        urlRewriter = URLRewriter(rules)
+        for url in urls:
+            expected = url
+            for pattern, replacement in rules:
+                expected = re.sub(pattern, replacement, expected, count = 1)
+            self.assertEqual(urlRewriter.rewrite(url), expected)
+
+if __name__ == '__main__':
+    unittest.main()
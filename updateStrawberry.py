@@ -9,8 +9,12 @@ import argparse
 import sqlite3
 import re
 from datetime import datetime, timezone
-from urllib.parse import quote, unquote, urlparse, urlunparse
-import unicodedata
+from strawberryDatabase import executeUpdate
+from pipeline import Pipeline, MATCHER_COUNT, connectReadOnly
+from liveDatabase import databaseToUpdate
+from runStatistics import runStatistics
+
+appLogger = logging.getLogger("strawberry2Strawberry")
 
 def dumpAllPlayed(cursor):
     findPlayed = "SELECT title,artist,url,playcount,lastplayed,skipcount FROM songs WHERE playcount <> 0"
@@ -19,73 +23,116 @@ def dumpAllPlayed(cursor):
     for row in cursor.fetchall():
         print(row[0], row[1], row[2], row[3], datetime.fromtimestamp(row[4]), row[5])
 
-def convertURL(iTunesURL):
+def mergeStrawberryDatabases(updateDatabaseCursor, fromDatabasePath, dryRun = False):
     """
-    Converts the iTunes URLs to a URL that can be found in the Strawberry database.
+    Only update songs in the strawberry database which have play counts of zero, from the first
+    played song with the same URL in the from database. The from database is attached, so the
+    transfer is made with a single joined UPDATE, rather than querying it for each song.
+    Returns a tuple of the number of updates performed, and a dictionary summarising the number
+    of unplayed songs matched, skipped as unplayed in the from database, and missing from it.
+    If dryRun, the songs to be updated are only reported.
     """
-    # Convert XML encoding of ampersands in the URL.
-    iTunesURL = iTunesURL.replace('&#38;', '&')
-    # iTunes encodes URLs, using UTF-8 encoding, but using a character and the combining diacritic,
-    # instead of the noramlized, singular combined character including the diacritic, that Strawberry uses.
-    # For example, iTunes: "n%CC%83", Strawberry: "%C3%B1"
-    # So we need to decode the URL encoding, normalize the characters to the Normal Form
-    # Composed form, then decode the unicode encoding into UTF-8, then reencode the URL.
-    parsedURL = urlparse(iTunesURL) # parse the URL to ensure the URL separators don't get encoded.
-    decodedPath = unquote(parsedURL.path)
-    normalizedUnicodePath = unicodedata.normalize('NFC', decodedPath)
-    # While Strawberry encodes the URL, it leaves a lot of characters unquoted.
-    encodedURL = urlunparse((parsedURL.scheme,
-                             parsedURL.netloc,
-                             quote(normalizedUnicodePath, safe = "/&'(),[];!+=@"),
-                             parsedURL.params,
-                             parsedURL.query,
-                             parsedURL.fragment))
-    # Finally escape quote characters in URL for SQL use.
-    return encodedURL.replace("'", "''")
-
-def updatePlayDetails(strawberryDatabaseCursor, cleanedURL, newPlayCount, newLastPlayed, newSkipCount):
-    # Set the track with the unassigned play count, last played date, and skip counts to the iTunes values:
-    updateCounts = f"UPDATE songs SET playcount = {newPlayCount}, skipcount = {newSkipCount}, lastplayed = {newLastPlayed} WHERE url = '{cleanedURL}' AND playcount = 0"
-    appLogger.debug(updateCounts)
-    strawberryDatabaseCursor.execute(updateCounts)
-    # Determine if the field was updated.
-    strawberryDatabaseCursor.execute('SELECT changes() FROM songs')
-    result = strawberryDatabaseCursor.fetchone()
-    if result[0] == 0:
-        appLogger.warning(f"Unable to update {cleanedURL}")
-        return False
-    else:
-        appLogger.info(f"Updated Track: {cleanedURL} to {newPlayCount}, {newLastPlayed}, {newSkipCount}")
-        return True
-    
-def processUnplayedStrawberyFiles(updateDatabaseCursor, fromDatabaseCursor):
+    appLogger.info("Searching for unplayed tracks in database in the from database")
+    updateDatabaseCursor.execute("ATTACH DATABASE ? AS fromDatabase", (fromDatabasePath, ))
+    # For each URL in the from database, the first song played, if any, indexed for the join.
+    updateDatabaseCursor.execute("DROP TABLE IF EXISTS temp.from_songs")
+    with runStatistics.phase('matching'):
+        updateDatabaseCursor.execute("""CREATE TEMP TABLE from_songs AS
+            SELECT url, MIN(iif(playcount > 0, rowid, NULL)) AS played_row FROM fromDatabase.songs GROUP BY url""")
+        updateDatabaseCursor.execute("CREATE UNIQUE INDEX temp.from_songs_url ON from_songs (url)")
+    previewMerge = """SELECT songs.url, from_songs.url IS NOT NULL, playedSongs.playcount, playedSongs.lastplayed, playedSongs.skipcount
+        FROM songs LEFT JOIN from_songs ON (from_songs.url = songs.url)
+        LEFT JOIN fromDatabase.songs AS playedSongs ON (playedSongs.rowid = from_songs.played_row)
+        WHERE songs.playcount = 0"""
+    appLogger.debug(previewMerge)
+    summary = {'matched': 0, 'skipped': 0, 'missing': 0}
+    with runStatistics.phase('matching'):
+        updateDatabaseCursor.execute(previewMerge)
+        for url, found, playCount, lastPlayed, skipCount in updateDatabaseCursor:
+            if playCount is not None:
+                appLogger.info("Matched URL %s, play count %s last played %s skip count %s", url, playCount, lastPlayed, skipCount)
+                summary['matched'] += 1
+            elif found:
+                appLogger.warning("Unplayed in the from database, not altering play count: %s", url)
+                summary['skipped'] += 1
+            else:
+                appLogger.debug("Unable to find %s", url)
+                summary['missing'] += 1
+    runStatistics.count('matched_url', summary['matched'] + summary['skipped'])
+    runStatistics.count('unmatched', summary['missing'])
+
+    updateCount = 0
+    if not dryRun:
+        mergeCounts = """UPDATE songs SET playcount = playedSongs.playcount, skipcount = playedSongs.skipcount, lastplayed = playedSongs.lastplayed
+            FROM from_songs JOIN fromDatabase.songs AS playedSongs ON (playedSongs.rowid = from_songs.played_row)
+            WHERE from_songs.url = songs.url AND songs.playcount = 0"""
+        appLogger.debug(mergeCounts)
+        updateCount = executeUpdate(updateDatabaseCursor, mergeCounts)
+    return updateCount, summary
+
+def pipelineMergeStrawberryDatabases(updateDatabasePath, fromDatabasePath, dryRun = False, matcherCount = MATCHER_COUNT,
+                                     pageSize = 1000):
     """
-    Only update files in the strawberry database which have play counts of zero.
-    Returns the number of updates performed.
+    The pipelined equivalent of mergeStrawberryDatabases. The unplayed songs are read a page at
+    a time on this thread, while matcher threads look up the first played song with the same URL
+    in the from database, and a writer thread updates the songs by rowid, committing the updates
+    in batches. Returns the same tuple as mergeStrawberryDatabases.
     """
     appLogger.info("Searching for unplayed tracks in database in the from database")
-    allUnplayedSongs = "SELECT url, artist, title, playcount, lastplayed, skipcount FROM songs WHERE playcount = 0"
-    appLogger.debug(allUnplayedSongs)
+    # The played song, or else any song, with the URL, so those unplayed can be reported.
+    findFromSong = "SELECT playcount, lastplayed, skipcount FROM songs WHERE url = ? ORDER BY playcount = 0, rowid LIMIT 1"
+    appLogger.debug(findFromSong)
+
+    def matchSong(readCursor, song):
+        rowId, url = song
+        readCursor.execute(findFromSong, (url, ))
+        fromSongs = readCursor.fetchall()
+        fromSong = fromSongs[0] if len(fromSongs) > 0 else None
+        if fromSong is None or fromSong[0] == 0 or dryRun:
+            return fromSong, []
+        playCount, lastPlayed, skipCount = fromSong
+        return fromSong, [("UPDATE songs SET playcount = ?, skipcount = ?, lastplayed = ? WHERE rowid = ? AND playcount = 0",
+                           (playCount, skipCount, lastPlayed, rowId))]
+
+    summary = {'matched': 0, 'skipped': 0, 'missing': 0}
     updateCount = 0
-    updateDatabaseCursor.execute(allUnplayedSongs)
-    for row in updateDatabaseCursor.fetchall():
-        cleanedURL = convertURL(row[0])
-        retrieveSong = f"SELECT url, artist, title, playcount, lastplayed, skipcount FROM songs WHERE url='{cleanedURL}'"
-        appLogger.debug(retrieveSong)
-        fromDatabaseCursor.execute(retrieveSong)
-        found = False
-        for fromRow in fromDatabaseCursor.fetchall():
-            appLogger.info(f"Matched URL {fromRow[0]}, play count {fromRow[3]} last played {fromRow[4]} skip count {fromRow[5]}")
-            found = True
-            if fromRow[3] > 0:
-                if updatePlayDetails(updateDatabaseCursor, cleanedURL, fromRow[3], fromRow[4], fromRow[5]):
-                    updateCount += 1
-                break
-            else:
-                appLogger.warning(f"Unplayed in the from database, not altering play count: {row[0]}")
-        if not found:
-            appLogger.debug(f"Unable to find {row[0]}")
-    return updateCount
+    def songWritten(song, fromSong, updateIndex):
+        nonlocal updateCount
+        rowId, url = song
+        if fromSong is None:
+            appLogger.debug("Unable to find %s", url)
+            summary['missing'] += 1
+        elif fromSong[0] == 0:
+            appLogger.warning("Unplayed in the from database, not altering play count: %s", url)
+            summary['skipped'] += 1
+        else:
+            appLogger.info("Matched URL %s, play count %s last played %s skip count %s", url, *fromSong)
+            summary['matched'] += 1
+            if updateIndex is not None:
+                updateCount += 1
+
+    # The songs are paged through by rowid, so no read is left open while the writer commits.
+    unplayedSongs = "SELECT rowid, url FROM songs WHERE playcount = 0 AND rowid > ? ORDER BY rowid LIMIT ?"
+    appLogger.debug(unplayedSongs)
+    readConnection = connectReadOnly(updateDatabasePath)
+    try:
+        readCursor = readConnection.cursor()
+        with Pipeline(updateDatabasePath, matchSong, songWritten, matchDatabasePath = fromDatabasePath,
+                      matcherCount = matcherCount) as songPipeline:
+            lastRowId = -1
+            while True:
+                readCursor.execute(unplayedSongs, (lastRowId, pageSize))
+                songs = readCursor.fetchall()
+                if len(songs) == 0:
+                    break
+                for song in songs:
+                    songPipeline.put(song)
+                lastRowId = songs[-1][0]
+    finally:
+        readConnection.close()
+    runStatistics.count('matched_url', summary['matched'] + summary['skipped'])
+    runStatistics.count('unmatched', summary['missing'])
+    return updateCount, summary
 
 
 if __name__ == '__main__':
@@ -94,33 +141,49 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--update-db', action = 'store', help = 'Path to the Strawberry database file to update.', type = str, default = 'strawberry.db')
     parser.add_argument('-f', '--from-db', action = 'store', help = 'Path to the Strawberry database to update from.', default = '')
     parser.add_argument('-d', '--dump-existing', action = 'store_true', help = 'Display the existing tracks if they already have play counts')
+    parser.add_argument('-n', '--dry-run', action = 'store_true', help = 'Only report the tracks which would be updated, without updating them')
+    parser.add_argument('-P', '--pipeline', action = 'store_true', help = 'Match and update the songs on separate threads, committing the updates in batches, rather than with a single joined UPDATE')
+    parser.add_argument('--matchers', action = 'store', type = int, help = 'The number of threads matching the songs with --pipeline. Defaults to %(default)s', default = MATCHER_COUNT)
+    parser.add_argument('--live', action = 'store_true', help = 'Update a snapshot of the Strawberry database, taken while it may still be open in Strawberry, then check the snapshot and swap it for the database, keeping the database as it was with .rollback appended')
+    parser.add_argument('--stats', action = 'store', nargs = '?', const = '-', metavar = 'FILE',
+                        help = 'Write the time of each phase of the run, and the number of tracks matched, as JSON to the file, or standard output')
     
     args = parser.parse_args()
 
-    # We set the logging value here so it's available to the core and master nodes.
-    appLogger = logging.getLogger("strawberry2Strawberry")
     logging.basicConfig()
 
     if args.verbose > 1:
         appLogger.setLevel(logging.DEBUG)
+        logging.getLogger("pipeline").setLevel(logging.DEBUG)
+        logging.getLogger("liveDatabase").setLevel(logging.DEBUG)
     elif args.verbose > 0:
         appLogger.setLevel(logging.INFO)
+        logging.getLogger("pipeline").setLevel(logging.INFO)
+        logging.getLogger("liveDatabase").setLevel(logging.INFO)
 
-    updateSQLClient = sqlite3.connect(args.update_db)
-    updateCursor = updateSQLClient.cursor()
+    if args.stats is not None:
+        runStatistics.enable()
 
-    fromSQLClient = sqlite3.connect(args.from_db)
-    fromCursor = fromSQLClient.cursor()
-    
-    if args.dump_existing:
-        dumpAllPlayed(updateCursor)
-    
-    updateCount = processUnplayedStrawberyFiles(updateCursor, fromCursor)
-    appLogger.info(f"Updated {updateCount} tracks")
-    if updateCount > 0:
-        # Save (commit) the changes
-        updateSQLClient.commit()
+    with databaseToUpdate(args.update_db, args.live) as databasePath:
+        updateSQLClient = sqlite3.connect(databasePath)
+        updateCursor = updateSQLClient.cursor()
 
-    updateSQLClient.close()
+        if args.dump_existing:
+            dumpAllPlayed(updateCursor)
+    
+        if args.pipeline:
+            # The updates are committed by the pipeline's own connection.
+            updateCount, summary = pipelineMergeStrawberryDatabases(databasePath, args.from_db, dryRun = args.dry_run,
+                                                                    matcherCount = args.matchers)
+        else:
+            updateCount, summary = mergeStrawberryDatabases(updateCursor, args.from_db, dryRun = args.dry_run)
+        print("{matched} unplayed tracks matched, {skipped} skipped as unplayed in the from database, {missing} missing from the from database".format(**summary))
+        appLogger.info(f"Updated {updateCount} tracks")
+        if updateCount > 0:
+            # Save (commit) the changes
+            with runStatistics.phase('commit'):
+                updateSQLClient.commit()
 
-    fromSQLClient.close()
+        updateSQLClient.close()
+    if args.stats is not None:
+        runStatistics.write(args.stats)
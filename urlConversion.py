@@ -0,0 +1,77 @@
+"""
+Conversion of iTunes track URLs to the URLs used in the Strawberry database, shared by each
+of the utilities.
+
+Conversions are memoized, since the same Location is typically converted many times within a
+run, for example once for the play counts and again for each playlist it is in.
+"""
+
+import functools
+from urllib.parse import quote, unquote, urlparse, urlunparse
+import unicodedata
+
+# The maximum number of URLs retained by the memo of convertURL.
+URL_CACHE_SIZE = 131072
+
+def canonicalURL(iTunesURL):
+    """
+    Converts the iTunes URLs to a URL that can be found in the Strawberry database.
+    This performs the conversion without memoization, use convertURL for repeated conversions.
+    """
+    # Convert XML encoding of ampersands in the URL.
+    iTunesURL = iTunesURL.replace('&#38;', '&')
+    # iTunes encodes URLs, using UTF-8 encoding, but using a character and the combining diacritic,
+    # instead of the noramlized, singular combined character including the diacritic, that Strawberry uses.
+    # For example, iTunes: "n%CC%83", Strawberry: "%C3%B1"
+    # So we need to decode the URL encoding, normalize the characters to the Normal Form
+    # Composed form, then decode the unicode encoding into UTF-8, then reencode the URL.
+    parsedURL = urlparse(iTunesURL) # parse the URL to ensure the URL separators don't get encoded.
+    decodedPath = unquote(parsedURL.path)
+    normalizedUnicodePath = unicodedata.normalize('NFC', decodedPath)
+    # While Strawberry encodes the URL, it leaves a lot of characters unquoted.
+    encodedURL = urlunparse((parsedURL.scheme,
+                             parsedURL.netloc,
+                             quote(normalizedUnicodePath, safe = "/&'(),[];!+=@"),
+                             parsedURL.params,
+                             parsedURL.query,
+                             parsedURL.fragment))
+    return encodedURL
+
+# Converts the iTunes URLs to a URL that can be found in the Strawberry database, retaining
+# the most recently used conversions.
+convertURL = functools.lru_cache(maxsize = URL_CACHE_SIZE)(canonicalURL)
+
+def encodePath(path):
+    """
+    Returns the URL encoded path in the form Strawberry uses, the path component of canonicalURL.
+    """
+    return quote(unicodedata.normalize('NFC', unquote(path)), safe = "/&'(),[];!+=@")
+
+def convertURLs(iTunesURLs):
+    """
+    Converts a sequence of iTunes URLs in a single pass, converting each distinct URL only once.
+    Returns a list of the converted URLs, in the same order, identical to those of convertURL.
+    """
+    converted = {}
+    # Tracks are grouped in album directories, so the encoding of each directory is reused.
+    encodedDirectories = {}
+    convertedURLs = []
+    for iTunesURL in iTunesURLs:
+        cleanedURL = converted.get(iTunesURL)
+        if cleanedURL is None:
+            url = iTunesURL.replace('&#38;', '&')
+            slash = url.find('/', 7)
+            # Plain file URLs are split directly, leaving any others to be parsed by canonicalURL.
+            if (url.startswith('file://') and slash >= 0 and url[7:slash] in ('', 'localhost')
+                and url[slash:slash + 2] != '//' and not any(c in url for c in '?#\t\r\n')):
+                directory, separator, fileName = url[slash:].rpartition('/')
+                encodedDirectory = encodedDirectories.get(directory)
+                if encodedDirectory is None:
+                    encodedDirectory = encodedDirectories[directory] = encodePath(directory)
+                cleanedURL = url[:slash] + encodedDirectory + separator + encodePath(fileName)
+            # urlunparse treats a decoded path starting with // as the network location.
+            if cleanedURL is None or cleanedURL.startswith('//', slash):
+                cleanedURL = canonicalURL(iTunesURL)
+            converted[iTunesURL] = cleanedURL
+        convertedURLs.append(cleanedURL)
+    return convertedURLs
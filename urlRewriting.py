@@ -0,0 +1,67 @@
+"""
+Rewriting of the converted URLs of iTunes tracks by the URL replacement rules of the utilities,
+such as the moves of volumes and folders made since the iTunes library was written.
+
+Rules are (regular expression, replacement) pairs, applied to each URL in the order given, each
+at most once, at the first position it matches, as re.sub with a count of one does. A rule is
+applied to the URL as rewritten by the rules before it, so rules may be chained, such as a move
+of a folder followed by a move of one of its subfolders under the new name.
+
+The rules are compiled once, and shared by all the URLs rewritten. Those whose pattern and
+replacement are literal text, the usual case of a moved folder, are applied with a substring
+search and replace, rather than the regular expression engine. The number of URLs each rule
+rewrote is counted, so rules which no longer apply can be found.
+"""
+
+import re
+
+# Patterns holding no regular expression syntax, other than escaped punctuation.
+literalPattern = re.compile(r"(?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])+")
+escapedCharacter = re.compile(r"\\(.)")
+
+class URLRewriter:
+    """
+    Rewrites URLs by the (pattern, replacement) rules, in the order given.
+    """
+
+    def __init__(self, rules):
+        self.rules = [(pattern, replacement) for pattern, replacement in rules]
+        # The number of URLs rewritten by each rule.
+        self.counts = [0] * len(self.rules)
+        # The literal text, or compiled pattern, and replacement of each rule.
+        self.compiledRules = []
+        for pattern, replacement in self.rules:
+            if literalPattern.fullmatch(pattern) and '\\' not in replacement:
+                self.compiledRules.append((escapedCharacter.sub(r"\1", pattern), replacement))
+            else:
+                self.compiledRules.append((re.compile(pattern), replacement))
+
+    def rewrite(self, url):
+        """
+        Returns the URL rewritten by the rules.
+        """
+        for index, (pattern, replacement) in enumerate(self.compiledRules):
+            if isinstance(pattern, str):
+                if pattern in url:
+                    url = url.replace(pattern, replacement, 1)
+                    self.counts[index] += 1
+            else:
+                url, replacedCount = pattern.subn(replacement, url, count = 1)
+                self.counts[index] += replacedCount
+        return url
+
+    def ruleCounts(self):
+        """
+        Returns a list of the (pattern, replacement, number of URLs rewritten) of each rule.
+        """
+        return [(pattern, replacement, count) for (pattern, replacement), count in zip(self.rules, self.counts)]
+
+    def logRuleCounts(self, logger):
+        """
+        Logs the number of URLs each rule rewrote, warning of those which rewrote none.
+        """
+        for pattern, replacement, count in self.ruleCounts():
+            if count == 0:
+                logger.warning(f"No URLs were rewritten by replacing {pattern} with {replacement}")
+            else:
+                logger.info(f"Rewrote {count} URLs replacing {pattern} with {replacement}")